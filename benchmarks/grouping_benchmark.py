@@ -0,0 +1,70 @@
+"""Compare the time each job grouper takes to render a page mixing a few slow
+components with large props and many fast ones, against a local Hypernova
+stand-in that renders the jobs of each job group one after the other.
+
+Run from the repository root with:
+
+    python -m benchmarks.grouping_benchmark
+
+Job groups are sent at once, so a page takes as long as its slowest job group.
+CountJobGrouper puts the product grids, rendered first, in the same job group,
+while SizeJobGrouper and RenderTimeJobGrouper spread them across job groups.
+RenderTimeJobGrouper learns the render times while warming up.
+"""
+import time
+
+import pyramid.request
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.grouping import CountJobGrouper
+from pyramid_hypernova.grouping import RenderTimeJobGrouper
+from pyramid_hypernova.grouping import SizeJobGrouper
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.transports import ThreadPoolTransport
+from testing.hypernova_server import StubHypernovaServer
+
+
+MAX_BATCH_SIZE = 4
+RENDER_TIMES = {'ProductGrid.js': 0.03, 'Button.js': 0.001}
+PAGES = 10
+WARM_UP_PAGES = 3
+JOB_GROUPERS = (
+    ('count', CountJobGrouper()),
+    ('size', SizeJobGrouper()),
+    ('render time', RenderTimeJobGrouper()),
+)
+
+
+def render_page(url, transport, job_grouper):
+    batch_request = BatchRequest(
+        get_job_group_url=lambda job_group, pyramid_request: url,
+        plugin_controller=PluginController([]),
+        pyramid_request=pyramid.request.Request.blank('/'),
+        max_batch_size=MAX_BATCH_SIZE,
+        transport=transport,
+        job_grouper=job_grouper,
+    )
+    for i in range(3):
+        batch_request.render('ProductGrid.js', {'products': [{'id': i * 100 + j} for j in range(100)]})
+    for i in range(13):
+        batch_request.render('Button.js', {'label': f'Button {i}'})
+    results = batch_request.submit()
+    assert all(result.error is None for result in results.values())
+
+
+def main():
+    transport = ThreadPoolTransport(max_workers=16)
+    with StubHypernovaServer(render_times=RENDER_TIMES) as stub_server:
+        print(f'{"job grouper":>12}{"page (ms)":>12}')
+        for name, job_grouper in JOB_GROUPERS:
+            for _ in range(WARM_UP_PAGES):
+                render_page(stub_server.url, transport, job_grouper)
+
+            start = time.perf_counter()
+            for _ in range(PAGES):
+                render_page(stub_server.url, transport, job_grouper)
+            print(f'{name:>12}{(time.perf_counter() - start) / PAGES * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Compare render token replacement strategies on a large HTML document.
+
+Run from the repository root with:
+
+    python -m benchmarks.token_replacement_benchmark
+
+The previous implementation called `str.replace` once per job, rescanning the
+whole body for every token. `replace_render_tokens` scans the body once, so its
+run time should stay roughly flat as the number of tokens grows.
+`replace_render_tokens_in_bytes` does the same on the encoded body, as the
+tween does, without decoding it first.
+"""
+import timeit
+import uuid
+
+from pyramid_hypernova.rendering import RenderToken
+from pyramid_hypernova.token_replacement import replace_render_tokens
+from pyramid_hypernova.token_replacement import replace_render_tokens_in_bytes
+from pyramid_hypernova.types import JobResult
+
+
+BODY_SIZE = 400 * 1024
+TOKEN_COUNTS = (1, 10, 100, 1000)
+NUMBER = 5
+FILLER = '<p class="filler">lorem ipsum dolor sit amet</p>\n'
+
+
+def build_document(token_count):
+    identifiers = [str(uuid.uuid4()) for _ in range(token_count)]
+    filler_repeats = max(1, BODY_SIZE // len(FILLER) // (token_count + 1))
+    filler = FILLER * filler_repeats
+
+    pieces = [filler]
+    for identifier in identifiers:
+        pieces.append(str(RenderToken(identifier)))
+        pieces.append(filler)
+    content = ''.join(pieces)
+
+    job_results = {
+        identifier: JobResult(error=None, html=f'<div data-id="{identifier}">rendered</div>', job=None)
+        for identifier in identifiers
+    }
+    return content, job_results
+
+
+def replace_per_job(content, job_results):
+    for identifier, job_result in job_results.items():
+        content = content.replace(str(RenderToken(identifier)), job_result.html)
+    return content
+
+
+def main():
+    print(f'{"tokens":>8} {"per-job replace (ms)":>22} {"single pass (ms)":>18} {"bytes (ms)":>12}')
+    for token_count in TOKEN_COUNTS:
+        content, job_results = build_document(token_count)
+        encoded_content = content.encode('utf-8')
+        expected = replace_per_job(content, job_results)
+        assert replace_render_tokens(content, job_results) == expected
+        assert replace_render_tokens_in_bytes(encoded_content, job_results) == expected.encode('utf-8')
+
+        timings = [
+            min(timeit.repeat(lambda: replace(body, job_results), number=NUMBER, repeat=3)) / NUMBER * 1000
+            for replace, body in (
+                (replace_per_job, content),
+                (replace_render_tokens, content),
+                (replace_render_tokens_in_bytes, encoded_content),
+            )
+        ]
+        print(f'{token_count:>8} {timings[0]:>22.3f} {timings[1]:>18.3f} {timings[2]:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
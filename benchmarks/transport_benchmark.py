@@ -0,0 +1,75 @@
+"""Compare the time each transport takes to render a page against a local
+Hypernova stand-in that takes DELAY seconds to answer each job group.
+
+Run from the repository root with:
+
+    python -m benchmarks.transport_benchmark
+
+RequestsTransport sends job groups one after the other, so a page takes about
+`groups * DELAY`. The other transports send every group at once, so a page
+should take about DELAY however many groups it has. UnixSocketTransport queries
+the stand-in over a Unix domain socket rather than TCP.
+"""
+import os
+import tempfile
+import time
+
+import pyramid.request
+
+from pyramid_hypernova.aio import AsyncioTransport
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.transports import FidoTransport
+from pyramid_hypernova.transports import RequestsTransport
+from pyramid_hypernova.transports import ThreadPoolTransport
+from pyramid_hypernova.transports import UnixSocketTransport
+from testing.hypernova_server import StubHypernovaServer
+
+
+DELAY = 0.05
+GROUP_COUNTS = (1, 4, 16)
+PAGES = 5
+TRANSPORTS = (
+    ('requests', RequestsTransport()),
+    ('fido', FidoTransport()),
+    ('thread pool', ThreadPoolTransport(max_workers=16)),
+    ('asyncio', AsyncioTransport()),
+    ('unix', UnixSocketTransport(max_workers=16)),
+)
+
+
+def render_page(url, transport, group_count):
+    batch_request = BatchRequest(
+        get_job_group_url=lambda job_group, pyramid_request: url,
+        plugin_controller=PluginController([]),
+        pyramid_request=pyramid.request.Request.blank('/'),
+        max_batch_size=1,
+        transport=transport,
+    )
+    for i in range(group_count):
+        batch_request.render(f'Component{i}.js', {})
+    results = batch_request.submit()
+    assert all(result.error is None for result in results.values())
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubHypernovaServer(delay=DELAY) as stub_server, \
+            StubHypernovaServer(delay=DELAY, address=os.path.join(directory, 'hypernova.sock')) as unix_stub_server:
+        print(f'{"transport":>12}' + ''.join(f'{f"{count} groups (ms)":>18}' for count in GROUP_COUNTS))
+        for name, transport in TRANSPORTS:
+            url = unix_stub_server.url if isinstance(transport, UnixSocketTransport) else stub_server.url
+            # warm up connection pools and background threads
+            render_page(url, transport, 1)
+
+            timings = []
+            for group_count in GROUP_COUNTS:
+                start = time.perf_counter()
+                for _ in range(PAGES):
+                    render_page(url, transport, group_count)
+                timings.append((time.perf_counter() - start) / PAGES * 1000)
+            print(f'{name:>12}' + ''.join(f'{timing:>18.1f}' for timing in timings))
+
+
+if __name__ == '__main__':
+    main()
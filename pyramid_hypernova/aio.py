@@ -0,0 +1,228 @@
+"""asyncio support for querying Hypernova.
+
+Requires httpx, which is installed with the `asyncio` extra:
+
+    pip install pyramid-hypernova[asyncio]
+
+Http2Transport also requires h2, which is installed with the `http2` extra.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+import httpx
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.hedging import HedgedResponse
+from pyramid_hypernova.process import ProcessLocal
+from pyramid_hypernova.session import DEFAULT_POOL_SIZE
+from pyramid_hypernova.transports import BaseTransport
+from pyramid_hypernova.transports import format_response_error_data
+from pyramid_hypernova.transports import FutureResponse
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError
+from pyramid_hypernova.transports import min_timeout
+
+
+class EventLoopThread:
+    """An asyncio event loop running in a daemon thread, shared by every
+    request in this process, along with an httpx client (and its connection
+    pool) bound to that loop.
+
+    Synchronous code can run coroutines on it with run(), which returns a
+    concurrent.futures.Future.
+
+    :param http2: True for the client to speak HTTP/2 to servers that support
+        it
+    :param http1: False for the client to only speak HTTP/2, including to
+        plain http:// servers
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, http2=False, http1=True):
+        self.pool_size = pool_size
+        self.http2 = http2
+        self.http1 = http1
+        self.loop = ProcessLocal(self.start_loop)
+        self.client = None
+
+    def start_loop(self):
+        loop = asyncio.new_event_loop()
+        # The client's connections belong to the loop
+        self.client = None
+        threading.Thread(target=loop.run_forever, name='pyramid-hypernova-asyncio', daemon=True).start()
+        return loop
+
+    def get_loop(self):
+        return self.loop.get()
+
+    def get_client(self):
+        """Get the shared httpx client. Must be called from the loop's thread.
+
+        :rtype: httpx.AsyncClient
+        """
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=None,
+                    max_keepalive_connections=self.pool_size,
+                ),
+                http1=self.http1,
+                http2=self.http2,
+            )
+        return self.client
+
+    def run(self, coroutine):
+        """
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop())
+
+
+event_loop_thread = EventLoopThread()
+
+
+class AsyncioTransport(BaseTransport):
+    """Queries Hypernova with httpx on the asyncio event loop shared by the
+    process. Every query is sent as soon as it's created, so all of a page's
+    job groups are in flight at once.
+    """
+
+    def __init__(self, event_loop_thread=None):
+        self.event_loop_thread = event_loop_thread
+
+    def get_event_loop_thread(self):
+        return self.event_loop_thread or event_loop_thread
+
+    async def post(self, url, body, headers, timeout):
+        connect_timeout, read_timeout = timeout
+        try:
+            response = await self.get_event_loop_thread().get_client().post(
+                url=url,
+                headers=headers,
+                content=body,
+                timeout=httpx.Timeout(None, connect=connect_timeout, read=read_timeout),
+            )
+            response.raise_for_status()
+            return response.json()
+        except httpx.TimeoutException as e:
+            raise HypernovaQueryTimeoutError(e)
+        except httpx.HTTPStatusError as e:
+            try:
+                error_data = format_response_error_data(response.json().get('error', None))
+            except ValueError:
+                error_data = format_response_error_data({
+                    'message': response.text or 'SSRS did not return any content',
+                })
+            raise HypernovaQueryError(e, error_data, status_code=response.status_code)
+        except httpx.TransportError as e:
+            raise HypernovaQueryError(e)
+
+    def send(self, url, body, headers, timeout):
+        return FutureResponse(self.get_event_loop_thread().run(self.post(url, body, headers, timeout)))
+
+
+asyncio_transport = AsyncioTransport()
+
+
+class Http2Transport(AsyncioTransport):
+    """Queries Hypernova over HTTP/2. Every job group of a page, and every
+    page rendered at the same time in the process, is multiplexed over a
+    single long-lived connection per Hypernova server.
+
+    HTTP/2 is negotiated with https:// servers. Plain http:// servers are
+    queried with HTTP/1.1 unless `prior_knowledge` is set.
+
+    :param prior_knowledge: True to speak HTTP/2 to http:// servers without
+        negotiating it first (h2c), for servers known to support it
+    """
+
+    def __init__(self, prior_knowledge=False, event_loop_thread=None):
+        super().__init__(event_loop_thread or EventLoopThread(http2=True, http1=not prior_knowledge))
+
+
+class AsyncBatchRequest(BatchRequest):
+    """A BatchRequest that queries Hypernova with asyncio, sending every job
+    group concurrently over a shared connection pool.
+
+    It can be used as `pyramid_hypernova.batch_request_factory`. Async callers
+    can use `await submit_async()` instead of submit() to avoid blocking their
+    event loop while waiting on Hypernova.
+
+    Servers listening on a Unix domain socket (`unix://` URLs) are queried
+    with UnixSocketTransport, unless another transport is passed.
+    """
+
+    def choose_transport(self, url, concurrent):
+        if self.transport is None and not url.startswith('unix://'):
+            return asyncio_transport
+        return super().choose_transport(url, concurrent)
+
+    async def submit_async(self):
+        """Like submit(), but waits for Hypernova's responses without blocking
+        the running event loop, including while hedging slow queries,
+        retrying failed ones and waiting on identical jobs in flight from
+        other pages.
+
+        Responses that are only received once they're waited on, e.g. those of
+        the 'requests' or 'fido' transports, can't be awaited. submit() is then
+        run in the loop's default executor instead.
+
+        :rtype: Dict[str, JobResult]
+        """
+        self.flush()
+        if not all(
+            isinstance(getattr(query.response, 'future', None), Future)
+            for __, query in self.queries
+            if query.response is not None
+        ):
+            return await asyncio.get_running_loop().run_in_executor(None, self.submit)
+
+        await asyncio.gather(*[self.wait_for_query(query) for __, query in self.queries])
+        return self.submit()
+
+    async def wait_for_query(self, query):
+        """Wait for a query's response, hedging it once its hedge time has
+        passed and sending it again if it fails and its retry policy allows
+        it, then for the renders it joined. submit() then gets the results
+        without waiting.
+
+        :type query: HypernovaQuery
+        """
+        # Queries whose jobs were all coalesced with in-flight ones have no response
+        while query.response is not None:
+            future = query.response.future
+            if isinstance(query.response, HedgedResponse) and query.response.hedge_at is not None:
+                await wait_for_futures([future], min_timeout(
+                    max(query.response.hedge_at - time.monotonic(), 0),
+                    self.get_remaining_time(),
+                ))
+                remaining_time = self.get_remaining_time()
+                if remaining_time is None or remaining_time > 0:
+                    query.response.hedge()
+            await wait_for_futures([future], self.get_remaining_time())
+            if not future.done() or future.cancelled() or future.exception() is None:
+                break
+            backoff = query.get_retry_backoff(future.exception(), self.deadline_at)
+            if backoff is None:
+                break
+            await asyncio.sleep(backoff)
+            query.retry()
+
+        renders = list(query.joined_renders.values())
+        if renders:
+            timeout = min_timeout(self.get_remaining_time(), query.read_timeout)
+            timeout = min_timeout(timeout, max(render.expires_at for render in renders) - time.monotonic())
+            await wait_for_futures([render.future for render in renders], timeout)
+
+
+async def wait_for_futures(futures, timeout):
+    """Wait for concurrent.futures.Future objects without blocking the
+    running event loop.
+
+    :param timeout: maximum number of seconds to wait, or None
+    """
+    done, __ = await asyncio.wait([asyncio.wrap_future(future) for future in futures], timeout=timeout)
+    for future in done:
+        # Errors are raised by submit(), from the original futures
+        future.cancelled() or future.exception()
@@ -1,20 +1,46 @@
 import sys
+import time
 import traceback
 import uuid
+from collections import namedtuple
 from json import JSONEncoder
 
-from more_itertools import chunked
-
+from pyramid_hypernova.grouping import create_job_groups  # noqa: F401
+from pyramid_hypernova.grouping import get_job_grouper
 from pyramid_hypernova.rendering import render_blank_markup
 from pyramid_hypernova.rendering import RenderToken
+from pyramid_hypernova.request import encode_job_payload
+from pyramid_hypernova.request import EncodedJob
 from pyramid_hypernova.request import ErrorData
 from pyramid_hypernova.request import HypernovaQuery
 from pyramid_hypernova.request import HypernovaQueryError
+from pyramid_hypernova.shedding import NORMAL_PRIORITY
+from pyramid_hypernova.transports import get_transport
+from pyramid_hypernova.types import ComponentMetrics
 from pyramid_hypernova.types import HypernovaError
 from pyramid_hypernova.types import Job
+from pyramid_hypernova.types import JobGroupMetrics
 from pyramid_hypernova.types import JobResult
 
 
+# The name of the error plugins' on_error receives for jobs that Hypernova
+# failed to render, but were served stale HTML from the render cache
+STALE_RENDER_ERROR_NAME = 'HypernovaStaleRenderError'
+
+# The error plugins' on_error receives for jobs that weren't sent to Hypernova
+# because the circuit breaker is open
+CIRCUIT_OPEN_ERROR = HypernovaError(
+    name='HypernovaCircuitOpenError',
+    message='Not querying Hypernova while its circuit breaker is open',
+    stack=[],
+)
+
+# What a batch saved by sending jobs identical to others once: the number of
+# jobs that weren't sent, their size in the requests to Hypernova, and the
+# time Hypernova reported spending to render the jobs they were identical to
+DeduplicationStats = namedtuple('DeduplicationStats', ['jobs', 'bytes', 'render_ms'])
+
+
 def create_fallback_response(jobs, throw_client_error, json_encoder, error=None, display_error_stack=False):
     """Create a response dict for falling back to client-side rendering.
 
@@ -36,19 +62,18 @@ def create_fallback_response(jobs, throw_client_error, json_encoder, error=None,
     }
 
 
-def create_job_groups(jobs, max_batch_size):
-    job_groups = []
-
-    if max_batch_size and max_batch_size > 0:
-        for names in chunked(jobs, max_batch_size):
-            job_groups.append({
-                name: jobs[name]
-                for name in names
-            })
-    else:
-        job_groups.append(jobs)
+def split_job_group_url(job_group_url):
+    """Split what get_job_group_url returned into the URL to query, and
+    optionally the URL to send hedged queries to (see
+    pyramid_hypernova.hedging). get_job_group_url may return a single URL, or
+    a list of candidate URLs in order of preference.
 
-    return job_groups
+    :rtype: Tuple[str, Optional[str]]
+    """
+    if isinstance(job_group_url, str):
+        return job_group_url, None
+    urls = list(job_group_url)
+    return urls[0], urls[1] if len(urls) > 1 else None
 
 
 class BatchRequest:
@@ -60,17 +85,118 @@ class BatchRequest:
         pyramid_request,
         max_batch_size=None,
         json_encoder=JSONEncoder(),
-        display_error_stack=False
+        display_error_stack=False,
+        send_on_render=False,
+        connect_timeout=None,
+        read_timeout=None,
+        deadline=None,
+        transport=None,
+        render_cache=None,
+        coalescer=None,
+        max_batch_bytes=None,
+        job_grouper='count',
+        circuit_breaker=None,
+        load_shedder=None,
+        hedger=None,
+        retry_policy=None,
     ):
+        """
+        :param send_on_render: True to send each job to Hypernova as soon as it
+            is rendered, instead of waiting for the next flush() or submit()
+        :param connect_timeout: seconds to wait for a connection to Hypernova
+        :param read_timeout: seconds to wait for Hypernova to respond
+        :param deadline: seconds after the first job is sent to Hypernova after
+            which any job group still waiting on a response falls back to
+            client-side rendering
+        :param transport: the transport to query Hypernova with, or the name
+            it's registered under (see pyramid_hypernova.transports). By
+            default, Hypernova servers listening on a Unix domain socket
+            (`unix://` URLs) are queried with UnixSocketTransport, pages with a
+            single job group synchronously with requests, and other pages
+            asynchronously with fido.
+        :param render_cache: a pyramid_hypernova.cache.RenderCache to look
+            jobs up in before sending them to Hypernova
+        :param coalescer: a pyramid_hypernova.coalescing.RenderCoalescer, to
+            wait on identical jobs already sent by other pages instead of
+            sending them again
+        :param max_batch_bytes: the maximum size in bytes of the request sent
+            for a job group, on top of max_batch_size jobs
+        :param job_grouper: the pyramid_hypernova.grouping.JobGrouper splitting
+            jobs into job groups, or its name: 'count' (the default) to split
+            them in the order they were rendered, 'size' or 'render_time' to
+            balance job groups by the size of their props or the time their
+            components take to render
+        :param circuit_breaker: a
+            pyramid_hypernova.circuit_breaker.CircuitBreaker. While it's open,
+            job groups fall back to client-side rendering without being sent.
+        :param load_shedder: a pyramid_hypernova.shedding.LoadShedder. While
+            Hypernova is under pressure, jobs below the priority it sets fall
+            back to client-side rendering without being sent.
+        :param hedger: a pyramid_hypernova.hedging.Hedger. When
+            get_job_group_url returns several URLs, queries to the first one
+            that are slow to respond are sent again to the second one.
+        :param retry_policy: a pyramid_hypernova.retries.RetryPolicy. Queries
+            that fail transiently are sent again if it allows it, within the
+            deadline.
+        """
         self.get_job_group_url = get_job_group_url
         self.jobs = {}
+        self.results = {}
+        self.submitted = False
+        self.sent_identifiers = set()
+        self.queries = []
+        self.fallback_response = {}
+        self.cached_response = {}
+        self.cache_keys = {}
         self.plugin_controller = plugin_controller
         self.max_batch_size = max_batch_size
         self.json_encoder = json_encoder
         self.pyramid_request = pyramid_request
         self.display_error_stack = display_error_stack
-
-    def render(self, name, data, context=None):
+        self.send_on_render = send_on_render
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.deadline_at = None
+        self.transport = None if transport is None else get_transport(transport)
+        self.render_cache = render_cache
+        self.coalescer = coalescer
+        self.max_batch_bytes = max_batch_bytes
+        self.job_grouper = get_job_grouper(job_grouper)
+        self.circuit_breaker = circuit_breaker
+        self.load_shedder = load_shedder
+        self.hedger = hedger
+        self.retry_policy = retry_policy
+        # identifier -> priority, for jobs rendered with one
+        self.priorities = {}
+        # HypernovaQuery -> its token in load_shedder
+        self.load_tokens = {}
+        # encoded payload -> identifier of the first job sent with it
+        self.job_keys = {}
+        # identifier -> EncodedPayload, reused by the job's query
+        self.encoded_payloads = {}
+        # identifier of a sent job -> identifiers of the identical jobs that weren't
+        self.duplicates = {}
+        # identifier -> milliseconds Hypernova reported spending to render the job
+        self.render_durations = {}
+        # identifier -> (size of the HTML Hypernova rendered, seconds spent parsing its result)
+        self.parse_metrics = {}
+        self.deduplicated_job_count = 0
+        self.deduplicated_bytes = 0
+        self.deduplicated_render_ms = 0
+        # seconds spent encoding queries and waiting on their responses
+        self.encode_time = 0
+        self.wait_time = 0
+
+    def render(self, name, data, context=None, priority=None):
+        """Render a component, or queue it to be rendered by the next submit.
+
+        :param priority: how important it is to render the component on the
+            server, e.g. shedding.HIGH_PRIORITY for content above the fold or
+            shedding.LOW_PRIORITY for content below it. Defaults to
+            shedding.NORMAL_PRIORITY. Under pressure, a load shedder falls back
+            to client-side rendering for jobs with the lowest priorities.
+        :rtype: RenderToken
+        """
         if context is None:  # pragma: no cover
             context = {}
 
@@ -79,6 +205,11 @@ class BatchRequest:
         data = self.plugin_controller.get_view_data(name, data, self.pyramid_request)
         job = Job(name, data, context)
         self.jobs[identifier] = job
+        if priority is not None:
+            self.priorities[identifier] = priority
+
+        if self.send_on_render:
+            self.flush()
 
         return RenderToken(identifier)
 
@@ -88,7 +219,9 @@ class BatchRequest:
         :rtype: Dict[str, JobResult]
         """
         response = {}
+        rendered = {}
         for identifier, result in response_json['results'].items():
+            started = time.perf_counter()
             job = self.jobs[identifier]
 
             error = None
@@ -105,6 +238,18 @@ class BatchRequest:
                 html = render_blank_markup(identifier, job, True, self.json_encoder)
 
             response[identifier] = JobResult(error=error, html=html, job=job)
+            if result.get('duration') is not None:
+                self.render_durations[identifier] = result['duration']
+                self.job_grouper.record_render_time(job.name, result['duration'])
+            if result['html'] and not error:
+                rendered[identifier] = response[identifier]
+            self.parse_metrics[identifier] = (
+                len(result['html'].encode('utf-8')) if result['html'] else 0,
+                time.perf_counter() - started,
+            )
+
+        if self.render_cache is not None:
+            self.render_cache.set_results(rendered, self.cache_keys)
         return response
 
     def process_responses(self, query, jobs):
@@ -119,9 +264,16 @@ class BatchRequest:
         """
 
         pyramid_response = {}
+        error = None
+        parse_time = 0
 
         try:
-            response_json = query.json()
+            started = time.perf_counter()
+            try:
+                response_json = query.json(timeout=self.get_remaining_time())
+            finally:
+                self.wait_time += time.perf_counter() - started
+
             if response_json['error']:
                 error = HypernovaError(
                     name=response_json['error']['name'],
@@ -129,12 +281,11 @@ class BatchRequest:
                     stack=response_json['error']['stack'],
                 )
 
-                pyramid_response = create_fallback_response(
-                    jobs, True, self.json_encoder, error, self.display_error_stack
-                )
-                self.plugin_controller.on_error(error, jobs, self.pyramid_request)
+                pyramid_response = self.create_error_response(jobs, error)
             else:
+                started = time.perf_counter()
                 pyramid_response = self._parse_response(response_json)
+                parse_time = time.perf_counter() - started
                 self.plugin_controller.on_success(pyramid_response, jobs, self.pyramid_request)
 
         except (HypernovaQueryError, ValueError) as e:
@@ -154,46 +305,397 @@ class BatchRequest:
                     str(e),
                     [line.rstrip('\n') for line in traceback.format_tb(exc_traceback)],
                 )
-            self.plugin_controller.on_error(error, jobs, self.pyramid_request)
-            pyramid_response = create_fallback_response(jobs, True, self.json_encoder, error, self.display_error_stack)
+            pyramid_response = self.create_error_response(jobs, error)
 
+        self.record_query_result(query, error is not None, self.on_circuit_state_change)
+        load_token = self.load_tokens.pop(query, None)
+        if load_token is not None:
+            if query.was_sent():
+                self.load_shedder.finish_query(load_token, query.network_time)
+            else:
+                self.load_shedder.cancel_query(load_token)
+        self.report_metrics(query, jobs, parse_time, error)
         return pyramid_response
 
-    def submit(self):
-        """Submit the Hypernova jobs as batches with a max size of self.max_batch_size.
+    def record_query_result(self, query, failed, on_circuit_state_change=None):
+        """Report whether a query failed, and how long it took, to what
+        tracks the health of Hypernova servers.
+
+        :type query: HypernovaQuery
+        :type failed: bool
+        :param on_circuit_state_change: optional callable called if the
+            circuit breaker changes state. Revalidation queries are recorded
+            from the render cache's thread, once their page may be done, so
+            plugins aren't told.
+        """
+        # Queries that weren't sent say nothing about Hypernova's health
+        if not query.was_sent():
+            return
+
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_result(query.url, failed, query.network_time, on_circuit_state_change)
+
+        # get_job_group_url may be an UpstreamPool (see pyramid_hypernova.upstreams)
+        record_result = getattr(self.get_job_group_url, 'record_result', None)
+        if record_result is not None:
+            record_result(query.url, failed, query.network_time)
 
+    def on_circuit_state_change(self, url, old_state, new_state):
+        self.plugin_controller.on_circuit_state_change(url, old_state, new_state, self.pyramid_request)
+
+    def report_metrics(self, query, jobs, parse_time, error):
+        """Report what querying Hypernova for a job group cost, in total and
+        for each component, to plugins' on_metrics.
+
+        :type query: HypernovaQuery
+        :type jobs: Dict[str, Job]
+        :param parse_time: seconds spent parsing the response
+        :type error: Optional[HypernovaError]
+        """
+        components = {}
+        for identifier, job in jobs.items():
+            # Jobs waiting on identical ones in flight weren't encoded
+            encoded_job = query.encoded_jobs.get(identifier, EncodedJob(0, 0))
+            html_bytes, job_parse_time = self.parse_metrics.get(identifier, (0, 0))
+            render_time = self.render_durations.get(identifier)
+
+            metrics = components.get(job.name) or ComponentMetrics(0, 0, query.network_time, 0, 0, 0, None)
+            if render_time is not None:
+                metrics = metrics._replace(render_time=(metrics.render_time or 0) + render_time / 1000)
+            components[job.name] = metrics._replace(
+                jobs=metrics.jobs + 1,
+                encode_time=metrics.encode_time + encoded_job.encode_time,
+                parse_time=metrics.parse_time + job_parse_time,
+                payload_bytes=metrics.payload_bytes + encoded_job.payload_bytes,
+                html_bytes=metrics.html_bytes + html_bytes,
+            )
+
+        self.plugin_controller.on_metrics(
+            JobGroupMetrics(
+                url=query.url,
+                encode_time=query.encode_time,
+                network_time=query.network_time,
+                parse_time=parse_time,
+                payload_bytes=len(query.job_bytes),
+                html_bytes=sum(metrics.html_bytes for metrics in components.values()),
+                error=error,
+                components=components,
+                retries=query.retry_count,
+            ),
+            self.pyramid_request,
+        )
+
+    def create_error_response(self, jobs, error):
+        """Create the response for jobs that Hypernova failed to render, and
+        report the error to plugins.
+
+        Jobs whose HTML is in the render cache, even past its ttl, are served
+        that stale HTML and rendered again in the background. Plugins are
+        told with a HypernovaStaleRenderError. Other jobs fall back to
+        client-side rendering.
+
+        :type jobs: Dict[str, Job]
+        :type error: HypernovaError
         :rtype: Dict[str, JobResult]
         """
-        self.jobs = self.plugin_controller.prepare_request(self.jobs, self.pyramid_request)
-        response = {}
+        stale_response = {}
+        if self.render_cache is not None:
+            cache_keys = {
+                identifier: self.cache_keys[identifier]
+                for identifier in jobs
+                if identifier in self.cache_keys
+            }
+            stale_response = self.render_cache.get_stale_results(jobs, cache_keys)
+
+        if stale_response:
+            stale_error = HypernovaError(
+                name=STALE_RENDER_ERROR_NAME,
+                message='Served stale HTML after {}: {}'.format(error.name, error.message),
+                stack=error.stack,
+            )
+            stale_jobs = {identifier: jobs[identifier] for identifier in stale_response}
+            stale_response = {
+                identifier: job_result._replace(error=stale_error)
+                for identifier, job_result in stale_response.items()
+            }
+            self.plugin_controller.on_error(stale_error, stale_jobs, self.pyramid_request)
+            # Hypernova isn't queried at all while the circuit breaker is open
+            if error != CIRCUIT_OPEN_ERROR:
+                self.render_cache.revalidate(
+                    stale_jobs,
+                    cache_keys,
+                    self.send_revalidation_query,
+                    self.record_query_result,
+                )
+
+        failed_jobs = {identifier: job for identifier, job in jobs.items() if identifier not in stale_response}
+        if failed_jobs:
+            self.plugin_controller.on_error(error, failed_jobs, self.pyramid_request)
 
-        if self.jobs and self.plugin_controller.should_send_request(self.jobs, self.pyramid_request):
-            self.plugin_controller.will_send_request(self.jobs, self.pyramid_request)
-            job_groups = create_job_groups(self.jobs, self.max_batch_size)
-            queries = []
+        return {
+            **create_fallback_response(failed_jobs, True, self.json_encoder, error, self.display_error_stack),
+            **stale_response,
+        }
 
-            # Fido is asynchronous and Python2.7 is bad at asynchronous, incurring 10-30ms of overhead
-            # when calling and immediately waiting on an HTTP request. If we only have one request to
-            # make, use synchronous Requests instead to save a little time.
-            synchronous = len(job_groups) == 1
+    def send_revalidation_query(self, job_group):
+        """Send a job group whose stale HTML was served to Hypernova again,
+        without waiting for the response.
+
+        :returns: the query, or None if the circuit breaker doesn't allow it
+        :rtype: Optional[HypernovaQuery]
+        """
+        batch_url, hedge_url = split_job_group_url(self.get_job_group_url(job_group, self.pyramid_request))
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request(
+            batch_url,
+            self.on_circuit_state_change,
+        ):
+            return None
+        request_headers = self.plugin_controller.transform_request_headers({}, self.pyramid_request)
+        query = self.create_query(
+            job_group,
+            batch_url,
+            self.choose_transport(batch_url, True),
+            request_headers,
+            hedge_url,
+        )
+        query.send()
+        return query
+
+    def get_remaining_time(self):
+        """
+        :returns: seconds left until the deadline, or None if there's no deadline
+        :rtype: Optional[float]
+        """
+        if self.deadline_at is None:
+            return None
+        return self.deadline_at - time.monotonic()
+
+    def choose_transport(self, url, concurrent):
+        """
+        :param url: the URL of the Hypernova server to query
+        :param concurrent: whether several queries will be waited on at once
+        :rtype: pyramid_hypernova.transports.BaseTransport
+        """
+        if self.transport is not None:
+            return self.transport
+
+        if url.startswith('unix://'):
+            return get_transport('unix')
+
+        # Fido is asynchronous and Python2.7 is bad at asynchronous, incurring 10-30ms of overhead
+        # when calling and immediately waiting on an HTTP request. If we only have one request to
+        # make, use synchronous Requests instead to save a little time.
+        return get_transport('fido' if concurrent else 'requests')
+
+    def create_query(self, job_group, url, transport, request_headers, hedge_url=None):
+        """
+        :param hedge_url: the URL to send hedged queries to, if any
+        :rtype: HypernovaQuery
+        """
+        return HypernovaQuery(
+            job_group,
+            url,
+            self.json_encoder,
+            transport,
+            request_headers,
+            timeout=self.timeout,
+            coalescer=self.coalescer,
+            hedge_url=hedge_url,
+            hedger=self.hedger,
+            retry_policy=self.retry_policy,
+            encoded_payloads=self.encoded_payloads,
+        )
+
+    def get_unsent_jobs(self):
+        """
+        :rtype: Dict[str, Job]
+        """
+        return {
+            identifier: job
+            for identifier, job in self.jobs.items()
+            if identifier not in self.sent_identifiers
+        }
+
+    def deduplicate_jobs(self, jobs):
+        """Keep a single job of each set of identical jobs (with the same name,
+        data and context), among these jobs and those already sent. The others
+        get the result of the job that's sent (see fan_out_duplicates).
+
+        :type jobs: Dict[str, Job]
+        :returns: the jobs to send
+        :rtype: Dict[str, Job]
+        """
+        distinct_jobs = {}
+        for identifier, job in jobs.items():
+            # Jobs are identical when they're encoded the same, which is also
+            # what's sent to Hypernova
+            encoded_payload = encode_job_payload(job, self.json_encoder)
+            self.encoded_payloads[identifier] = encoded_payload
+            sent_identifier = self.job_keys.setdefault(encoded_payload.payload, identifier)
+            if sent_identifier == identifier:
+                distinct_jobs[identifier] = job
+            else:
+                if identifier in self.priorities:
+                    # The job that's sent renders for its duplicates too
+                    self.priorities[sent_identifier] = max(
+                        self.priorities.get(sent_identifier, NORMAL_PRIORITY),
+                        self.priorities[identifier],
+                    )
+                self.duplicates.setdefault(sent_identifier, []).append(identifier)
+                self.deduplicated_job_count += 1
+                self.deduplicated_bytes += len('{{{}: {}}}'.format(
+                    self.json_encoder.encode(identifier),
+                    encoded_payload.payload,
+                ).encode('utf-8'))
+        return distinct_jobs
+
+    def fan_out_duplicates(self, response):
+        """Create the results of the jobs that weren't sent because they were
+        identical to others, from the results of those.
+
+        :type response: Dict[str, JobResult]
+        :rtype: Dict[str, JobResult]
+        """
+        results = {**self.results, **response}
+        duplicate_response = {}
+        for sent_identifier in [identifier for identifier in self.duplicates if identifier in results]:
+            result = results[sent_identifier]
+            for identifier in self.duplicates.pop(sent_identifier):
+                duplicate_response[identifier] = result._replace(
+                    html=result.html.replace(sent_identifier, identifier),
+                    job=self.jobs[identifier],
+                )
+                self.deduplicated_render_ms += self.render_durations.get(sent_identifier, 0)
+        return duplicate_response
+
+    def get_deduplication_stats(self):
+        """Get what this batch saved by sending identical jobs once.
+
+        :rtype: DeduplicationStats
+        """
+        return DeduplicationStats(
+            jobs=self.deduplicated_job_count,
+            bytes=self.deduplicated_bytes,
+            render_ms=self.deduplicated_render_ms,
+        )
+
+    def send_jobs(self, jobs, concurrent=None):
+        """Send jobs to Hypernova without waiting for them to be rendered.
+        The responses are processed by the next call to submit().
+
+        :type jobs: Dict[str, Job]
+        :param concurrent: whether the queries may be waited on along with
+            others (see choose_transport), defaults to whether the jobs are
+            split into more than one job group
+        """
+        jobs = self.plugin_controller.prepare_request(jobs, self.pyramid_request)
+        self.jobs = {
+            **{identifier: job for identifier, job in self.jobs.items() if identifier in self.sent_identifiers},
+            **jobs,
+        }
+        self.sent_identifiers.update(jobs)
+
+        if self.render_cache is not None and jobs:
+            cache_keys = self.render_cache.get_keys(jobs, self.json_encoder)
+            self.cache_keys.update(cache_keys)
+            cached_response = self.render_cache.get_results(jobs, cache_keys)
+            self.cached_response.update(cached_response)
+            jobs = {identifier: job for identifier, job in jobs.items() if identifier not in cached_response}
+
+        jobs = self.deduplicate_jobs(jobs)
+
+        if self.load_shedder is not None and jobs:
+            jobs, shed_jobs = self.load_shedder.shed_jobs(jobs, self.priorities)
+            self.fallback_response.update(create_fallback_response(
+                shed_jobs,
+                throw_client_error=False,  # Hypernova is fine, but too busy to render these jobs
+                json_encoder=self.json_encoder,
+            ))
+
+        if jobs and self.plugin_controller.should_send_request(jobs, self.pyramid_request):
+            self.plugin_controller.will_send_request(jobs, self.pyramid_request)
+            job_groups = self.job_grouper.group_jobs(
+                jobs,
+                self.max_batch_size,
+                self.max_batch_bytes,
+                self.json_encoder,
+            )
+            if self.deadline is not None and self.deadline_at is None:
+                self.deadline_at = time.monotonic() + self.deadline
+
+            if concurrent is None:
+                concurrent = len(job_groups) > 1
 
             for job_group in job_groups:
-                batch_url = self.get_job_group_url(job_group, self.pyramid_request)
+                batch_url, hedge_url = split_job_group_url(self.get_job_group_url(job_group, self.pyramid_request))
+                if self.circuit_breaker is not None and not self.circuit_breaker.allow_request(
+                    batch_url,
+                    self.on_circuit_state_change,
+                ):
+                    self.fallback_response.update(self.create_error_response(job_group, CIRCUIT_OPEN_ERROR))
+                    continue
+
                 request_headers = self.plugin_controller.transform_request_headers({}, self.pyramid_request)
-                query = HypernovaQuery(job_group, batch_url, self.json_encoder, synchronous, request_headers)
+                transport = self.choose_transport(batch_url, concurrent)
+                query = self.create_query(job_group, batch_url, transport, request_headers, hedge_url)
                 query.send()
-                queries.append((job_group, query))
-
-            for job_group, query in queries:
-                response.update(self.process_responses(query, job_group))
+                self.encode_time += query.encode_time
+                if self.load_shedder is not None and query.response is not None:
+                    self.load_tokens[query] = self.load_shedder.start_query()
+                self.queries.append((job_group, query))
 
         else:
             # fall back to client-side rendering
-            response.update(create_fallback_response(
-                self.jobs,
+            self.fallback_response.update(create_fallback_response(
+                jobs,
                 throw_client_error=False,  # client-side rendering was intentional; don't throw an error
                 json_encoder=self.json_encoder
             ))
 
+    def flush(self):
+        """Send the jobs rendered since the last flush to Hypernova, without
+        waiting for them to be rendered.
+
+        Call this at a flush point in a streamed template (e.g. after the
+        <head>) so that server-side rendering happens while the rest of the
+        page is being rendered and sent.
+        """
+        unsent_jobs = self.get_unsent_jobs()
+        if unsent_jobs:
+            # Later jobs may be sent before these are waited on, and a
+            # synchronous query is only sent once its response is needed.
+            self.send_jobs(unsent_jobs, concurrent=True)
+
+    def submit(self):
+        """Submit the Hypernova jobs as batches with a max size of self.max_batch_size.
+
+        Jobs whose HTML is in the render cache aren't sent to Hypernova, and
+        jobs identical to others (with the same name, data and context) are
+        only sent once. Their results share its HTML, and only the job that was
+        sent is seen by on_error and on_success.
+
+        Results are memoized, so calling this again (e.g. once per chunk of a
+        streamed response) only sends jobs rendered since the previous submit,
+        and plugin hooks only see those new jobs and their results. Jobs that
+        were already sent by flush() are waited on rather than sent again.
+
+        :rtype: Dict[str, JobResult]
+        """
+        unsent_jobs = self.get_unsent_jobs()
+        if unsent_jobs or not (self.submitted or self.sent_identifiers):
+            self.send_jobs(unsent_jobs)
+        elif not (self.queries or self.fallback_response or self.cached_response):
+            return dict(self.results)
+        self.submitted = True
+
+        response, self.fallback_response = self.fallback_response, {}
+        response.update(self.cached_response)
+        self.cached_response = {}
+        queries, self.queries = self.queries, []
+        for job_group, query in queries:
+            response.update(self.process_responses(query, job_group))
+        response.update(self.fan_out_duplicates(response))
+
         response = self.plugin_controller.after_response(response, self.pyramid_request)
-        return response
+        self.results.update(response)
+        return dict(self.results)
@@ -0,0 +1,510 @@
+"""Caching of the HTML Hypernova renders for components.
+
+A component's HTML can be cached when it only depends on the component's name,
+data and context, e.g. a header or a static marketing block. Cached HTML is
+looked up by a hash of the job, so pages rendering a component with the same
+props share it.
+"""
+import hashlib
+import json
+import math
+import socket
+import threading
+import time
+import zlib
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid_hypernova.process import ProcessLocal
+from pyramid_hypernova.session import DEFAULT_POOL_SIZE
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.types import JobResult
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_MEMCACHED_TIMEOUT = 0.05
+DEFAULT_REVALIDATE_TIMEOUT = 10
+DEFAULT_REVALIDATE_INTERVAL = 5
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'errors', 'stale_hits'], defaults=[0, 0])
+
+# The HTML rendered for a job, the identifier it was rendered with, which
+# Hypernova embeds in the HTML (as data-hypernova-id), and the time until
+# which it's fresh (or None if it never goes stale)
+CachedRender = namedtuple('CachedRender', ['identifier', 'html', 'fresh_until'], defaults=[None])
+
+
+def get_job_key(job, json_encoder):
+    """Get a stable hash of a job, which is the same for every job with the
+    same name, data and context.
+
+    :type job: Job
+    :param json_encoder: the JSON encoder whose `default` method encodes
+        objects that json can't
+    :rtype: str
+    """
+    payload = {'name': job.name, 'data': job.data, 'context': job.context}
+    try:
+        encoded_job = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=json_encoder.default)
+    except TypeError:
+        # Keys that can't be sorted, e.g. a mix of ints and strings. Such
+        # jobs are only the same if their keys are in the same order.
+        encoded_job = json_encoder.encode(payload)
+    return hashlib.sha256(encoded_job.encode('utf-8')).hexdigest()
+
+
+class CacheError(Exception):
+    """Raised by cache backends when the cache can't be reached."""
+
+
+class LRUCacheBackend:
+    """Keeps cached renders in this process's memory, evicting the least
+    recently used ones once there are more than max_size.
+
+    A cache backend has two methods:
+
+    * get_many(keys), which returns a dict of the cached values of the keys
+      that are in the cache
+    * set_many(values, ttl), which caches a dict of values for ttl seconds
+
+    Both raise a CacheError if the cache can't be reached.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # key -> (expiry time, value), least recently used first
+        self.entries = OrderedDict()
+
+    def get_many(self, keys):
+        """
+        :type keys: Iterable[str]
+        :rtype: Dict[str, CachedRender]
+        """
+        now = time.monotonic()
+        values = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+
+                expires_at, value = entry
+                if expires_at <= now:
+                    del self.entries[key]
+                    continue
+
+                self.entries.move_to_end(key)
+                values[key] = value
+        return values
+
+    def set_many(self, values, ttl):
+        """
+        :type values: Dict[str, CachedRender]
+        :param ttl: seconds to cache the values for
+        """
+        expires_at = time.monotonic() + ttl
+        with self.lock:
+            for key, value in values.items():
+                self.entries[key] = (expires_at, value)
+                self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class MemcachedConnection:
+
+    def __init__(self, address, timeout):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class MemcachedCacheBackend:
+    """Keeps cached renders in memcached (or anything speaking its text
+    protocol, such as mcrouter or twemproxy), so that they're shared by every
+    process. A batch's jobs are all looked up in a single multi-get, and
+    rendered HTML is stored compressed with zlib.
+
+    :param address: the (host, port) of the memcached server
+    :param timeout: seconds to wait for memcached before giving up on the
+        cache
+    :param key_prefix: prefixed to the cache keys
+    :param pool_size: the maximum number of idle connections kept open
+    """
+
+    # set in the flags of compressed values
+    FLAG_COMPRESSED = 1
+
+    def __init__(
+        self,
+        address,
+        timeout=DEFAULT_MEMCACHED_TIMEOUT,
+        key_prefix='hypernova:',
+        pool_size=DEFAULT_POOL_SIZE,
+    ):
+        self.address = address
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        # Sockets must not be shared with a forked process
+        self.idle_connections = ProcessLocal(list)
+
+    def get_connection(self):
+        """
+        :rtype: MemcachedConnection
+        """
+        idle_connections = self.idle_connections.get()
+        with self.lock:
+            if idle_connections:
+                return idle_connections.pop()
+        return MemcachedConnection(self.address, self.timeout)
+
+    def release_connection(self, connection):
+        idle_connections = self.idle_connections.get()
+        with self.lock:
+            if len(idle_connections) < self.pool_size:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def run(self, command):
+        """Send a command to memcached on a pooled connection.
+
+        :param command: a callable taking the connection and returning the
+            command's result
+        """
+        try:
+            connection = self.get_connection()
+        except OSError as e:
+            raise CacheError(e)
+
+        # The connection may be left in the middle of a response, so it can't
+        # be reused after an error
+        try:
+            result = command(connection)
+        except CacheError:
+            connection.close()
+            raise
+        except (OSError, ValueError, zlib.error) as e:
+            connection.close()
+            raise CacheError(e)
+
+        self.release_connection(connection)
+        return result
+
+    def encode_value(self, value):
+        """
+        :type value: CachedRender
+        :returns: the value's flags and data
+        """
+        return self.FLAG_COMPRESSED, zlib.compress(json.dumps(value).encode('utf-8'))
+
+    def decode_value(self, flags, data):
+        """
+        :rtype: CachedRender
+        """
+        if flags & self.FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        return CachedRender(*json.loads(data))
+
+    def get_many(self, keys):
+        """
+        :type keys: Iterable[str]
+        :rtype: Dict[str, CachedRender]
+        """
+        keys = {(self.key_prefix + key).encode('utf-8'): key for key in keys}
+        if not keys:
+            return {}
+
+        def get(connection):
+            connection.sock.sendall(b'get ' + b' '.join(keys) + b'\r\n')
+
+            values = {}
+            while True:
+                line = connection.file.readline()
+                if line == b'END\r\n':
+                    return values
+
+                parts = line.split()
+                if len(parts) < 4 or parts[0] != b'VALUE':
+                    raise CacheError('Unexpected response from memcached: {!r}'.format(line))
+
+                length = int(parts[3])
+                data = connection.file.read(length + 2)
+                if len(data) != length + 2:
+                    raise CacheError('Connection to memcached closed')
+                values[keys[parts[1]]] = self.decode_value(int(parts[2]), data[:-2])
+
+        return self.run(get)
+
+    def set_many(self, values, ttl):
+        """
+        :type values: Dict[str, CachedRender]
+        :param ttl: seconds to cache the values for
+        """
+        commands = []
+        for key, value in values.items():
+            flags, data = self.encode_value(value)
+            commands.append('set {}{} {} {} {} noreply\r\n'.format(
+                self.key_prefix,
+                key,
+                flags,
+                max(1, math.ceil(ttl)),
+                len(data),
+            ).encode('utf-8'))
+            commands.append(data + b'\r\n')
+
+        # noreply: memcached doesn't answer, so this doesn't wait on it
+        self.run(lambda connection: connection.sock.sendall(b''.join(commands)))
+
+
+class RenderCache:
+    """Caches the HTML rendered by Hypernova for the components opted into it.
+
+    A single RenderCache is meant to be shared by every page rendered in the
+    process, by passing it as the `pyramid_hypernova.render_cache` setting.
+
+    :param components: the names of the components to cache, or a callable
+        taking a Job and returning whether it can be cached
+    :param ttl: seconds to cache rendered HTML for
+    :param backend: where to cache rendered HTML, by default an
+        LRUCacheBackend in this process's memory. If it can't be reached, jobs
+        are sent to Hypernova as if they weren't cached.
+    :param stale_ttl: seconds to keep HTML for after its ttl, to be served if
+        Hypernova fails to render the component again (stale-if-error)
+    :param revalidate_timeout: seconds to wait on Hypernova when re-rendering
+        stale HTML in the background
+    :param revalidate_interval: seconds between attempts to re-render the
+        same stale HTML, so that pages served stale HTML while Hypernova is
+        failing don't add to its load
+    """
+
+    def __init__(
+        self,
+        components,
+        ttl=DEFAULT_TTL,
+        backend=None,
+        stale_ttl=0,
+        revalidate_timeout=DEFAULT_REVALIDATE_TIMEOUT,
+        revalidate_interval=DEFAULT_REVALIDATE_INTERVAL,
+    ):
+        self.components = components
+        self.ttl = ttl
+        self.backend = LRUCacheBackend() if backend is None else backend
+        self.stale_ttl = stale_ttl
+        self.revalidate_timeout = revalidate_timeout
+        self.revalidate_interval = revalidate_interval
+        self.stats_lock = threading.Lock()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.error_count = 0
+        self.stale_hit_count = 0
+        self.revalidate_lock = threading.Lock()
+        self.revalidating_keys = set()
+        # key -> time.monotonic() of its latest revalidation attempt
+        self.revalidated_at = {}
+        self.executor = ProcessLocal(self.create_executor)
+
+    def should_cache(self, job):
+        """
+        :type job: Job
+        :rtype: bool
+        """
+        if callable(self.components):
+            return self.components(job)
+        return job.name in self.components
+
+    def get_keys(self, jobs, json_encoder):
+        """Get the cache keys of the jobs that can be cached.
+
+        :type jobs: Dict[str, Job]
+        :rtype: Dict[str, str]
+        """
+        return {
+            identifier: get_job_key(job, json_encoder)
+            for identifier, job in jobs.items()
+            if self.should_cache(job)
+        }
+
+    def get_cached_renders(self, keys):
+        """
+        :type keys: Dict[str, str]
+        :rtype: Dict[str, CachedRender]
+        """
+        try:
+            return self.backend.get_many(set(keys.values()))
+        except CacheError:
+            # Render the jobs rather than failing the page
+            with self.stats_lock:
+                self.error_count += 1
+            return {}
+
+    def create_results(self, jobs, keys, cached_renders):
+        """
+        :rtype: Dict[str, JobResult]
+        """
+        results = {}
+        for identifier, key in keys.items():
+            cached_render = cached_renders.get(key)
+            if cached_render is not None:
+                results[identifier] = JobResult(
+                    error=None,
+                    html=cached_render.html.replace(cached_render.identifier, identifier),
+                    job=jobs[identifier],
+                )
+        return results
+
+    def get_results(self, jobs, keys):
+        """Get the results of the jobs whose HTML is cached, as if they had
+        been rendered by Hypernova.
+
+        :type jobs: Dict[str, Job]
+        :param keys: the cache keys of the jobs to look up (see get_keys)
+        :type keys: Dict[str, str]
+        :rtype: Dict[str, JobResult]
+        """
+        if not keys:
+            return {}
+
+        now = time.time()
+        cached_renders = {
+            key: cached_render
+            for key, cached_render in self.get_cached_renders(keys).items()
+            if cached_render.fresh_until is None or cached_render.fresh_until > now
+        }
+        results = self.create_results(jobs, keys, cached_renders)
+
+        with self.stats_lock:
+            self.hit_count += len(results)
+            self.miss_count += len(keys) - len(results)
+        return results
+
+    def get_stale_results(self, jobs, keys):
+        """Get the results of the jobs whose HTML was cached, even if it's
+        past its ttl. Only used when Hypernova fails to render the jobs.
+
+        :type jobs: Dict[str, Job]
+        :type keys: Dict[str, str]
+        :rtype: Dict[str, JobResult]
+        """
+        if not (keys and self.stale_ttl):
+            return {}
+
+        results = self.create_results(jobs, keys, self.get_cached_renders(keys))
+        with self.stats_lock:
+            self.stale_hit_count += len(results)
+        return results
+
+    def set_results(self, results, keys):
+        """Cache the HTML of jobs rendered by Hypernova.
+
+        :type results: Dict[str, JobResult]
+        :param keys: the cache keys of the jobs (see get_keys). Results
+            without one aren't cached.
+        :type keys: Dict[str, str]
+        """
+        fresh_until = time.time() + self.ttl
+        cached_renders = {
+            keys[identifier]: CachedRender(identifier, result.html, fresh_until)
+            for identifier, result in results.items()
+            if identifier in keys
+        }
+        if cached_renders:
+            try:
+                self.backend.set_many(cached_renders, self.ttl + self.stale_ttl)
+            except CacheError:
+                with self.stats_lock:
+                    self.error_count += 1
+
+    def create_executor(self):
+        with self.revalidate_lock:
+            # Revalidations in flight in the parent process never finish here
+            self.revalidating_keys = set()
+            self.revalidated_at = {}
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix='pyramid-hypernova-cache')
+
+    def get_executor(self):
+        return self.executor.get()
+
+    def revalidate(self, jobs, keys, send_query, record_result=None):
+        """Render stale jobs again in the background, and cache their HTML if
+        Hypernova renders them. Jobs that are already being rendered again,
+        or were less than revalidate_interval seconds ago, aren't sent.
+
+        :type jobs: Dict[str, Job]
+        :type keys: Dict[str, str]
+        :param send_query: a callable taking a job group, sending it to
+            Hypernova and returning the HypernovaQuery, or None if it wasn't
+            sent (e.g. the circuit breaker is open)
+        :param record_result: optional callable called with the query and
+            whether it failed, once it's been waited on
+        """
+        executor = self.get_executor()
+        now = time.monotonic()
+        with self.revalidate_lock:
+            self.revalidated_at = {
+                key: revalidated_at
+                for key, revalidated_at in self.revalidated_at.items()
+                if now - revalidated_at < self.revalidate_interval
+            }
+            keys = {
+                identifier: key
+                for identifier, key in keys.items()
+                if key not in self.revalidating_keys and key not in self.revalidated_at
+            }
+            self.revalidating_keys.update(keys.values())
+            self.revalidated_at.update((key, now) for key in keys.values())
+        if not keys:
+            return
+
+        query = send_query({identifier: jobs[identifier] for identifier in keys})
+        if query is None:
+            self.finish_revalidating(keys)
+            return
+        executor.submit(self.wait_for_revalidation, query, keys, record_result)
+
+    def wait_for_revalidation(self, query, keys, record_result=None):
+        failed = True
+        try:
+            response_json = query.json(timeout=self.revalidate_timeout)
+            failed = bool(response_json['error'])
+            if not failed:
+                self.set_results(
+                    {
+                        identifier: JobResult(error=None, html=result['html'], job=None)
+                        for identifier, result in response_json['results'].items()
+                        if result['html'] and not result['error']
+                    },
+                    keys,
+                )
+        except (HypernovaQueryError, ValueError):
+            # The stale HTML will be served until the next attempt
+            pass
+        finally:
+            if record_result is not None:
+                record_result(query, failed)
+            self.finish_revalidating(keys)
+
+    def finish_revalidating(self, keys):
+        with self.revalidate_lock:
+            self.revalidating_keys.difference_update(keys.values())
+
+    def get_stats(self):
+        """
+        :rtype: CacheStats
+        """
+        with self.stats_lock:
+            return CacheStats(
+                hits=self.hit_count,
+                misses=self.miss_count,
+                errors=self.error_count,
+                stale_hits=self.stale_hit_count,
+            )
@@ -0,0 +1,177 @@
+"""A circuit breaker that stops querying Hypernova while it's failing.
+
+When Hypernova is down, every page still pays for a connection attempt or a
+timeout before falling back to client-side rendering. A CircuitBreaker shared
+by those pages tracks the outcome of the latest queries. Once too many of them
+failed or were slow, the circuit opens: job groups fall back to client-side
+rendering without being sent. After open_timeout seconds, a single query is
+sent as a probe (the circuit is half-open), which closes the circuit if it
+succeeds in time, or opens it again otherwise.
+"""
+import threading
+import time
+from collections import deque
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_ERROR_RATE_THRESHOLD = 0.5
+DEFAULT_SLOW_RATE_THRESHOLD = 0.5
+DEFAULT_WINDOW_SIZE = 20
+DEFAULT_MINIMUM_QUERIES = 10
+DEFAULT_OPEN_TIMEOUT = 30
+
+
+class Circuit:
+    """The state of the circuit of a Hypernova server, or of every server if
+    the breaker isn't per URL.
+    """
+
+    def __init__(self, window_size):
+        self.state = CLOSED
+        # (failed, slow) outcome of each of the latest queries
+        self.outcomes = deque(maxlen=window_size)
+        self.opened_at = None
+        self.probe_sent_at = None
+
+    def open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.probe_sent_at = None
+        self.outcomes.clear()
+
+    def close(self):
+        self.state = CLOSED
+        self.opened_at = None
+        self.probe_sent_at = None
+
+
+class CircuitBreaker:
+    """Skips querying Hypernova while too many of the latest queries failed
+    or were slow.
+
+    A single CircuitBreaker is meant to be shared by every page rendered in
+    the process, by passing it as the `pyramid_hypernova.circuit_breaker`
+    setting.
+
+    :param error_rate_threshold: the share of failed queries, out of the
+        latest window_size, at which the circuit opens
+    :param slow_query_time: seconds after which a successful query counts as
+        slow, or None to ignore latency
+    :param slow_rate_threshold: the share of slow queries, out of the latest
+        window_size, at which the circuit opens
+    :param window_size: the number of latest queries the rates are computed on
+    :param minimum_queries: the number of queries needed to open the circuit,
+        so that it isn't opened by a handful of failures after a restart
+    :param open_timeout: seconds the circuit stays open before a probe is
+        sent. A probe that isn't waited on within that time is sent again.
+    :param per_url: True to keep a circuit for each Hypernova URL, so that a
+        failing server doesn't stop queries to the others
+    """
+
+    def __init__(
+        self,
+        error_rate_threshold=DEFAULT_ERROR_RATE_THRESHOLD,
+        slow_query_time=None,
+        slow_rate_threshold=DEFAULT_SLOW_RATE_THRESHOLD,
+        window_size=DEFAULT_WINDOW_SIZE,
+        minimum_queries=DEFAULT_MINIMUM_QUERIES,
+        open_timeout=DEFAULT_OPEN_TIMEOUT,
+        per_url=False,
+    ):
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_query_time = slow_query_time
+        self.slow_rate_threshold = slow_rate_threshold
+        self.window_size = window_size
+        self.minimum_queries = minimum_queries
+        self.open_timeout = open_timeout
+        self.per_url = per_url
+        self.lock = threading.Lock()
+        # URL, or None if the breaker isn't per URL -> Circuit
+        self.circuits = {}
+
+    def get_circuit(self, url):
+        key = url if self.per_url else None
+        if key not in self.circuits:
+            self.circuits[key] = Circuit(self.window_size)
+        return self.circuits[key]
+
+    def get_state(self, url=None):
+        """
+        :param url: the Hypernova URL, if the breaker is per URL
+        :returns: CLOSED, OPEN or HALF_OPEN
+        :rtype: str
+        """
+        with self.lock:
+            return self.get_circuit(url).state
+
+    def allow_request(self, url, on_state_change=None):
+        """Whether a query may be sent to the Hypernova server at url. Once
+        the circuit has been open for open_timeout seconds, the next query is
+        let through as a probe.
+
+        :param on_state_change: optional callable called with the URL, the
+            previous state and the new state if the circuit changes state
+        :rtype: bool
+        """
+        now = time.monotonic()
+        with self.lock:
+            circuit = self.get_circuit(url)
+            previous_state = circuit.state
+            if circuit.state == CLOSED:
+                return True
+
+            if circuit.state == OPEN:
+                allowed = now - circuit.opened_at >= self.open_timeout
+                if allowed:
+                    circuit.state = HALF_OPEN
+            else:
+                allowed = now - circuit.probe_sent_at >= self.open_timeout
+
+            if allowed:
+                circuit.probe_sent_at = now
+            state = circuit.state
+
+        if on_state_change is not None and state != previous_state:
+            on_state_change(url, previous_state, state)
+        return allowed
+
+    def record_result(self, url, failed, duration, on_state_change=None):
+        """Record the outcome of a query sent to the Hypernova server at url.
+
+        :param failed: whether the query failed (e.g. it timed out, or
+            Hypernova returned an error for the whole job group)
+        :param duration: seconds spent waiting on the query
+        :param on_state_change: optional callable called with the URL, the
+            previous state and the new state if the circuit changes state
+        """
+        slow = self.slow_query_time is not None and duration >= self.slow_query_time
+        now = time.monotonic()
+        with self.lock:
+            circuit = self.get_circuit(url)
+            previous_state = circuit.state
+            if circuit.state == HALF_OPEN:
+                if failed or slow:
+                    circuit.open(now)
+                else:
+                    circuit.close()
+            elif circuit.state == CLOSED:
+                circuit.outcomes.append((failed, slow))
+                if self.should_open(circuit.outcomes):
+                    circuit.open(now)
+            # Queries sent before the circuit opened don't change its state
+            state = circuit.state
+
+        if on_state_change is not None and state != previous_state:
+            on_state_change(url, previous_state, state)
+
+    def should_open(self, outcomes):
+        if len(outcomes) < self.minimum_queries:
+            return False
+        failed_count = sum(1 for failed, __ in outcomes if failed)
+        slow_count = sum(1 for __, slow in outcomes if slow)
+        return (
+            failed_count / len(outcomes) >= self.error_rate_threshold or
+            slow_count / len(outcomes) >= self.slow_rate_threshold
+        )
@@ -0,0 +1,170 @@
+"""Coalescing of identical jobs sent to Hypernova at the same time.
+
+Under bursty traffic, the pages a process renders at once may send the same
+component with the same props to Hypernova at the same moment. A
+RenderCoalescer shared by those pages sends such a job once: identical jobs
+sent while it's in flight wait for its response instead, and share its HTML.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures import InvalidStateError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from pyramid_hypernova.transports import ErrorData
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError
+from pyramid_hypernova.transports import min_timeout
+
+DEFAULT_MAX_WAIT = 10
+
+CoalescerStats = namedtuple('CoalescerStats', ['sent', 'coalesced'])
+
+
+def create_error_result(error):
+    """Create a job's result in a Hypernova response for an error.
+
+    :type error: Exception
+    :rtype: Dict
+    """
+    error_data = getattr(error, 'error_data', None)
+    if isinstance(error_data, ErrorData):
+        name, message, stack = error_data
+    else:
+        name, message, stack = type(error).__name__, str(error), []
+    return {'error': {'name': name, 'message': message, 'stack': stack}, 'html': None}
+
+
+class InFlightRender:
+    """A job sent to Hypernova, whose result identical jobs wait on.
+
+    :param key: the job's key (see pyramid_hypernova.cache.get_job_key)
+    :param identifier: the identifier the job was sent with, which Hypernova
+        embeds in its HTML (as data-hypernova-id)
+    :param expires_at: the time.monotonic() after which identical jobs stop
+        waiting on it
+    """
+
+    def __init__(self, key, identifier, expires_at):
+        self.key = key
+        self.identifier = identifier
+        self.expires_at = expires_at
+        # resolved with the job's result in Hypernova's response
+        self.future = Future()
+
+    def finish(self, result):
+        try:
+            self.future.set_result(result)
+        except InvalidStateError:
+            # The first result wins, e.g. if the query times out after its
+            # response was received
+            pass
+
+    def wait(self, identifier, timeout=None):
+        """Wait for the job's result.
+
+        :param identifier: the identifier of the identical job waiting on it,
+            which its HTML is rewritten with
+        :param timeout: maximum number of seconds to wait
+        :returns: the job's result in Hypernova's response, or an error result
+            if it wasn't received in time
+        :rtype: Dict
+        """
+        timeout = max(min_timeout(timeout, self.expires_at - time.monotonic()), 0)
+        try:
+            result = self.future.result(timeout)
+        except FutureTimeoutError:
+            return create_error_result(HypernovaQueryTimeoutError(
+                'Timed out waiting on an identical job sent to Hypernova',
+            ))
+
+        if result['html']:
+            result = dict(result, html=result['html'].replace(self.identifier, identifier))
+        return result
+
+
+class RenderCoalescer:
+    """Sends identical jobs to Hypernova once, while they're in flight.
+
+    A single RenderCoalescer is meant to be shared by every page rendered in
+    the process, by passing it as the `pyramid_hypernova.coalescer` setting.
+
+    :param max_wait: seconds an in-flight job is waited on by identical jobs.
+        After that, they're sent to Hypernova again, e.g. in case the page
+        that sent it never waits for its response.
+    """
+
+    def __init__(self, max_wait=DEFAULT_MAX_WAIT):
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        # job key -> InFlightRender
+        self.in_flight = {}
+        self.pid = None
+        self.sent_count = 0
+        self.coalesced_count = 0
+
+    def start(self, keys, share=True):
+        """Start sending jobs, unless identical jobs are already in flight.
+
+        :param keys: the keys of the jobs being sent, by identifier
+        :type keys: Dict[str, str]
+        :param share: False not to let identical jobs wait on the jobs sent,
+            e.g. because they're only sent once their page waits on them
+        :returns: the in-flight renders of the jobs to send, and of the
+            identical jobs the others must wait on, by identifier
+        :rtype: Tuple[Dict[str, InFlightRender], Dict[str, InFlightRender]]
+        """
+        now = time.monotonic()
+        started = {}
+        joined = {}
+        with self.lock:
+            # A forked process would wait on renders it didn't send
+            if self.pid != os.getpid():
+                self.in_flight = {}
+                self.pid = os.getpid()
+
+            for identifier, key in keys.items():
+                in_flight_render = self.in_flight.get(key)
+                if in_flight_render is not None and in_flight_render.expires_at > now:
+                    joined[identifier] = in_flight_render
+                else:
+                    started[identifier] = InFlightRender(key, identifier, now + self.max_wait)
+                    if share:
+                        self.in_flight[key] = started[identifier]
+
+            self.sent_count += len(started)
+            self.coalesced_count += len(joined)
+        return started, joined
+
+    def finish(self, in_flight_renders, response_json=None, error=None):
+        """Hand the response to jobs sent by start() to the jobs waiting on
+        them.
+
+        :param in_flight_renders: the renders returned by start(), by identifier
+        :type in_flight_renders: Dict[str, InFlightRender]
+        :param response_json: Hypernova's response
+        :param error: the error raised instead of getting a response
+        """
+        with self.lock:
+            for in_flight_render in in_flight_renders.values():
+                if self.in_flight.get(in_flight_render.key) is in_flight_render:
+                    del self.in_flight[in_flight_render.key]
+
+        for identifier, in_flight_render in in_flight_renders.items():
+            if error is not None:
+                result = create_error_result(error)
+            elif response_json['error']:
+                result = {'error': response_json['error'], 'html': None}
+            else:
+                result = response_json['results'].get(identifier) or create_error_result(
+                    ValueError('Hypernova did not return a result for the job'),
+                )
+            in_flight_render.finish(result)
+
+    def get_stats(self):
+        """
+        :rtype: CoalescerStats
+        """
+        with self.lock:
+            return CoalescerStats(sent=self.sent_count, coalesced=self.coalesced_count)
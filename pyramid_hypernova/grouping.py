@@ -0,0 +1,237 @@
+"""Job groupers split a batch's jobs into the job groups sent to Hypernova.
+
+A page is only rendered once its slowest job group is, so groupers other than
+the default CountJobGrouper balance the groups by their estimated cost. They
+can be selected by name with the `pyramid_hypernova.job_grouper` setting.
+"""
+import heapq
+import math
+import threading
+
+from more_itertools import chunked
+
+from pyramid_hypernova.request import create_jobs_payload
+
+DEFAULT_RENDER_TIME_WEIGHT = 0.2
+
+
+def create_job_groups(jobs, max_batch_size):
+    job_groups = []
+
+    if max_batch_size and max_batch_size > 0:
+        for names in chunked(jobs, max_batch_size):
+            job_groups.append({
+                name: jobs[name]
+                for name in names
+            })
+    else:
+        job_groups.append(jobs)
+
+    return job_groups
+
+
+def get_job_sizes(jobs, json_encoder):
+    """Get the size of each job in the request sent to Hypernova.
+
+    :type jobs: Dict[str, Job]
+    :rtype: Dict[str, int]
+    """
+    return {
+        identifier: len(json_encoder.encode(create_jobs_payload({identifier: job})).encode('utf-8'))
+        for identifier, job in jobs.items()
+    }
+
+
+def has_room(job_group_size, job_group_bytes, job_size, max_batch_size, max_batch_bytes):
+    """Whether a job fits in a job group. Empty job groups fit any job, even
+    one larger than max_batch_bytes.
+
+    :rtype: bool
+    """
+    if job_group_size == 0:
+        return True
+    if max_batch_size and max_batch_size > 0 and job_group_size >= max_batch_size:
+        return False
+    return max_batch_bytes is None or job_group_bytes + job_size <= max_batch_bytes
+
+
+def balance_job_groups(jobs, costs, sizes, max_batch_size, max_batch_bytes):
+    """Split jobs into as many job groups as fixed-count chunking would, or
+    more if needed to stay under max_batch_bytes, balancing their total cost.
+
+    Jobs are assigned from the costliest to the cheapest, each to the
+    cheapest job group it fits in.
+
+    :type jobs: Dict[str, Job]
+    :param costs: the estimated cost of each job, by identifier
+    :param sizes: the size of each job in bytes, by identifier
+    :rtype: List[Dict[str, Job]]
+    """
+    group_count = 1
+    if max_batch_size and max_batch_size > 0:
+        group_count = max(group_count, math.ceil(len(jobs) / max_batch_size))
+    if max_batch_bytes:
+        group_count = max(group_count, math.ceil(sum(sizes.values()) / max_batch_bytes))
+
+    # (cost, index) of each job group, cheapest first
+    heap = [(0, index) for index in range(group_count)]
+    job_groups = [{} for __ in range(group_count)]
+    job_group_bytes = [0] * group_count
+
+    for identifier in sorted(jobs, key=lambda identifier: costs[identifier], reverse=True):
+        skipped = []
+        while heap:
+            cost, index = heapq.heappop(heap)
+            if has_room(len(job_groups[index]), job_group_bytes[index], sizes[identifier], max_batch_size,
+                        max_batch_bytes):
+                break
+            skipped.append((cost, index))
+        else:
+            # no job group has room left
+            cost, index = 0, len(job_groups)
+            job_groups.append({})
+            job_group_bytes.append(0)
+
+        job_groups[index][identifier] = jobs[identifier]
+        job_group_bytes[index] += sizes[identifier]
+        heapq.heappush(heap, (cost + costs[identifier], index))
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+
+    return [job_group for job_group in job_groups if job_group]
+
+
+class JobGrouper:
+    """The interface of a job grouper.
+
+    A job grouper is shared by every page rendered in the process, so it must
+    be thread-safe.
+    """
+
+    def group_jobs(self, jobs, max_batch_size, max_batch_bytes, json_encoder):
+        """Split jobs into the job groups to send to Hypernova.
+
+        :type jobs: Dict[str, Job]
+        :param max_batch_size: the maximum number of jobs in a job group, or
+            None for no maximum
+        :param max_batch_bytes: the maximum size of a job group's request in
+            bytes, or None for no maximum. A job larger than this is sent in a
+            job group of its own.
+        :param json_encoder: the JSON encoder the jobs are sent with
+        :rtype: List[Dict[str, Job]]
+        """
+        raise NotImplementedError
+
+    def record_render_time(self, name, duration):
+        """Called with the milliseconds Hypernova reported spending to render
+        a component.
+        """
+
+
+class CountJobGrouper(JobGrouper):
+    """Splits jobs into chunks of max_batch_size jobs, in the order they were
+    rendered. With a max_batch_bytes, a new chunk is also started when the
+    next job would take the current one past it.
+    """
+
+    def group_jobs(self, jobs, max_batch_size, max_batch_bytes, json_encoder):
+        if max_batch_bytes is None:
+            return create_job_groups(jobs, max_batch_size)
+
+        sizes = get_job_sizes(jobs, json_encoder)
+        job_groups = [{}]
+        job_group_bytes = 0
+        for identifier, job in jobs.items():
+            if not has_room(len(job_groups[-1]), job_group_bytes, sizes[identifier], max_batch_size,
+                            max_batch_bytes):
+                job_groups.append({})
+                job_group_bytes = 0
+            job_groups[-1][identifier] = job
+            job_group_bytes += sizes[identifier]
+        return job_groups
+
+
+class SizeJobGrouper(JobGrouper):
+    """Balances job groups by the size of their jobs' encoded props, for
+    components whose render time grows with their data.
+    """
+
+    def group_jobs(self, jobs, max_batch_size, max_batch_bytes, json_encoder):
+        sizes = get_job_sizes(jobs, json_encoder)
+        return balance_job_groups(jobs, sizes, sizes, max_batch_size, max_batch_bytes)
+
+
+class RenderTimeJobGrouper(JobGrouper):
+    """Balances job groups by the time Hypernova takes to render each
+    component, learned from the render times it reports as an exponentially
+    weighted moving average. Components that haven't been rendered yet are
+    assumed to take the average time of the others.
+
+    :param weight: the weight of each new render time in the average
+    """
+
+    def __init__(self, weight=DEFAULT_RENDER_TIME_WEIGHT):
+        self.weight = weight
+        self.lock = threading.Lock()
+        # component name -> average render time in milliseconds
+        self.render_times = {}
+
+    def get_render_times(self, jobs):
+        """Get the estimated render time of each job.
+
+        :type jobs: Dict[str, Job]
+        :rtype: Dict[str, float]
+        """
+        with self.lock:
+            render_times = dict(self.render_times)
+
+        default = sum(render_times.values()) / len(render_times) if render_times else 1
+        return {
+            identifier: render_times.get(job.name, default)
+            for identifier, job in jobs.items()
+        }
+
+    def group_jobs(self, jobs, max_batch_size, max_batch_bytes, json_encoder):
+        sizes = get_job_sizes(jobs, json_encoder) if max_batch_bytes else dict.fromkeys(jobs, 0)
+        return balance_job_groups(jobs, self.get_render_times(jobs), sizes, max_batch_size, max_batch_bytes)
+
+    def record_render_time(self, name, duration):
+        with self.lock:
+            average = self.render_times.get(name)
+            if average is None:
+                self.render_times[name] = duration
+            else:
+                self.render_times[name] = average + self.weight * (duration - average)
+
+
+_job_grouper_factories = {
+    'count': CountJobGrouper,
+    'size': SizeJobGrouper,
+    'render_time': RenderTimeJobGrouper,
+}
+_job_groupers = {}
+_job_groupers_lock = threading.Lock()
+
+
+def get_job_grouper(job_grouper):
+    """Get a job grouper by name: 'count', 'size' or 'render_time'. Anything
+    other than a name is assumed to already be a job grouper, and is returned
+    as is.
+
+    :rtype: JobGrouper
+    """
+    if not isinstance(job_grouper, str):
+        return job_grouper
+
+    with _job_groupers_lock:
+        if job_grouper not in _job_groupers:
+            try:
+                factory = _job_grouper_factories[job_grouper]
+            except KeyError:
+                raise ValueError('Unknown Hypernova job grouper {!r}, expected one of: {}'.format(
+                    job_grouper,
+                    ', '.join(sorted(_job_grouper_factories)),
+                ))
+            # Shared by the process, so that render times are learned across pages
+            _job_groupers[job_grouper] = factory()
+        return _job_groupers[job_grouper]
@@ -0,0 +1,246 @@
+"""Hedged queries to a second Hypernova server.
+
+A single slow Hypernova server dominates tail latency. When get_job_group_url
+returns a list of URLs, a Hedger sends a job group to the first one, and if it
+hasn't responded within a percentile of recent latencies, sends it again to
+the second one. Whichever responds first is used, and the other is cancelled.
+
+Hedging needs responses that are received in the background (with an
+`add_done_callback` method, see BaseTransport.send), e.g. those of the
+'thread_pool', 'unix', 'asyncio' or 'http2' transports. Other responses are
+never hedged.
+"""
+import threading
+import time
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+
+from pyramid_hypernova.process import TokenBucket
+from pyramid_hypernova.transports import DEADLINE_EXCEEDED_MESSAGE
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError
+
+DEFAULT_PERCENTILE = 95
+DEFAULT_WINDOW_SIZE = 100
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_MAX_HEDGE_RATE = 0.05
+DEFAULT_HEDGE_BURST = 10
+
+# The number of queries that could have been hedged, of hedges sent, and of
+# hedges that responded before the query they duplicated
+HedgeStats = namedtuple('HedgeStats', ['queries', 'hedges', 'wins'])
+
+
+class HedgedResponse:
+    """The response of a query that may be sent again to a second Hypernova
+    server, once its hedge time has passed without a response. The hedge is
+    sent by whichever thread waits on the response then.
+
+    :param response: the response of the query to the first server
+    :param send_hedge: a callable sending the query to the second server and
+        returning its response
+    :param hedge_at: the time.monotonic() at which to send the hedge
+    :type hedger: Hedger
+    """
+
+    def __init__(self, response, send_hedge, hedge_at, hedger):
+        self.send_hedge = send_hedge
+        self.hedge_at = hedge_at
+        self.hedger = hedger
+        self.lock = threading.Lock()
+        # resolved with the first response received, or the last error
+        self.future = Future()
+        self.responses = []
+        self.sent_at = []
+        self.pending_count = 0
+        self.hedged = False
+        # whether the future is (being) resolved
+        self.finished = False
+        self.add_response(response)
+
+    def add_response(self, response):
+        with self.lock:
+            finished = self.finished
+            if not finished:
+                self.responses.append(response)
+                self.sent_at.append(time.monotonic())
+                self.pending_count += 1
+                index = len(self.responses) - 1
+
+        if finished:
+            # The other query responded while this one was being sent
+            response.cancel()
+        else:
+            response.add_done_callback(lambda response: self.on_response(index, response))
+
+    def on_response(self, index, response):
+        try:
+            response_json = response.result(0)
+        except (HypernovaQueryError, ValueError) as e:
+            response_json, error = None, e
+        else:
+            error = None
+            self.hedger.record_latency(time.monotonic() - self.sent_at[index])
+
+        with self.lock:
+            self.pending_count -= 1
+            # Hedging is for slow servers, a query that failed isn't sent
+            # again, but the other one may still respond
+            if self.finished or (error is not None and self.pending_count > 0):
+                return
+            self.finished = True
+            losers = [other for other in self.responses if other is not response]
+
+        # Outside of the lock, as the future's callbacks may wait on this response
+        if error is None:
+            if index > 0:
+                self.hedger.record_win()
+            for loser in losers:
+                loser.cancel()
+            self.future.set_result(response_json)
+        else:
+            self.future.set_exception(error)
+
+    def hedge(self):
+        """Send the hedge, unless it was already sent, a response was
+        received, or the hedger's budget is spent.
+        """
+        with self.lock:
+            if self.hedged or self.hedge_at is None or self.finished:
+                return
+            self.hedged = True
+        if self.hedger.allow_hedge():
+            self.add_response(self.send_hedge())
+
+    def result(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.hedge_at is not None:
+            hedge_timeout = self.hedge_at - time.monotonic()
+            if deadline is not None:
+                hedge_timeout = min(hedge_timeout, deadline - time.monotonic())
+            wait([self.future], timeout=max(hedge_timeout, 0))
+            if deadline is None or time.monotonic() < deadline:
+                self.hedge()
+
+        try:
+            return self.future.result(None if deadline is None else max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            self.cancel()
+            raise HypernovaQueryTimeoutError(DEADLINE_EXCEEDED_MESSAGE)
+
+    def cancel(self):
+        with self.lock:
+            self.hedge_at = None
+            finished, self.finished = self.finished, True
+            responses = list(self.responses)
+        if not finished:
+            self.future.cancel()
+        for response in responses:
+            response.cancel()
+
+    def add_done_callback(self, fn):
+        """Call fn with this response once either query responded, or every
+        query failed, unless it's cancelled.
+        """
+        self.future.add_done_callback(lambda future: future.cancelled() or fn(self))
+
+
+class Hedger:
+    """Sends queries again to a second Hypernova server when the first one
+    hasn't responded within a percentile of the latencies of recent queries.
+
+    A single Hedger is meant to be shared by every page rendered in the
+    process, by passing it as the `pyramid_hypernova.hedger` setting.
+
+    :param percentile: the percentile of recent latencies after which a query
+        is hedged
+    :param window_size: the number of recent latencies the percentile is
+        computed on
+    :param min_samples: the number of latencies needed before hedging
+    :param max_hedge_rate: the maximum share of queries that are hedged, so
+        that hedging doesn't overload Hypernova when every server is slow
+    :param hedge_burst: the maximum number of hedges sent in a row when
+        queries haven't been hedged for a while
+    """
+
+    def __init__(
+        self,
+        percentile=DEFAULT_PERCENTILE,
+        window_size=DEFAULT_WINDOW_SIZE,
+        min_samples=DEFAULT_MIN_SAMPLES,
+        max_hedge_rate=DEFAULT_MAX_HEDGE_RATE,
+        hedge_burst=DEFAULT_HEDGE_BURST,
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedge_rate = max_hedge_rate
+        self.hedge_burst = hedge_burst
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window_size)
+        # hedges that can be sent, earned by each query
+        self.budget = TokenBucket(max_hedge_rate, hedge_burst)
+        self.query_count = 0
+        self.hedge_count = 0
+        self.win_count = 0
+
+    def get_hedge_delay(self):
+        """
+        :returns: seconds after which to hedge a query, or None if too few
+            latencies were recorded
+        :rtype: Optional[float]
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def record_win(self):
+        with self.lock:
+            self.win_count += 1
+
+    def allow_hedge(self):
+        """Spend a hedge from the budget, if there's one left.
+
+        :rtype: bool
+        """
+        if not self.budget.spend():
+            return False
+        with self.lock:
+            self.hedge_count += 1
+        return True
+
+    def hedge(self, response, send_hedge):
+        """Wrap a query's response to hedge it.
+
+        :param response: the response of the query to the first server
+        :param send_hedge: a callable sending the query to the second server
+            and returning its response
+        :returns: a HedgedResponse, or the response itself if it can't be
+            hedged
+        """
+        with self.lock:
+            self.query_count += 1
+        self.budget.earn()
+
+        if not hasattr(response, 'add_done_callback'):
+            return response
+
+        delay = self.get_hedge_delay()
+        hedge_at = None if delay is None else time.monotonic() + delay
+        return HedgedResponse(response, send_hedge, hedge_at, self)
+
+    def get_stats(self):
+        """
+        :rtype: HedgeStats
+        """
+        with self.lock:
+            return HedgeStats(queries=self.query_count, hedges=self.hedge_count, wins=self.win_count)
@@ -0,0 +1,163 @@
+"""An in-process aggregator of the metrics plugins receive in on_metrics.
+
+MetricsAggregator is a plugin keeping histograms of the cost of each job group
+and each component, which can be read with get_histograms() or exposed to
+Prometheus, e.g. from a /metrics view, with render_prometheus().
+"""
+import bisect
+import threading
+
+from pyramid_hypernova.plugins import BasePlugin
+
+DEFAULT_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DEFAULT_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# (metric name, field of JobGroupMetrics and ComponentMetrics, is a time)
+METRICS = (
+    ('encode_seconds', 'encode_time', True),
+    ('network_seconds', 'network_time', True),
+    ('parse_seconds', 'parse_time', True),
+    ('render_seconds', 'render_time', True),
+    ('payload_bytes', 'payload_bytes', False),
+    ('html_bytes', 'html_bytes', False),
+)
+
+
+class Histogram:
+    """Counts observed values in buckets.
+
+    :param buckets: the upper bounds of the buckets, in increasing order. Values
+        larger than the last one are only counted in the total.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_cumulative_counts(self):
+        """Get the number of values less than or equal to each bucket's upper
+        bound, as Prometheus expects.
+
+        :rtype: List[Tuple[float, int]]
+        """
+        cumulative_counts = []
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative_counts.append((bucket, total))
+        return cumulative_counts
+
+
+def format_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsAggregator(BasePlugin):
+    """A plugin aggregating the metrics of every job group queried by the
+    process into histograms, for job groups (`hypernova_job_group_*`) and by
+    component (`hypernova_component_*`, with a `component` label).
+
+    A single MetricsAggregator is meant to be shared by every page, by adding
+    it to the `pyramid_hypernova.plugins` setting.
+
+    :param time_buckets: the upper bounds of the buckets of times, in seconds
+    :param size_buckets: the upper bounds of the buckets of sizes, in bytes
+    """
+
+    def __init__(self, time_buckets=DEFAULT_TIME_BUCKETS, size_buckets=DEFAULT_SIZE_BUCKETS):
+        self.time_buckets = time_buckets
+        self.size_buckets = size_buckets
+        self.lock = threading.Lock()
+        # (metric name, component name or None for job groups) -> Histogram
+        self.histograms = {}
+        self.error_count = 0
+        self.retry_count = 0
+
+    def observe(self, metric_name, component, value, is_time):
+        key = (metric_name, component)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(self.time_buckets if is_time else self.size_buckets)
+        self.histograms[key].observe(value)
+
+    def on_metrics(self, metrics, request):
+        with self.lock:
+            if metrics.error is not None:
+                self.error_count += 1
+            self.retry_count += metrics.retries
+
+            for metric_name, field, is_time in METRICS:
+                # render times are only reported by component
+                if field != 'render_time':
+                    self.observe(metric_name, None, getattr(metrics, field), is_time)
+
+                for component, component_metrics in metrics.components.items():
+                    value = getattr(component_metrics, field)
+                    if value is not None:
+                        self.observe(metric_name, component, value, is_time)
+
+    def get_histograms(self):
+        """Get a copy of the histograms.
+
+        :returns: histograms by (metric name, component name), where the
+            component name is None for the histograms of job groups
+        :rtype: Dict[Tuple[str, Optional[str]], Histogram]
+        """
+        with self.lock:
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                histograms[key] = Histogram(histogram.buckets)
+                histograms[key].counts = list(histogram.counts)
+                histograms[key].count = histogram.count
+                histograms[key].sum = histogram.sum
+            return histograms
+
+    def render_prometheus(self):
+        """Render the histograms in Prometheus' text exposition format.
+
+        :rtype: str
+        """
+        histograms = self.get_histograms()
+        with self.lock:
+            error_count = self.error_count
+            retry_count = self.retry_count
+
+        lines = [
+            '# TYPE hypernova_job_group_errors_total counter',
+            f'hypernova_job_group_errors_total {error_count}',
+            '# TYPE hypernova_job_group_retries_total counter',
+            f'hypernova_job_group_retries_total {retry_count}',
+        ]
+        for scope in ('job_group', 'component'):
+            for metric_name, __, __ in METRICS:
+                name = f'hypernova_{scope}_{metric_name}'
+                keys = sorted(
+                    key for key in histograms
+                    if key[0] == metric_name and (key[1] is None) == (scope == 'job_group')
+                )
+                if not keys:
+                    continue
+
+                lines.append(f'# TYPE {name} histogram')
+                for key in keys:
+                    histogram = histograms[key]
+                    labels = '' if key[1] is None else 'component="{}",'.format(format_label(key[1]))
+                    for bucket, count in histogram.get_cumulative_counts():
+                        lines.append(f'{name}_bucket{{{labels}le="{format_number(bucket)}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {histogram.count}')
+                    labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+                    lines.append(f'{name}_sum{labels} {format_number(histogram.sum)}')
+                    lines.append(f'{name}_count{labels} {histogram.count}')
+        return '\n'.join(lines) + '\n'
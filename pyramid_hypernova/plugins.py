@@ -112,6 +112,33 @@ class PluginController:
         for plugin in self.plugins:
             plugin.on_error(err, jobs, request)
 
+    def on_metrics(self, metrics, request):
+        """An event type function that is called with what querying Hypernova
+        for a job group cost, once its response is processed.
+
+        :type metrics: JobGroupMetrics
+        :type request: a Pyramid request object
+        """
+        for plugin in self.plugins:
+            # Plugins written before this hook existed may not have it
+            on_metrics = getattr(plugin, 'on_metrics', None)
+            if on_metrics is not None:
+                on_metrics(metrics, request)
+
+    def on_circuit_state_change(self, url, old_state, new_state, request):
+        """An event type function that is called when the circuit breaker of
+        a Hypernova server changes state.
+
+        :param url: the URL of the query that changed the state
+        :param old_state: 'closed', 'open' or 'half_open'
+        :param new_state: 'closed', 'open' or 'half_open'
+        :param request: the Pyramid request whose query changed the state
+        """
+        for plugin in self.plugins:
+            on_circuit_state_change = getattr(plugin, 'on_circuit_state_change', None)
+            if on_circuit_state_change is not None:
+                on_circuit_state_change(url, old_state, new_state, request)
+
 
 class BasePlugin:
     """A trivial base plugin that doesn't do anything.
@@ -207,3 +234,23 @@ class BasePlugin:
         :type jobs: Dict[str, Job]
         :type request: a Pyramid request object
         """
+
+    def on_metrics(self, metrics, request):
+        """An event type function that is called with what querying Hypernova
+        for a job group cost, once its response is processed.
+
+        :param metrics: the time spent and bytes sent and received for the job
+            group, in total and by component name
+        :type metrics: JobGroupMetrics
+        :type request: a Pyramid request object
+        """
+
+    def on_circuit_state_change(self, url, old_state, new_state, request):
+        """An event type function that is called when the circuit breaker of
+        a Hypernova server changes state, e.g. to alert when it opens.
+
+        :param url: the URL of the query that changed the state
+        :param old_state: 'closed', 'open' or 'half_open'
+        :param new_state: 'closed', 'open' or 'half_open'
+        :param request: the Pyramid request whose query changed the state
+        """
@@ -0,0 +1,59 @@
+"""Helpers for state shared by every page rendered in a process."""
+import os
+import threading
+
+
+class ProcessLocal:
+    """A value created lazily, and created again in each forked process (e.g.
+    of a preloaded gunicorn master), for what doesn't survive a fork: threads,
+    and the executors and event loops running on them, or sockets.
+
+    :param factory: a callable taking no arguments and creating the value
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.value = None
+        self.pid = None
+
+    def get(self):
+        """Get the value, creating it if this process hasn't yet."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.value = self.factory()
+                self.pid = os.getpid()
+            return self.value
+
+
+class TokenBucket:
+    """A budget of actions, e.g. retries or hedges, earned by other events.
+
+    Each event earns `ratio` tokens, up to `burst` tokens, and each action
+    spends a whole token. Over time, at most `ratio` actions are taken per
+    event, and at most `burst` in a row after a quiet period.
+
+    :param tokens: the number of tokens to start with
+    """
+
+    def __init__(self, ratio, burst, tokens=0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = tokens
+        self.lock = threading.Lock()
+
+    def earn(self):
+        """Called for each event, earning `ratio` tokens."""
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.burst)
+
+    def spend(self):
+        """Spend a token, if there's one left.
+
+        :rtype: bool
+        """
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
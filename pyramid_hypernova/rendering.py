@@ -31,6 +31,9 @@ FALLBACK_ERROR = dedent('''
     </script>
 ''')  # noqa: ignore=E501
 
+RENDER_TOKEN_PREFIX = '<!--hypernova-render-token-'
+RENDER_TOKEN_SUFFIX = '-->'
+
 
 def encode(data, json_encoder):
     text = json_encoder.encode(data)
@@ -74,7 +77,7 @@ class RenderToken:
 
     def __html__(self):
         """Custom HTML markup for templating languages that use markupsafe."""
-        return f'<!--hypernova-render-token-{self.identifier}-->'
+        return f'{RENDER_TOKEN_PREFIX}{self.identifier}{RENDER_TOKEN_SUFFIX}'
 
     def __str__(self):
         return self.__html__()
@@ -1,126 +1,332 @@
+import time
+import warnings
 from collections import namedtuple
 
-import fido
-import requests
-from fido.exceptions import NetworkError
-from requests.exceptions import ConnectionError
-from requests.exceptions import HTTPError
-from requests.exceptions import JSONDecodeError
+from pyramid_hypernova.cache import get_job_key
+from pyramid_hypernova.transports import DeferredResponse
+from pyramid_hypernova.transports import ErrorData  # noqa: F401
+from pyramid_hypernova.transports import format_response_error_data  # noqa: F401
+from pyramid_hypernova.transports import get_transport
+from pyramid_hypernova.transports import HypernovaQueryError  # noqa: F401
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError  # noqa: F401
+from pyramid_hypernova.transports import min_timeout
+from pyramid_hypernova.transports import RequestsTransport
 
-ErrorData = namedtuple('ErrorData', ['name', 'message', 'stack'], defaults=[None, None, None])
 
+# The time spent encoding a job, in seconds, and its size in the request
+EncodedJob = namedtuple('EncodedJob', ['encode_time', 'payload_bytes'])
 
-def format_response_error_data(response_error_data):
-    if response_error_data and isinstance(response_error_data, dict):
-        name = response_error_data.get('name', None)
-        message = response_error_data.get('message', None)
-        stack = response_error_data.get('stack', None)
+# A job's name, data and context encoded as JSON, and the time spent encoding
+# them, in seconds
+EncodedPayload = namedtuple('EncodedPayload', ['payload', 'encode_time'])
 
-        if name or message or stack:
-            return ErrorData(name, message, stack)
 
-    return None
+def create_job_payload(job):
+    return {'name': job.name, 'data': job.data, 'context': job.context}
 
 
 def create_jobs_payload(jobs):
-    return {
-        identifier: {'name': job.name, 'data': job.data, 'context': job.context}
-        for identifier, job in jobs.items()
-    }
+    return {identifier: create_job_payload(job) for identifier, job in jobs.items()}
 
 
-class HypernovaQueryError(Exception):
-    """Creates a HypernovaQueryError object
+def encode_job_payload(job, json_encoder):
+    """Encode a job's name, data and context as they're sent to Hypernova.
 
-        :param child_error: Exception object
-        :param error_data: Optional argument of type ErrorData (namedtuple)
+    :type job: Job
+    :rtype: EncodedPayload
     """
-
-    def __init__(self, child_error, error_data=None):
-        super().__init__(str(child_error))
-        self.error_data = error_data
+    started = time.perf_counter()
+    payload = json_encoder.encode(create_job_payload(job))
+    return EncodedPayload(payload, time.perf_counter() - started)
 
 
 class HypernovaQuery:
     """ Abstract Hypernova query """
 
-    def __init__(self, job_group, url, json_encoder, synchronous, request_headers):
+    def __init__(
+        self,
+        job_group,
+        url,
+        json_encoder,
+        transport,
+        request_headers,
+        timeout=None,
+        coalescer=None,
+        hedge_url=None,
+        hedger=None,
+        retry_policy=None,
+        encoded_payloads=None,
+    ):
         """
         Build a Hypernova query.
         :param job_group: A job group (see create_job_groups)
         :param url: the URL of the Hypernova server we should query
         :param json_encoder: A JSON encoder to encode the query with
-        :param synchronous: True to synchronously query hypernova (faster),
-            False to query asynchronously (allows parallelization)
+        :param transport: the transport to send the query with (see
+            pyramid_hypernova.transports.BaseTransport). Passing True or
+            False, as the former `synchronous` argument, is deprecated and
+            selects the 'requests' or 'fido' transport.
         :param request_headers: dict of request headers to add
+        :param timeout: optional (connect timeout, read timeout) tuple, in
+            seconds. Either may be None to wait indefinitely.
+        :param coalescer: optional RenderCoalescer (see
+            pyramid_hypernova.coalescing). Jobs identical to ones already in
+            flight aren't sent, and wait for their response instead.
+        :param hedge_url: optional URL of a second Hypernova server to send
+            the query to if the first one is slow to respond
+        :param hedger: optional Hedger deciding when to query hedge_url (see
+            pyramid_hypernova.hedging)
+        :param retry_policy: optional RetryPolicy deciding whether to send
+            the query again if it fails (see pyramid_hypernova.retries)
+        :param encoded_payloads: optional dict of EncodedPayload by
+            identifier, for jobs already encoded with encode_job_payload.
+            They aren't encoded again.
         """
         self.job_group = job_group
         self.url = url
         self.json_encoder = json_encoder
-        self.synchronous = synchronous
+        if isinstance(transport, bool):
+            warnings.warn(
+                'The synchronous argument of HypernovaQuery is deprecated, pass a transport instead',
+                DeprecationWarning,
+                stacklevel=2,
+            )
+            transport = get_transport('requests' if transport else 'fido')
+        self.transport = transport
         self.request_headers = request_headers
+        self.connect_timeout, self.read_timeout = timeout or (None, None)
+        self.coalescer = coalescer
+        self.hedge_url = hedge_url
+        self.hedger = hedger
+        self.retry_policy = retry_policy
+        self.retry_count = 0
+        # whether it was decided not to send the query again
+        self.retries_stopped = False
+        self.encoded_payloads = encoded_payloads or {}
+        self.started_renders = {}
+        self.joined_renders = {}
+        self.response = None
+        self.encoded_jobs = {}
+        self.job_bytes = b''
+        self.encode_time = 0
+        self.sent_at = None
+        self.received_at = None
+        self.network_time = None
 
-    def send(self):
-        """ Query Hypernova """
-        job_str = self.json_encoder.encode(create_jobs_payload(self.job_group))
-        self.job_bytes = job_str.encode('utf-8')
+    def encode_request(self, jobs):
+        """ Encode the jobs and set the request headers to send to Hypernova """
+        encode_started = time.perf_counter()
+        # Jobs are encoded one at a time to measure what each one costs
+        encoded_jobs = []
+        # the time spent encoding payloads before this query was built
+        earlier_encode_time = 0
+        for identifier, job in jobs.items():
+            started = time.perf_counter()
+            encoded_payload = self.encoded_payloads.get(identifier)
+            if encoded_payload is None:
+                encoded_payload = encode_job_payload(job, self.json_encoder)
+                payload_encode_time = 0
+            else:
+                payload_encode_time = encoded_payload.encode_time
+                earlier_encode_time += payload_encode_time
+            encoded_job = '{}: {}'.format(
+                self.json_encoder.encode(identifier),
+                encoded_payload.payload,
+            ).encode('utf-8')
+            self.encoded_jobs[identifier] = EncodedJob(
+                time.perf_counter() - started + payload_encode_time,
+                len(encoded_job),
+            )
+            encoded_jobs.append(encoded_job)
+        self.job_bytes = b'{' + b', '.join(encoded_jobs) + b'}'
+        self.encode_time = time.perf_counter() - encode_started + earlier_encode_time
 
         self.request_headers = dict(self.request_headers)
         self.request_headers['Content-Type'] = 'application/json'
 
-        if self.synchronous:
-            # do nothing! requests.post() will throw an HTTPError if there's no healthy SSR
-            # upstream. we're not expecting this method to ever throw an exception,
-            # so make synchronous SSR requests in json() instead, where we're equipped to
-            # catch and deal with them.
-            pass
-        else:
-            self.response = fido.fetch(
-                url=self.url,
-                headers={key: [value] for key, value in self.request_headers.items()},
-                method='POST',
-                body=self.job_bytes,
+    def send(self):
+        """ Query Hypernova """
+        jobs = self.job_group
+        if self.coalescer is not None:
+            keys = {identifier: get_job_key(job, self.json_encoder) for identifier, job in jobs.items()}
+            # Requests' queries are only sent once they're waited on. Pages
+            # waiting on each other's unsent renders would stall until they
+            # time out, so these renders can't be joined, but they can join
+            # renders that were sent.
+            self.started_renders, self.joined_renders = self.coalescer.start(
+                keys,
+                share=not isinstance(self.transport, RequestsTransport),
             )
+            jobs = {identifier: job for identifier, job in jobs.items() if identifier in self.started_renders}
+
+        self.encode_request(jobs)
+        self.sent_at = time.perf_counter()
+        if not jobs:
+            # every job waits on an identical one in flight
+            return
+
+        if self.retry_policy is not None:
+            self.retry_policy.record_query()
+        self.send_request()
 
-    def json(self):
+    def send_request(self):
+        """Send the encoded jobs, or send them again when retrying."""
+        self.sent_at = time.perf_counter()
+        self.received_at = None
+        self.response = self.send_to(self.url)
+        if self.hedger is not None and self.hedge_url is not None:
+            self.response = self.hedger.hedge(self.response, lambda: self.send_to(self.hedge_url))
+        if hasattr(self.response, 'add_done_callback'):
+            self.response.add_done_callback(self.on_received)
+            if self.started_renders:
+                # Identical jobs can get the response as soon as it's received,
+                # rather than once this query is waited on
+                self.response.add_done_callback(self.on_response)
+
+    def send_to(self, url):
+        """Send the encoded jobs to the Hypernova server at url.
+
+        :returns: the transport's response
         """
-        Get the JSON response from Hypernova.
+        return self.transport.send(
+            url,
+            self.job_bytes,
+            self.request_headers,
+            (self.connect_timeout, self.read_timeout),
+        )
+
+    def get_result(self, timeout=None):
+        """Wait for the response, sending the query again if it fails and
+        the retry policy allows it.
+
+        :param timeout: optional maximum number of seconds to wait, retries
+            included
         :rtype: Dict
         """
-        if self.synchronous:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
             try:
-                self.response = requests.post(
-                    url=self.url,
-                    headers=self.request_headers,
-                    data=self.job_bytes,
-                )
-                self.response.raise_for_status()
-                json = self.response.json()
-            except HTTPError as e:
-                try:
-                    response_error_data = self.response.json().get('error', None)
-                    error_data = format_response_error_data(response_error_data)
-                except JSONDecodeError:
-                    error_data = format_response_error_data({
-                        'message': self.response.text or 'SSRS did not return any content',
-                    })
-
-                raise HypernovaQueryError(e, error_data)
-            except ConnectionError as e:
-                raise HypernovaQueryError(e)
+                return self.response.result(timeout)
+            except HypernovaQueryError as e:
+                backoff = self.get_retry_backoff(e, deadline)
+                if backoff is None:
+                    raise
+            time.sleep(backoff)
+            self.retry()
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+
+    def retry(self):
+        """Send the query again, once get_retry_backoff()'s backoff passed."""
+        self.retry_count += 1
+        self.send_request()
+
+    def get_retry_backoff(self, error, deadline):
+        """Decide whether to send the query again after it failed. Once it's
+        decided not to, the query isn't sent again.
+
+        :param error: the error the query failed with
+        :param deadline: the time.monotonic() after which to give up, or None
+        :returns: seconds to wait for before sending the query again, or None
+            not to send it again
+        :rtype: Optional[float]
+        """
+        backoff = None
+        if (
+            not self.retries_stopped and
+            self.retry_policy is not None and
+            self.retry_count < self.retry_policy.max_retries and
+            self.retry_policy.is_retryable(error)
+        ):
+            backoff = self.retry_policy.get_backoff(self.retry_count)
+            # Don't retry a query that would time out anyway
+            if deadline is not None and time.monotonic() + backoff >= deadline:
+                backoff = None
+            elif not self.retry_policy.allow_retry():
+                backoff = None
+        self.retries_stopped = backoff is None
+        return backoff
+
+    def finish_renders(self, timeout=None):
+        """Get the response and hand it over to the identical jobs waiting on
+        this query's jobs.
+
+        :rtype: Dict
+        """
+        try:
+            response_json = self.get_result(timeout)
+        except (HypernovaQueryError, ValueError) as e:
+            self.coalescer.finish(self.started_renders, error=e)
+            raise
+        self.coalescer.finish(self.started_renders, response_json)
+        return response_json
+
+    def on_received(self, response):
+        # unless a retry was sent since
+        if response is self.response:
+            self.received_at = time.perf_counter()
+
+    def on_response(self, response):
+        try:
+            response_json = response.result(0)
+        except (HypernovaQueryError, ValueError) as e:
+            # Queries that may be retried are finished once they're waited on
+            if self.retry_policy is None or not self.retry_policy.is_retryable(e):
+                self.coalescer.finish(self.started_renders, error=e)
         else:
-            try:
-                result = self.response.wait()
-            except NetworkError as e:
-                raise HypernovaQueryError(e)
-            else:
-                # NetworkError is only called raised there's an actual network
-                # problem (socket closed, etc.) and not for non-2xx statuses.
-                if result.code != 200:
-                    raise HypernovaQueryError(
-                        'Received response with status code {} from Hypernova. Response body:\n'
-                        '{}'.format(result.code, result.body.decode('UTF-8', 'ignore')),
-                    )
-                else:
-                    json = result.json()
-        return json
+            self.coalescer.finish(self.started_renders, response_json)
+
+    def json(self, timeout=None):
+        """
+        Get the JSON response from Hypernova.
+        :param timeout: optional maximum number of seconds to wait for the
+            response, on top of the query's own timeouts
+        :rtype: Dict
+        """
+        try:
+            return self.get_response_json(timeout)
+        finally:
+            self.network_time = self.get_network_time()
+
+    def was_sent(self):
+        """Whether the query's request went out. Queries whose jobs were all
+        coalesced with in-flight ones aren't sent, and DeferredResponses are
+        only sent once they're waited on, which may be past the deadline.
+
+        :rtype: bool
+        """
+        if isinstance(self.response, DeferredResponse):
+            return self.response.sent_at is not None
+        return self.response is not None
+
+    def get_network_time(self):
+        """Get the time between sending the query (its last attempt, if it
+        was retried) and receiving its response. Responses that can't tell
+        when they were received (e.g. fido's) count until they're waited on.
+
+        :returns: seconds
+        :rtype: float
+        """
+        if isinstance(self.response, DeferredResponse) and self.response.sent_at is not None:
+            # only sent once it's waited on
+            return self.response.received_at - self.response.sent_at
+        return (self.received_at or time.perf_counter()) - self.sent_at
+
+    def get_response_json(self, timeout):
+        if self.coalescer is None:
+            return self.get_result(timeout)
+
+        response_json = {'error': None, 'results': {}}
+        if self.response is not None:
+            response_json = self.finish_renders(timeout)
+            if response_json['error']:
+                return response_json
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = dict(response_json['results'])
+        for identifier, in_flight_render in self.joined_renders.items():
+            results[identifier] = in_flight_render.wait(
+                identifier,
+                min_timeout(None if deadline is None else deadline - time.monotonic(), self.read_timeout),
+            )
+        return dict(response_json, results=results)
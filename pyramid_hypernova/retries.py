@@ -0,0 +1,122 @@
+"""Retries of Hypernova queries that failed transiently.
+
+Rendering a page's components on the client is far costlier to users than
+retrying a query that failed to connect, or that a busy Hypernova server
+turned down with a 503. A RetryPolicy sends such queries again after a
+jittered backoff, within the page's deadline. Retries are capped at a share of
+queries by a budget shared by the process, so that they can't amplify an
+outage.
+
+Queries that timed out aren't retried, as Hypernova may still be rendering
+them.
+"""
+import random
+import threading
+from collections import namedtuple
+
+from pyramid_hypernova.process import TokenBucket
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError
+
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_STATUS_CODES = (502, 503)
+DEFAULT_BACKOFF = 0.01
+DEFAULT_MAX_BACKOFF = 0.1
+DEFAULT_BUDGET_RATIO = 0.1
+DEFAULT_BUDGET_BURST = 10
+
+# The number of queries sent, of retries sent, and of retries that weren't
+# sent because the budget was spent
+RetryStats = namedtuple('RetryStats', ['queries', 'retries', 'budget_exceeded'])
+
+
+class RetryPolicy:
+    """Decides which failed queries to send again, and when.
+
+    A single RetryPolicy is meant to be shared by every page rendered in the
+    process, by passing it as the `pyramid_hypernova.retry_policy` setting.
+
+    :param max_retries: the maximum number of times a query is sent again
+    :param status_codes: the HTTP statuses of Hypernova's responses to retry.
+        Queries that failed without a response, e.g. because the connection
+        was refused or reset, are always retried.
+    :param backoff: seconds the first retry waits for at most. Each retry
+        waits for a random time up to twice as long as the previous one
+        ("full jitter"), so that pages retrying at once don't all hit
+        Hypernova at the same moment.
+    :param max_backoff: the maximum number of seconds a retry waits for
+    :param budget_ratio: the maximum share of queries that are retried
+    :param budget_burst: the maximum number of retries sent in a row when
+        queries haven't been retried for a while
+    """
+
+    def __init__(
+        self,
+        max_retries=DEFAULT_MAX_RETRIES,
+        status_codes=DEFAULT_STATUS_CODES,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        budget_ratio=DEFAULT_BUDGET_RATIO,
+        budget_burst=DEFAULT_BUDGET_BURST,
+    ):
+        self.max_retries = max_retries
+        self.status_codes = frozenset(status_codes)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.lock = threading.Lock()
+        # retries that can be sent, earned by each query
+        self.budget = TokenBucket(budget_ratio, budget_burst, tokens=budget_burst)
+        self.query_count = 0
+        self.retry_count = 0
+        self.budget_exceeded_count = 0
+
+    def is_retryable(self, error):
+        """Whether a query that failed with this error may be sent again.
+
+        :type error: Exception
+        :rtype: bool
+        """
+        if not isinstance(error, HypernovaQueryError) or isinstance(error, HypernovaQueryTimeoutError):
+            return False
+        status_code = getattr(error, 'status_code', None)
+        return status_code is None or status_code in self.status_codes
+
+    def get_backoff(self, retry_count):
+        """
+        :param retry_count: the number of times the query was already retried
+        :returns: seconds to wait for before retrying the query
+        :rtype: float
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry_count))
+
+    def record_query(self):
+        """Called for each query sent, earning budget_ratio retries."""
+        with self.lock:
+            self.query_count += 1
+        self.budget.earn()
+
+    def allow_retry(self):
+        """Spend a retry from the budget, if there's one left.
+
+        :rtype: bool
+        """
+        allowed = self.budget.spend()
+        with self.lock:
+            if allowed:
+                self.retry_count += 1
+            else:
+                self.budget_exceeded_count += 1
+        return allowed
+
+    def get_stats(self):
+        """
+        :rtype: RetryStats
+        """
+        with self.lock:
+            return RetryStats(
+                queries=self.query_count,
+                retries=self.retry_count,
+                budget_exceeded=self.budget_exceeded_count,
+            )
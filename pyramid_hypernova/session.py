@@ -0,0 +1,118 @@
+import threading
+from collections import namedtuple
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+
+ConnectionStats = namedtuple('ConnectionStats', ['requests', 'connections', 'reused'])
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter that counts the requests it sends and the connections it
+    opens, so that connection reuse can be monitored.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.connection_count = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self.create_counting_pool_class(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def create_counting_pool_class(self, pool_class):
+        adapter = self
+
+        class CountingConnection(pool_class.ConnectionCls):
+
+            def connect(self):
+                with adapter.stats_lock:
+                    adapter.connection_count += 1
+                return super().connect()
+
+        class CountingConnectionPool(pool_class):
+            ConnectionCls = CountingConnection
+
+        return CountingConnectionPool
+
+    def send(self, *args, **kwargs):
+        with self.stats_lock:
+            self.request_count += 1
+        return super().send(*args, **kwargs)
+
+    def get_stats(self):
+        """
+        :rtype: ConnectionStats
+        """
+        with self.stats_lock:
+            return ConnectionStats(
+                requests=self.request_count,
+                connections=self.connection_count,
+                reused=max(0, self.request_count - self.connection_count),
+            )
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, max_retries=0, keep_alive=True):
+    """Create a requests Session with a pool of persistent connections.
+
+    :param pool_size: the maximum number of connections kept open per Hypernova host
+    :param max_retries: the number of times to retry failed connections
+    :param keep_alive: False to close the connection after every request
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    # The session is shared by every page rendered in this process, so never
+    # send cookies set by one Hypernova response along with another request
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    adapter = PooledHTTPAdapter(pool_maxsize=pool_size, max_retries=max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_session(**kwargs):
+    """Replace the session shared by this process. Accepts the same arguments
+    as create_session.
+    """
+    global _session
+    with _session_lock:
+        _session = create_session(**kwargs)
+
+
+def get_session():
+    """Get the session shared by this process, creating it with the default
+    settings if it hasn't been configured.
+
+    :rtype: requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def get_connection_stats():
+    """Get the number of requests sent by the shared session, and how many of
+    them reused an existing connection.
+
+    :rtype: ConnectionStats
+    """
+    return get_session().get_adapter('http://').get_stats()
@@ -0,0 +1,179 @@
+"""Load shedding of low-priority jobs while Hypernova is under pressure.
+
+Jobs can be rendered with a priority (see BatchRequest.render). A LoadShedder
+shared by the pages of a process watches how long Hypernova takes to respond
+and how many queries are in flight. Under pressure, jobs below a priority fall
+back to client-side rendering instead of being sent, so that the critical ones
+keep being rendered on the server.
+"""
+import threading
+import time
+from collections import namedtuple
+
+LOW_PRIORITY = 0
+NORMAL_PRIORITY = 1
+HIGH_PRIORITY = 2
+
+DEFAULT_TARGET_LATENCY = 0.2
+DEFAULT_SEVERE_PRESSURE = 2
+DEFAULT_LATENCY_WEIGHT = 0.2
+DEFAULT_STALE_AFTER = 60
+
+# The average latency of Hypernova in seconds, the number of queries in
+# flight, and the number of jobs shed so far
+LoadStats = namedtuple('LoadStats', ['latency', 'in_flight', 'shed'])
+
+
+class LoadShedder:
+    """Sheds jobs below a priority while Hypernova is under pressure.
+
+    Pressure is the highest of the average latency of Hypernova over
+    target_latency, and of the number of queries in flight over max_in_flight.
+    At a pressure of 1, LOW_PRIORITY jobs are shed. At severe_pressure,
+    NORMAL_PRIORITY jobs are too. HIGH_PRIORITY jobs are always sent.
+
+    A single LoadShedder is meant to be shared by every page rendered in the
+    process, by passing it as the `pyramid_hypernova.load_shedder` setting.
+
+    :param target_latency: seconds Hypernova is expected to respond within
+    :param max_in_flight: the number of queries in flight the process is
+        expected to stay under, or None to ignore it
+    :param severe_pressure: the pressure at which NORMAL_PRIORITY jobs are shed
+    :param latency_weight: the weight of each new latency in the average
+    :param stale_after: seconds after which a query that was never waited on
+        (e.g. its page failed) stops counting as in flight, and after which
+        the average latency is forgotten if no query finished since, so that
+        shedding every job sent doesn't keep the pressure up
+    """
+
+    def __init__(
+        self,
+        target_latency=DEFAULT_TARGET_LATENCY,
+        max_in_flight=None,
+        severe_pressure=DEFAULT_SEVERE_PRESSURE,
+        latency_weight=DEFAULT_LATENCY_WEIGHT,
+        stale_after=DEFAULT_STALE_AFTER,
+    ):
+        self.target_latency = target_latency
+        self.max_in_flight = max_in_flight
+        self.severe_pressure = severe_pressure
+        self.latency_weight = latency_weight
+        self.stale_after = stale_after
+        self.lock = threading.Lock()
+        self.latency = None
+        self.latency_updated_at = None
+        # query token -> time.monotonic() it was sent at
+        self.in_flight = {}
+        self.shed_count = 0
+
+    def count_in_flight(self, now):
+        # must be called with the lock held
+        self.in_flight = {
+            token: sent_at
+            for token, sent_at in self.in_flight.items()
+            if now - sent_at < self.stale_after
+        }
+        return len(self.in_flight)
+
+    def get_latency(self, now):
+        # must be called with the lock held
+        if self.latency is not None and now - self.latency_updated_at >= self.stale_after:
+            self.latency = None
+        return self.latency
+
+    def get_pressure(self):
+        """
+        :returns: how loaded Hypernova is, where 1 is at target
+        :rtype: float
+        """
+        now = time.monotonic()
+        with self.lock:
+            latency = self.get_latency(now)
+            pressure = 0 if latency is None else latency / self.target_latency
+            if self.max_in_flight:
+                pressure = max(pressure, self.count_in_flight(now) / self.max_in_flight)
+        return pressure
+
+    def get_min_priority(self):
+        """
+        :returns: the lowest priority of the jobs to send, or None to send
+            every job
+        :rtype: Optional[int]
+        """
+        pressure = self.get_pressure()
+        if pressure >= self.severe_pressure:
+            return HIGH_PRIORITY
+        if pressure >= 1:
+            return NORMAL_PRIORITY
+        return None
+
+    def shed_jobs(self, jobs, priorities):
+        """Split jobs into those to send and those to shed.
+
+        :type jobs: Dict[str, Job]
+        :param priorities: the priority of jobs rendered with one, by
+            identifier. Other jobs have NORMAL_PRIORITY.
+        :type priorities: Dict[str, int]
+        :returns: the jobs to send, and the jobs to shed
+        :rtype: Tuple[Dict[str, Job], Dict[str, Job]]
+        """
+        min_priority = self.get_min_priority()
+        if min_priority is None:
+            return jobs, {}
+
+        sent_jobs = {}
+        shed_jobs = {}
+        for identifier, job in jobs.items():
+            if priorities.get(identifier, NORMAL_PRIORITY) >= min_priority:
+                sent_jobs[identifier] = job
+            else:
+                shed_jobs[identifier] = job
+
+        with self.lock:
+            self.shed_count += len(shed_jobs)
+        return sent_jobs, shed_jobs
+
+    def start_query(self):
+        """Count a query as in flight until it's passed to finish_query().
+
+        :returns: a token identifying the query
+        """
+        token = object()
+        with self.lock:
+            self.in_flight[token] = time.monotonic()
+        return token
+
+    def finish_query(self, token, latency):
+        """
+        :param token: the token returned by start_query()
+        :param latency: seconds spent waiting on the query
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight.pop(token, None)
+            if self.get_latency(now) is None:
+                self.latency = latency
+            else:
+                self.latency += self.latency_weight * (latency - self.latency)
+            self.latency_updated_at = now
+
+    def cancel_query(self, token):
+        """Stop counting a query that wasn't sent after all as in flight,
+        without recording its latency.
+
+        :param token: the token returned by start_query()
+        """
+        with self.lock:
+            self.in_flight.pop(token, None)
+
+    def get_stats(self):
+        """
+        :rtype: LoadStats
+        """
+        now = time.monotonic()
+        with self.lock:
+            return LoadStats(
+                latency=self.get_latency(now),
+                in_flight=self.count_in_flight(now),
+                shed=self.shed_count,
+            )
@@ -1,6 +1,186 @@
 from contextlib import contextmanager
 
-from pyramid_hypernova.rendering import RenderToken
+from pyramid_hypernova.rendering import RENDER_TOKEN_PREFIX
+from pyramid_hypernova.rendering import RENDER_TOKEN_SUFFIX
+
+
+RENDER_TOKEN_PREFIX_BYTES = RENDER_TOKEN_PREFIX.encode('utf-8')
+RENDER_TOKEN_SUFFIX_BYTES = RENDER_TOKEN_SUFFIX.encode('utf-8')
+
+# Identifiers are uuid4 strings, so anything longer than this can't be a
+# render token and doesn't need to be held back while streaming
+MAX_IDENTIFIER_LENGTH = 128
+MAX_RENDER_TOKEN_LENGTH = len(RENDER_TOKEN_PREFIX_BYTES) + MAX_IDENTIFIER_LENGTH + len(RENDER_TOKEN_SUFFIX_BYTES)
+
+
+def iter_render_tokens(content, prefix=RENDER_TOKEN_PREFIX, suffix=RENDER_TOKEN_SUFFIX):
+    """Find every complete render token in content in a single scan.
+
+    Works on both str and bytes content, as long as prefix and suffix are of
+    the same type.
+
+    :returns: (token_start, token_end, identifier) for each token, in order
+    :rtype: Iterator[Tuple[int, int, str | bytes]]
+    """
+    token_start = content.find(prefix)
+    while token_start != -1:
+        identifier_start = token_start + len(prefix)
+        identifier_end = content.find(suffix, identifier_start)
+        if identifier_end == -1:
+            return
+
+        identifier = content[identifier_start:identifier_end]
+        if len(identifier) > MAX_IDENTIFIER_LENGTH or prefix in identifier:
+            # A stray prefix without a suffix of its own, the suffix found
+            # may belong to a token after it
+            token_start = content.find(prefix, identifier_start)
+            continue
+
+        token_end = identifier_end + len(suffix)
+        yield token_start, token_end, identifier
+        token_start = content.find(prefix, token_end)
+
+
+def replace_render_tokens(content, job_results):
+    """Replace every render token in content with the html of its job result.
+
+    All tokens are found in a single scan of the content and the output is
+    built with a single join, so the cost is proportional to the size of the
+    content plus the number of tokens rather than their product. Tokens without
+    a matching job result are left untouched.
+
+    :type content: str
+    :type job_results: Dict[str, JobResult]
+    :rtype: str
+    """
+    if not job_results:
+        return content
+
+    pieces = []
+    position = 0
+    for token_start, token_end, identifier in iter_render_tokens(content):
+        job_result = job_results.get(identifier)
+        if job_result is not None:
+            pieces.append(content[position:token_start])
+            pieces.append(job_result.html)
+            position = token_end
+
+    if not pieces:
+        return content
+
+    pieces.append(content[position:])
+    return ''.join(pieces)
+
+
+def replace_render_tokens_in_bytes(content, job_results):
+    """Replace every render token in UTF-8 encoded content without decoding it.
+
+    The token prefix is plain ASCII, so it can be searched for in the raw
+    bytes. Content without any token is returned as-is, and the surrounding
+    document is only copied once, when the output is joined.
+
+    :type content: bytes
+    :type job_results: Dict[str, JobResult]
+    :rtype: bytes
+    """
+    if not job_results:
+        return content
+
+    view = memoryview(content)
+    pieces = []
+    position = 0
+    for token_start, token_end, identifier in iter_render_tokens(
+        content,
+        RENDER_TOKEN_PREFIX_BYTES,
+        RENDER_TOKEN_SUFFIX_BYTES,
+    ):
+        job_result = job_results.get(identifier.decode('utf-8', 'replace'))
+        if job_result is not None:
+            pieces.append(view[position:token_start])
+            pieces.append(job_result.html.encode('utf-8'))
+            position = token_end
+
+    if not pieces:
+        return content
+
+    pieces.append(view[position:])
+    return b''.join(pieces)
+
+
+def find_partial_render_token(content):
+    """Find where a render token that may continue in the next chunk starts.
+
+    :type content: bytes
+    :returns: the index of the start of a possibly incomplete render token at
+        the end of content, or len(content) if there isn't one
+    :rtype: int
+    """
+    token_start = content.rfind(RENDER_TOKEN_PREFIX_BYTES)
+    if (
+        token_start != -1 and
+        len(content) - token_start < MAX_RENDER_TOKEN_LENGTH and
+        content.find(RENDER_TOKEN_SUFFIX_BYTES, token_start + len(RENDER_TOKEN_PREFIX_BYTES)) == -1
+    ):
+        return token_start
+
+    # The content may also end with the first few bytes of the prefix. The
+    # prefix only contains a single '<', so only the last one can start it.
+    prefix_start = content.rfind(b'<', max(0, len(content) - len(RENDER_TOKEN_PREFIX_BYTES) + 1))
+    if prefix_start != -1 and RENDER_TOKEN_PREFIX_BYTES.startswith(content[prefix_start:]):
+        return prefix_start
+
+    return len(content)
+
+
+class StreamingTokenReplacer:
+    """Replaces render tokens in a stream of UTF-8 encoded chunks, including
+    tokens that are split across chunk boundaries.
+
+    Everything before a possibly incomplete token at the end of a chunk is
+    returned right away; only the incomplete token is held back until the next
+    chunk, so the memory used is bounded by MAX_RENDER_TOKEN_LENGTH.
+    """
+
+    def __init__(self, get_job_results):
+        """
+        :param get_job_results: called (possibly more than once) to get the
+            job results once a render token has been found, e.g.
+            BatchRequest.submit
+        :type get_job_results: Callable[[], Dict[str, JobResult]]
+        """
+        self.get_job_results = get_job_results
+        self.buffer = b''
+
+    def feed(self, chunk):
+        """Replace the render tokens in the next chunk of the stream.
+
+        :type chunk: bytes
+        :returns: the content that can be sent, possibly empty
+        :rtype: bytes
+        """
+        if self.buffer:
+            chunk = self.buffer + chunk
+
+        partial_token_start = find_partial_render_token(chunk)
+        if partial_token_start == len(chunk):
+            self.buffer = b''
+        else:
+            self.buffer = chunk[partial_token_start:]
+            chunk = chunk[:partial_token_start]
+
+        if RENDER_TOKEN_PREFIX_BYTES not in chunk:
+            return chunk
+
+        return replace_render_tokens_in_bytes(chunk, self.get_job_results())
+
+    def flush(self):
+        """Return the content held back at the end of the stream.
+
+        :rtype: bytes
+        """
+        remaining = self.buffer
+        self.buffer = b''
+        return remaining
 
 
 @contextmanager
@@ -22,7 +202,4 @@ def hypernova_token_replacement(hypernova_batch):
     yield body
 
     hypernova_response = hypernova_batch.submit()
-
-    for identifier, job_result in hypernova_response.items():
-        token = RenderToken(identifier)
-        body['content'] = body['content'].replace(str(token), job_result.html)
+    body['content'] = replace_render_tokens(body['content'], hypernova_response)
@@ -0,0 +1,487 @@
+"""Transports send encoded Hypernova queries and get their responses.
+
+See BaseTransport for the interface they implement. Transports registered with
+register_transport can be selected by name with the `pyramid_hypernova.transport`
+setting.
+"""
+import http.client
+import json
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import urlsplit
+
+import fido
+from crochet import TimeoutError as CrochetTimeoutError
+from fido.exceptions import NetworkError
+from requests.exceptions import ConnectionError
+from requests.exceptions import HTTPError
+from requests.exceptions import JSONDecodeError
+from requests.exceptions import Timeout
+
+from pyramid_hypernova.process import ProcessLocal
+from pyramid_hypernova.session import ConnectionStats
+from pyramid_hypernova.session import DEFAULT_POOL_SIZE
+from pyramid_hypernova.session import get_session
+
+ErrorData = namedtuple('ErrorData', ['name', 'message', 'stack'], defaults=[None, None, None])
+
+
+def format_response_error_data(response_error_data):
+    if response_error_data and isinstance(response_error_data, dict):
+        name = response_error_data.get('name', None)
+        message = response_error_data.get('message', None)
+        stack = response_error_data.get('stack', None)
+
+        if name or message or stack:
+            return ErrorData(name, message, stack)
+
+    return None
+
+
+def min_timeout(*timeouts):
+    """Get the smallest timeout, ignoring timeouts that are None.
+
+    :rtype: Optional[float]
+    """
+    timeouts = [timeout for timeout in timeouts if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+
+class HypernovaQueryError(Exception):
+    """Creates a HypernovaQueryError object
+
+        :param child_error: Exception object
+        :param error_data: Optional argument of type ErrorData (namedtuple)
+        :param status_code: Optional HTTP status Hypernova responded with, None
+            if it didn't respond (e.g. the connection failed)
+    """
+
+    def __init__(self, child_error, error_data=None, status_code=None):
+        super().__init__(str(child_error))
+        self.error_data = error_data
+        self.status_code = status_code
+
+
+class HypernovaQueryTimeoutError(HypernovaQueryError):
+    """Raised when Hypernova didn't respond within the query's timeouts or
+    the batch's deadline.
+    """
+
+
+DEADLINE_EXCEEDED_MESSAGE = 'Hypernova batch deadline exceeded'
+
+
+def post_with_session(session, url, body, headers, timeout):
+    """Query Hypernova with a requests session, in the calling thread.
+
+    :rtype: Dict
+    """
+    try:
+        response = session.post(
+            url=url,
+            headers=headers,
+            data=body,
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+    except HTTPError as e:
+        try:
+            response_error_data = response.json().get('error', None)
+            error_data = format_response_error_data(response_error_data)
+        except JSONDecodeError:
+            error_data = format_response_error_data({
+                'message': response.text or 'SSRS did not return any content',
+            })
+
+        raise HypernovaQueryError(e, error_data, status_code=response.status_code)
+    except Timeout as e:
+        raise HypernovaQueryTimeoutError(e)
+    except ConnectionError as e:
+        raise HypernovaQueryError(e)
+
+
+class DeferredResponse:
+    """The response to a request that is only sent, in the calling thread,
+    once its result is needed.
+
+    Its `sent_at` and `received_at` are the time.perf_counter() at which the
+    request was actually sent and its response received, or None until then.
+    """
+
+    def __init__(self, session, url, body, headers, timeout):
+        self.session = session
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.timeout = timeout
+        self.sent_at = None
+        self.received_at = None
+
+    def result(self, timeout=None):
+        if timeout is not None and timeout <= 0:
+            raise HypernovaQueryTimeoutError(DEADLINE_EXCEEDED_MESSAGE)
+
+        connect_timeout, read_timeout = self.timeout
+        self.sent_at = time.perf_counter()
+        try:
+            return post_with_session(
+                self.session or get_session(),
+                self.url,
+                self.body,
+                self.headers,
+                (min_timeout(connect_timeout, timeout), min_timeout(read_timeout, timeout)),
+            )
+        finally:
+            self.received_at = time.perf_counter()
+
+    def cancel(self):
+        """Nothing has been sent, so there's nothing to cancel."""
+
+
+class FutureResponse:
+    """A response wrapping a concurrent.futures.Future whose result is the
+    decoded JSON response.
+    """
+
+    def __init__(self, future):
+        self.future = future
+
+    def result(self, timeout=None):
+        try:
+            return self.future.result(timeout if timeout is None else max(timeout, 0))
+        except FutureTimeoutError:
+            self.cancel()
+            raise HypernovaQueryTimeoutError(DEADLINE_EXCEEDED_MESSAGE)
+
+    def cancel(self):
+        self.future.cancel()
+
+    def add_done_callback(self, fn):
+        """Call fn with this response once it's received, unless it's cancelled."""
+        self.future.add_done_callback(lambda future: future.cancelled() or fn(self))
+
+
+class FidoResponse:
+    """A response wrapping fido's crochet EventualResult."""
+
+    def __init__(self, eventual_result):
+        self.eventual_result = eventual_result
+
+    def result(self, timeout=None):
+        try:
+            result = self.eventual_result.wait(timeout if timeout is None else max(timeout, 0))
+        except CrochetTimeoutError as e:
+            # raised both by fido's own read timeout and by wait()
+            self.cancel()
+            raise HypernovaQueryTimeoutError(e)
+        except NetworkError as e:
+            raise HypernovaQueryError(e)
+
+        # NetworkError is only called raised there's an actual network
+        # problem (socket closed, etc.) and not for non-2xx statuses.
+        if result.code != 200:
+            raise HypernovaQueryError(
+                'Received response with status code {} from Hypernova. Response body:\n'
+                '{}'.format(result.code, result.body.decode('UTF-8', 'ignore')),
+                status_code=result.code,
+            )
+        return result.json()
+
+    def cancel(self):
+        self.eventual_result.cancel()
+
+
+class BaseTransport:
+    """The interface of a transport.
+
+    A transport is shared by every page rendered in the process, so it must be
+    thread-safe.
+    """
+
+    def send(self, url, body, headers, timeout):
+        """Send a query to Hypernova.
+
+        :param url: the URL of the Hypernova server, as returned by
+            get_job_group_url
+        :param body: the JSON encoded job group
+        :type body: bytes
+        :param headers: the request headers to send
+        :type headers: Dict[str, str]
+        :param timeout: a (connect timeout, read timeout) tuple in seconds,
+            either of which may be None to wait indefinitely
+        :returns: a future-like response. Its `result(timeout=None)` method
+            waits up to `timeout` seconds for the decoded JSON response,
+            raising a HypernovaQueryError (or a HypernovaQueryTimeoutError)
+            if Hypernova couldn't be queried, and its `cancel()` method gives
+            up on the query. Responses received in the background may also
+            have an `add_done_callback(fn)` method, calling `fn(response)`
+            once the response is received.
+        """
+        raise NotImplementedError
+
+
+class RequestsTransport(BaseTransport):
+    """Queries Hypernova with a requests session (by default, the one shared
+    by the process), synchronously.
+
+    Nothing is sent until the response's result is needed: requests can throw
+    if there's no healthy SSR upstream, and we're only equipped to catch and
+    deal with that once we're waiting on the response. This is the fastest
+    option when a page only has a single job group.
+    """
+
+    def __init__(self, session=None):
+        self.session = session
+
+    def send(self, url, body, headers, timeout):
+        return DeferredResponse(self.session, url, body, headers, timeout)
+
+
+class FidoTransport(BaseTransport):
+    """Queries Hypernova asynchronously with fido, which runs a Twisted
+    reactor in a background thread. Lets a page send all of its job groups
+    at once.
+    """
+
+    def send(self, url, body, headers, timeout):
+        connect_timeout, read_timeout = timeout
+        return FidoResponse(fido.fetch(
+            url=url,
+            headers={key: [value] for key, value in headers.items()},
+            method='POST',
+            body=body,
+            timeout=read_timeout,
+            connect_timeout=connect_timeout,
+        ))
+
+
+class ThreadPoolTransport(BaseTransport):
+    """Queries Hypernova with a requests session (by default, the one shared
+    by the process) from a pool of threads, so that all of a page's job
+    groups are sent at once without needing a Twisted reactor.
+
+    :param max_workers: the number of queries that can be in flight at once
+        in this process
+    """
+
+    def __init__(self, max_workers=DEFAULT_POOL_SIZE, session=None):
+        self.max_workers = max_workers
+        self.session = session
+        self.executor = ProcessLocal(self.create_executor)
+
+    def create_executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pyramid-hypernova')
+
+    def get_executor(self):
+        return self.executor.get()
+
+    def post(self, url, body, headers, timeout):
+        """Query Hypernova from one of the pool's threads.
+
+        :rtype: Dict
+        """
+        return post_with_session(self.session or get_session(), url, body, headers, timeout)
+
+    def send(self, url, body, headers, timeout):
+        return FutureResponse(self.get_executor().submit(self.post, url, body, headers, timeout))
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection over a Unix domain socket."""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class UnixSocketTransport(ThreadPoolTransport):
+    """Queries a Hypernova server listening on a Unix domain socket, e.g. a
+    sidecar on the same host, skipping TCP altogether. Connections are kept
+    alive and reused between pages.
+
+    It's used by default for `unix://` URLs returned by get_job_group_url,
+    such as `unix:///var/run/hypernova.sock`.
+
+    :param pool_size: the maximum number of idle connections kept open per
+        socket
+    :param request_path: the path to post batches to
+    """
+
+    def __init__(self, max_workers=DEFAULT_POOL_SIZE, pool_size=DEFAULT_POOL_SIZE, request_path='/batch'):
+        super().__init__(max_workers=max_workers)
+        self.pool_size = pool_size
+        self.request_path = request_path
+        self.pool_lock = threading.Lock()
+        # socket path -> idle connections. Sockets must not be shared with a
+        # forked process.
+        self.idle_connections = ProcessLocal(dict)
+        self.request_count = 0
+        self.connection_count = 0
+
+    def get_connection(self, socket_path):
+        """Get an idle connection to the socket, if there is one.
+
+        :rtype: Optional[UnixHTTPConnection]
+        """
+        pool = self.idle_connections.get()
+        with self.pool_lock:
+            self.request_count += 1
+            idle_connections = pool.get(socket_path)
+            return idle_connections.pop() if idle_connections else None
+
+    def create_connection(self, socket_path, connect_timeout):
+        """
+        :rtype: UnixHTTPConnection
+        """
+        with self.pool_lock:
+            self.connection_count += 1
+        connection = UnixHTTPConnection(socket_path, timeout=connect_timeout)
+        connection.connect()
+        return connection
+
+    def release_connection(self, socket_path, connection):
+        pool = self.idle_connections.get()
+        with self.pool_lock:
+            idle_connections = pool.setdefault(socket_path, [])
+            if len(idle_connections) < self.pool_size:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def get_stats(self):
+        """
+        :rtype: ConnectionStats
+        """
+        with self.pool_lock:
+            return ConnectionStats(
+                requests=self.request_count,
+                connections=self.connection_count,
+                reused=self.request_count - self.connection_count,
+            )
+
+    def request(self, connection, body, headers, read_timeout):
+        """
+        :rtype: http.client.HTTPResponse
+        """
+        connection.sock.settimeout(read_timeout)
+        connection.request('POST', self.request_path, body=body, headers=headers)
+        return connection.getresponse()
+
+    def post(self, url, body, headers, timeout):
+        socket_path = urlsplit(url).path
+        connect_timeout, read_timeout = timeout
+
+        connection = self.get_connection(socket_path)
+        try:
+            if connection is None:
+                connection = self.create_connection(socket_path, connect_timeout)
+                response = self.request(connection, body, headers, read_timeout)
+            else:
+                try:
+                    response = self.request(connection, body, headers, read_timeout)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The server closed the idle connection, the batch can
+                    # safely be sent again on a new one
+                    connection.close()
+                    connection = self.create_connection(socket_path, connect_timeout)
+                    response = self.request(connection, body, headers, read_timeout)
+            response_body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            if connection is not None:
+                connection.close()
+            if isinstance(e, socket.timeout):
+                raise HypernovaQueryTimeoutError(e)
+            raise HypernovaQueryError(e)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release_connection(socket_path, connection)
+
+        if response.status != 200:
+            try:
+                error_data = format_response_error_data(json.loads(response_body).get('error', None))
+            except ValueError:
+                error_data = format_response_error_data({
+                    'message': response_body.decode('utf-8', 'replace') or 'SSRS did not return any content',
+                })
+            raise HypernovaQueryError(
+                'Received response with status code {} from Hypernova'.format(response.status),
+                error_data,
+                status_code=response.status,
+            )
+        return json.loads(response_body)
+
+
+_transport_factories = {}
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def register_transport(name, factory):
+    """Register a transport so that it can be selected by name with the
+    `pyramid_hypernova.transport` setting.
+
+    :param factory: a callable taking no arguments and returning the
+        transport. It's called once, the first time the transport is used, and
+        the transport is then shared by the process.
+    """
+    with _transports_lock:
+        _transport_factories[name] = factory
+        _transports.pop(name, None)
+
+
+def get_transport(transport):
+    """Get a registered transport by name. Anything other than a name is
+    assumed to already be a transport, and is returned as is.
+
+    :rtype: BaseTransport
+    """
+    if not isinstance(transport, str):
+        return transport
+
+    with _transports_lock:
+        if transport not in _transports:
+            try:
+                factory = _transport_factories[transport]
+            except KeyError:
+                raise ValueError('Unknown Hypernova transport {!r}, expected one of: {}'.format(
+                    transport,
+                    ', '.join(sorted(_transport_factories)),
+                ))
+            _transports[transport] = factory()
+        return _transports[transport]
+
+
+def create_asyncio_transport():
+    # httpx is an optional dependency, only import it when it's used
+    from pyramid_hypernova.aio import asyncio_transport
+    return asyncio_transport
+
+
+def create_http2_transport():
+    from pyramid_hypernova.aio import Http2Transport
+    return Http2Transport()
+
+
+register_transport('requests', RequestsTransport)
+register_transport('fido', FidoTransport)
+register_transport('thread_pool', ThreadPoolTransport)
+register_transport('unix', UnixSocketTransport)
+register_transport('asyncio', create_asyncio_transport)
+register_transport('http2', create_http2_transport)
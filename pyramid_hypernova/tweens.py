@@ -1,41 +1,163 @@
+import time
 from json import JSONEncoder
 
 from pyramid_hypernova.batch import BatchRequest
 from pyramid_hypernova.plugins import PluginController
-from pyramid_hypernova.token_replacement import hypernova_token_replacement
+from pyramid_hypernova.session import configure_session
+from pyramid_hypernova.token_replacement import StreamingTokenReplacer
+
+
+# Optional BatchRequest arguments that can be set through `pyramid_hypernova.*`
+# settings. They're only passed when configured, so that custom batch request
+# factories don't have to accept them.
+BATCH_REQUEST_SETTINGS = (
+    'max_batch_size',
+    'max_batch_bytes',
+    'job_grouper',
+    'send_on_render',
+    'connect_timeout',
+    'read_timeout',
+    'deadline',
+    'transport',
+    'render_cache',
+    'coalescer',
+    'circuit_breaker',
+    'load_shedder',
+    'hedger',
+    'retry_policy',
+)
+
+# `pyramid_hypernova.*` settings for the HTTP session shared by this process,
+# mapped to the create_session argument they set
+SESSION_SETTINGS = {
+    'http_pool_size': 'pool_size',
+    'http_max_retries': 'max_retries',
+    'http_keep_alive': 'keep_alive',
+}
+
+
+# The phases of a request whose time is recorded in request.hypernova_timings,
+# in seconds:
+# - view: the view, including rendering templates that are streamed
+# - submit: BatchRequest.submit, including encoding and waiting on queries
+# - encode: encoding queries to Hypernova, wherever they're sent from
+# - wait: waiting on Hypernova's responses
+# - replace: replacing render tokens, excluding submit
+TIMING_PHASES = ('view', 'submit', 'encode', 'wait', 'replace')
+
+
+def format_server_timing(timings):
+    """
+    :param timings: seconds spent in each phase (see TIMING_PHASES)
+    :returns: the value of a Server-Timing header reporting the timings
+    :rtype: str
+    """
+    return ', '.join(
+        'hypernova-{};dur={:.1f}'.format(phase, timings[phase] * 1000)
+        for phase in TIMING_PHASES
+    )
 
 
 def hypernova_tween_factory(handler, registry):
     registry = registry
 
-    def hypernova_mapper(request, chunk):
+    session_kwargs = {
+        argument: registry.settings[f'pyramid_hypernova.{name}']
+        for name, argument in SESSION_SETTINGS.items()
+        if f'pyramid_hypernova.{name}' in registry.settings
+    }
+    if session_kwargs:
+        configure_session(**session_kwargs)
+
+    def should_replace_tokens(request):
         if not request.hypernova_batch.jobs:
-            return chunk
+            return False
 
         try:
             # Skip token replacement logic if explicitly flagged to
             if request.disable_hypernova_tween:
-                return chunk
+                return False
         except AttributeError:
             pass
 
-        transformed_chunk = chunk.decode('utf-8')
-        with hypernova_token_replacement(request.hypernova_batch) as body:
-            body['content'] = transformed_chunk
+        return True
+
+    server_timing = registry.settings.get('pyramid_hypernova.server_timing', False)
 
-        transformed_chunk = body['content']
-        return transformed_chunk.encode('utf-8')
+    def update_batch_timings(request):
+        request.hypernova_timings['encode'] = getattr(request.hypernova_batch, 'encode_time', 0)
+        request.hypernova_timings['wait'] = getattr(request.hypernova_batch, 'wait_time', 0)
+
+    def hypernova_app_iter(request, app_iter):
+        timings = request.hypernova_timings
+
+        def submit():
+            started = time.perf_counter()
+            try:
+                return request.hypernova_batch.submit()
+            finally:
+                timings['submit'] += time.perf_counter() - started
+
+        # Chunks without a render token are passed through untouched, without
+        # submitting the batch or decoding them. Tokens split across chunks are
+        # held back until the chunk that completes them.
+        replacer = StreamingTokenReplacer(submit)
+        try:
+            started = time.perf_counter()
+            for chunk in app_iter:
+                # streamed templates are rendered as they're iterated over
+                timings['view'] += time.perf_counter() - started
+                started = time.perf_counter()
+                submit_time = timings['submit']
+
+                if should_replace_tokens(request):
+                    chunk = replacer.feed(chunk)
+                elif replacer.buffer:
+                    chunk = replacer.flush() + chunk
+
+                timings['replace'] += time.perf_counter() - started - (timings['submit'] - submit_time)
+                if chunk:
+                    yield chunk
+                started = time.perf_counter()
+
+            timings['view'] += time.perf_counter() - started
+            started = time.perf_counter()
+            submit_time = timings['submit']
+            remaining = replacer.flush()
+            timings['replace'] += time.perf_counter() - started - (timings['submit'] - submit_time)
+            if remaining:
+                yield remaining
+        finally:
+            update_batch_timings(request)
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
 
     def hypernova_tween(request):
+        request.hypernova_timings = dict.fromkeys(TIMING_PHASES, 0)
         request.hypernova_batch = configure_hypernova_batch(registry, request)
+        started = time.perf_counter()
         response = handler(request)
+        request.hypernova_timings['view'] += time.perf_counter() - started
         # Loop over all chunks in response.app_iter. Unlike accessing response.body
         # or response.text directly, this avoids buffering and is important
         # if our app_iter is a generator
         #
         # In cases where app_iter is a list (the default), this should work
         # equivalently
-        response.app_iter = map(lambda chunk: hypernova_mapper(request, chunk), response.app_iter)
+        app_iter = hypernova_app_iter(request, response.app_iter)
+
+        if server_timing:
+            if isinstance(response.app_iter, (list, tuple)):
+                # The body is already buffered, so tokens can be replaced
+                # before the headers are sent, and every phase reported
+                app_iter = list(app_iter)
+            else:
+                # Streamed responses send the headers before the body, so they
+                # only report what's happened so far
+                update_batch_timings(request)
+            response.headers.add('Server-Timing', format_server_timing(request.hypernova_timings))
+
+        response.app_iter = app_iter
         return response
 
     return hypernova_tween
@@ -57,10 +179,17 @@ def configure_hypernova_batch(registry, request):
         'pyramid_hypernova.should_display_error_stack', lambda request: False
     )
 
+    optional_kwargs = {
+        name: registry.settings[f'pyramid_hypernova.{name}']
+        for name in BATCH_REQUEST_SETTINGS
+        if f'pyramid_hypernova.{name}' in registry.settings
+    }
+
     return batch_request_factory(
         get_job_group_url=get_job_group_url,
         plugin_controller=plugin_controller,
         json_encoder=json_encoder,
         pyramid_request=request,
         display_error_stack=should_display_error_stack(request),
+        **optional_kwargs,
     )
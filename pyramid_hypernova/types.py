@@ -22,3 +22,39 @@ HypernovaError = namedtuple('HypernovaError', (
     'message',
     'stack',
 ))
+
+# What querying Hypernova for a job group cost, passed to plugins' on_metrics.
+# Times are in seconds and sizes in bytes.
+JobGroupMetrics = namedtuple('JobGroupMetrics', (
+    'url',
+    # the time spent encoding the request
+    'encode_time',
+    # the time from sending the request to receiving the response
+    'network_time',
+    # the time spent creating the JobResults from the response
+    'parse_time',
+    # the size of the request
+    'payload_bytes',
+    # the size of the HTML rendered by Hypernova
+    'html_bytes',
+    # a HypernovaError if the job group failed, or None
+    'error',
+    # Dict[str, ComponentMetrics], by component name
+    'components',
+    # the number of times the query was sent again after failing
+    'retries',
+), defaults=[0])
+
+# The share of a job group's metrics of the jobs of a component
+ComponentMetrics = namedtuple('ComponentMetrics', (
+    'jobs',
+    'encode_time',
+    # the job group's network time, which every job waited on
+    'network_time',
+    'parse_time',
+    'payload_bytes',
+    'html_bytes',
+    # the time Hypernova reported spending to render the jobs, or None if it
+    # didn't report it
+    'render_time',
+))
@@ -0,0 +1,162 @@
+"""Client-side load balancing between Hypernova servers.
+
+An UpstreamPool can be used as `pyramid_hypernova.get_job_group_url`. It
+tracks the latency and error rate of each Hypernova server from the queries
+sent to it, and picks where to send each job group with the power of two
+choices: of two servers picked at random, the one expected to respond faster.
+Servers with too many errors are ejected from the pool for a while.
+"""
+import math
+import random
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_WEIGHT = 0.2
+DEFAULT_DECAY_TIME = 10
+DEFAULT_EJECTION_ERROR_RATE = 0.5
+DEFAULT_MIN_QUERIES = 5
+DEFAULT_EJECTION_TIME = 30
+
+# The average latency of a server in seconds (None until it's been queried),
+# its average error rate, the number of queries recorded since it was added or
+# last ejected, and whether it's ejected
+UpstreamStats = namedtuple('UpstreamStats', ['latency', 'error_rate', 'queries', 'ejected'])
+
+
+class Upstream:
+    """The state of a Hypernova server in an UpstreamPool."""
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.updated_at = None
+        self.error_rate = 0
+        self.query_count = 0
+        self.ejected_until = None
+
+    def is_ejected(self, now):
+        return self.ejected_until is not None and now < self.ejected_until
+
+    def get_cost(self, now, decay_time):
+        """Estimate how long a query to this server takes to succeed.
+
+        The latency decays towards 0 as time passes without queries, so that
+        a server that was slow is eventually queried again to find out whether
+        it still is.
+
+        :rtype: float
+        """
+        if self.latency is None:
+            return 0
+        latency = self.latency * math.exp(-(now - self.updated_at) / decay_time)
+        return latency / max(1 - self.error_rate, 0.01)
+
+
+class UpstreamPool:
+    """Balances job groups between Hypernova servers, towards the fastest
+    healthy ones.
+
+    It returns two URLs for each job group, the one to query first, and the
+    other one to send hedged queries to if a Hedger is configured (see
+    pyramid_hypernova.hedging).
+
+    :param urls: the URLs of the Hypernova servers' batch endpoints
+    :param weight: the weight of each new latency and outcome in a server's
+        averages
+    :param decay_time: seconds over which a server's latency is forgotten when
+        it isn't queried
+    :param ejection_error_rate: the average error rate at which a server is
+        ejected
+    :param min_queries: the number of queries a server needs to have been sent
+        before it can be ejected
+    :param ejection_time: seconds a server stays ejected. It's then queried
+        again with a clean slate.
+    """
+
+    def __init__(
+        self,
+        urls,
+        weight=DEFAULT_WEIGHT,
+        decay_time=DEFAULT_DECAY_TIME,
+        ejection_error_rate=DEFAULT_EJECTION_ERROR_RATE,
+        min_queries=DEFAULT_MIN_QUERIES,
+        ejection_time=DEFAULT_EJECTION_TIME,
+    ):
+        if not urls:
+            raise ValueError('An UpstreamPool needs at least one URL')
+        self.weight = weight
+        self.decay_time = decay_time
+        self.ejection_error_rate = ejection_error_rate
+        self.min_queries = min_queries
+        self.ejection_time = ejection_time
+        self.lock = threading.Lock()
+        self.upstreams = {url: Upstream(url) for url in urls}
+
+    def __call__(self, job_group, pyramid_request):
+        """Choose the Hypernova servers to query for a job group.
+
+        :returns: the URL to query, and if there's more than one server, the
+            URL to send hedged queries to
+        :rtype: List[str]
+        """
+        return self.choose_urls()
+
+    def choose_urls(self):
+        """
+        :rtype: List[str]
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [upstream for upstream in self.upstreams.values() if not upstream.is_ejected(now)]
+            # Better to query an unhealthy server than none at all
+            if not candidates:
+                candidates = list(self.upstreams.values())
+            if len(candidates) == 1:
+                return [candidates[0].url]
+
+            choices = random.sample(candidates, 2)
+            choices.sort(key=lambda upstream: upstream.get_cost(now, self.decay_time))
+        return [upstream.url for upstream in choices]
+
+    def record_result(self, url, failed, latency):
+        """Record the outcome of a query. BatchRequest calls this for each
+        query it waits on.
+
+        :param failed: whether the query failed
+        :param latency: seconds spent waiting on the query
+        """
+        now = time.monotonic()
+        with self.lock:
+            upstream = self.upstreams.get(url)
+            if upstream is None:
+                return
+
+            if upstream.latency is None:
+                upstream.latency = latency
+            else:
+                upstream.latency += self.weight * (latency - upstream.latency)
+            upstream.updated_at = now
+            upstream.error_rate += self.weight * ((1 if failed else 0) - upstream.error_rate)
+            upstream.query_count += 1
+
+            if upstream.query_count >= self.min_queries and upstream.error_rate >= self.ejection_error_rate:
+                self.upstreams[url] = Upstream(url)
+                self.upstreams[url].ejected_until = now + self.ejection_time
+
+    def get_stats(self):
+        """
+        :returns: the stats of each server, by URL
+        :rtype: Dict[str, UpstreamStats]
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {
+                url: UpstreamStats(
+                    latency=upstream.latency,
+                    error_rate=upstream.error_rate,
+                    queries=upstream.query_count,
+                    ejected=upstream.is_ejected(now),
+                )
+                for url, upstream in self.upstreams.items()
+            }
@@ -21,5 +21,9 @@ setup(
         'more-itertools',
         'requests',
     ],
+    extras_require={
+        'asyncio': ['httpx'],
+        'http2': ['httpx[http2]'],
+    },
     packages=find_packages(exclude=('tests*', 'testing*')),
 )
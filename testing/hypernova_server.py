@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from socketserver import BaseRequestHandler
+from socketserver import ThreadingUnixStreamServer
+
+import h2.config
+import h2.connection
+import h2.events
+
+
+def render_batch(server, path, headers, body):
+    """ Renders every job in a batch as a div with the job's name, like a very fast Hypernova server would
+
+        :returns: the response's status and body
+    """
+    jobs = json.loads(body)
+    server.requests.append((path, headers, jobs))
+    # like Hypernova, render the jobs of a batch one after the other
+    render_times = [server.render_times.get(job['name'], 0) for job in jobs.values()]
+    time.sleep(server.delay + sum(render_times))
+
+    status, response = server.responses.pop(0) if server.responses else (200, None)
+    if response is None:
+        response = {'error': None, 'results': {}}
+        for (identifier, job), render_time in zip(jobs.items(), render_times):
+            response['results'][identifier] = {'error': None, 'html': '<div>{}</div>'.format(job['name'])}
+            if render_time:
+                response['results'][identifier]['duration'] = render_time * 1000
+
+    return status, response if isinstance(response, bytes) else json.dumps(response).encode('utf-8')
+
+
+class HypernovaRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't wait for an ACK in between
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections.append(self.client_address)
+
+    def do_POST(self):
+        status, body = render_batch(
+            self.server,
+            self.path,
+            dict(self.headers),
+            self.rfile.read(int(self.headers['Content-Length'])),
+        )
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in self.server.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHypernovaRequestHandler(HypernovaRequestHandler):
+    # TCP_NODELAY can't be set on a Unix domain socket
+    disable_nagle_algorithm = False
+
+
+class Http2HypernovaRequestHandler(BaseRequestHandler):
+    """ Answers HTTP/2 requests sent without TLS or an upgrade (h2c with prior knowledge) """
+
+    def handle(self):
+        self.server.connections.append(self.client_address)
+        connection = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding='utf-8'),
+        )
+        connection.initiate_connection()
+        self.request.sendall(connection.data_to_send())
+
+        streams = {}
+        while True:
+            data = self.request.recv(65535)
+            if not data:
+                break
+
+            for event in connection.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = (dict(event.headers), [])
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1].append(event.data)
+                    connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, chunks = streams.pop(event.stream_id)
+                    status, body = render_batch(self.server, headers[':path'], headers, b''.join(chunks))
+                    connection.send_headers(event.stream_id, [
+                        (':status', str(status)),
+                        ('content-type', 'application/json'),
+                        ('content-length', str(len(body))),
+                        *((name.lower(), value) for name, value in self.server.headers.items()),
+                    ])
+                    connection.send_data(event.stream_id, body, end_stream=True)
+
+            self.request.sendall(connection.data_to_send())
+
+
+class HypernovaHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # pages send all of their job groups at once
+    request_queue_size = 128
+
+
+class UnixHypernovaHTTPServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StubHypernovaServer:
+    """ A local Hypernova stand-in running in a background thread, for tests and benchmarks
+
+        :param delay: seconds to wait before answering each request
+        :param address: a (host, port) tuple, or the path of a Unix domain socket to listen on
+        :param http2: True to answer HTTP/2 requests (h2c with prior knowledge) instead of HTTP/1.1 ones
+        :param render_times: seconds rendering each job of a component takes, by component name. They're
+            reported as the job's duration.
+    """
+
+    def __init__(self, delay=0, address=('127.0.0.1', 0), http2=False, render_times=None):
+        if isinstance(address, str):
+            self.server = UnixHypernovaHTTPServer(address, UnixHypernovaRequestHandler)
+        elif http2:
+            self.server = HypernovaHTTPServer(address, Http2HypernovaRequestHandler)
+        else:
+            self.server = HypernovaHTTPServer(address, HypernovaRequestHandler)
+        self.server.delay = delay
+        self.server.render_times = render_times or {}
+        # received (path, headers, jobs) tuples
+        self.server.requests = []
+        # addresses of the clients of every connection accepted
+        self.server.connections = []
+        # (status, response json or raw bytes) tuples to answer the next requests with
+        self.server.responses = []
+        # extra headers to send with every response
+        self.server.headers = {}
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        if isinstance(self.server.server_address, str):
+            return f'unix://{self.server.server_address}'
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/batch'
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    @property
+    def responses(self):
+        return self.server.responses
+
+    @property
+    def headers(self):
+        return self.server.headers
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
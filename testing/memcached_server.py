@@ -0,0 +1,79 @@
+import threading
+import time
+from socketserver import StreamRequestHandler
+from socketserver import ThreadingTCPServer
+
+
+class MemcachedRequestHandler(StreamRequestHandler):
+    """ Answers the get and set commands of memcached's text protocol """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command, *args = line.split()
+            self.server.commands.append(command.decode('utf-8'))
+            if command == b'get':
+                self.handle_get(args)
+            elif command == b'set':
+                self.handle_set(*args)
+            else:
+                self.wfile.write(b'ERROR\r\n')
+
+    def handle_get(self, keys):
+        response = []
+        now = time.time()
+        for key in keys:
+            entry = self.server.entries.get(key)
+            if entry is not None and entry[0] > now:
+                __, flags, data = entry
+                response.append(b'VALUE %s %d %d\r\n%s\r\n' % (key, flags, len(data), data))
+        response.append(b'END\r\n')
+        self.wfile.write(b''.join(response))
+
+    def handle_set(self, key, flags, exptime, length, noreply=None):
+        data = self.rfile.read(int(length) + 2)[:-2]
+        self.server.entries[key] = (time.time() + int(exptime), int(flags), data)
+        if noreply is None:
+            self.wfile.write(b'STORED\r\n')
+
+
+class StubMemcachedServer:
+    """ A local memcached stand-in running in a background thread, for tests """
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        self.server = ThreadingTCPServer(address, MemcachedRequestHandler)
+        self.server.daemon_threads = True
+        # key -> (expiry time, flags, data)
+        self.server.entries = {}
+        # the name of every command received
+        self.server.commands = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    @property
+    def entries(self):
+        return self.server.entries
+
+    @property
+    def commands(self):
+        return self.server.commands
+
+    def wait_for_entries(self, count, timeout=1):
+        """ Sets sent with noreply aren't acknowledged, wait for them to be stored """
+        deadline = time.monotonic() + timeout
+        while len(self.entries) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
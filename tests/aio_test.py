@@ -0,0 +1,437 @@
+import asyncio
+import os
+import tempfile
+from json import JSONEncoder
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova import aio
+from pyramid_hypernova.aio import AsyncBatchRequest
+from pyramid_hypernova.aio import asyncio_transport
+from pyramid_hypernova.aio import EventLoopThread
+from pyramid_hypernova.aio import Http2Transport
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.coalescing import RenderCoalescer
+from pyramid_hypernova.hedging import Hedger
+from pyramid_hypernova.hedging import HedgeStats
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.request import ErrorData
+from pyramid_hypernova.request import HypernovaQuery
+from pyramid_hypernova.request import HypernovaQueryError
+from pyramid_hypernova.request import HypernovaQueryTimeoutError
+from pyramid_hypernova.retries import RetryPolicy
+from pyramid_hypernova.retries import RetryStats
+from pyramid_hypernova.transports import get_transport
+from pyramid_hypernova.types import Job
+from pyramid_hypernova.types import JobResult
+from testing.hypernova_server import StubHypernovaServer
+
+TEST_JOB_GROUP = {
+    'yellow keycard': Job('open the exit door', 'behind the cacodemon', {}),
+    'red skull key': Job('get the bfg9k', 'rocket jump from the platform', {'foo': 'bar'}),
+}
+
+
+@pytest.fixture
+def stub_server():
+    with StubHypernovaServer() as stub_server:
+        yield stub_server
+
+
+@pytest.fixture
+def http2_stub_server():
+    with StubHypernovaServer(http2=True) as stub_server:
+        yield stub_server
+
+
+@pytest.fixture
+def slow_stub_server():
+    with StubHypernovaServer(delay=0.5) as stub_server:
+        yield stub_server
+
+
+def create_query(url, request_headers=None, timeout=None, transport=asyncio_transport):
+    return HypernovaQuery(
+        TEST_JOB_GROUP,
+        url,
+        JSONEncoder(),
+        transport,
+        request_headers or {},
+        timeout=timeout,
+    )
+
+
+def create_batch_request(url, batch_request_class=AsyncBatchRequest, **kwargs):
+    return batch_request_class(
+        get_job_group_url=lambda job_group, pyramid_request: url,
+        plugin_controller=PluginController([]),
+        pyramid_request=pyramid.request.Request.blank('/'),
+        **kwargs
+    )
+
+
+def create_hedger(latency):
+    """A hedger that hedges after `latency` seconds, with budget to spare."""
+    hedger = Hedger(min_samples=1, max_hedge_rate=1)
+    hedger.record_latency(latency)
+    hedger.budget.tokens = hedger.hedge_burst
+    return hedger
+
+
+def submit_with_ticker(batch_request):
+    """Run submit_async() along with a coroutine ticking every 10ms, to tell
+    whether the event loop was blocked.
+
+    :returns: the response, and the number of ticks
+    """
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        try:
+            return await batch_request.submit_async(), ticks
+        finally:
+            ticker.cancel()
+
+    return asyncio.run(run())
+
+
+class TestEventLoopThread:
+
+    def test_runs_coroutines_on_shared_loop(self):
+        event_loop_thread = EventLoopThread()
+
+        async def get_loop():
+            return asyncio.get_running_loop()
+
+        assert event_loop_thread.run(get_loop()).result(1) is event_loop_thread.get_loop()
+        assert event_loop_thread.run(get_loop()).result(1) is event_loop_thread.get_loop()
+
+    def test_restarts_loop_after_fork(self):
+        event_loop_thread = EventLoopThread()
+        loop = event_loop_thread.get_loop()
+        event_loop_thread.client = mock.sentinel.client
+
+        with mock.patch('pyramid_hypernova.process.os.getpid', return_value=-1):
+            assert event_loop_thread.get_loop() is not loop
+
+        assert event_loop_thread.client is None
+
+    def test_creates_client_once(self):
+        event_loop_thread = EventLoopThread(pool_size=3)
+
+        client = event_loop_thread.get_client()
+
+        assert event_loop_thread.get_client() is client
+
+
+class TestAsyncioTransport:
+
+    def test_successful_query(self, stub_server):
+        query = create_query(stub_server.url, {'header1': 'value1'})
+        query.send()
+
+        assert query.json() == {
+            'error': None,
+            'results': {
+                'yellow keycard': {'error': None, 'html': '<div>open the exit door</div>'},
+                'red skull key': {'error': None, 'html': '<div>get the bfg9k</div>'},
+            },
+        }
+        path, headers, jobs = stub_server.requests[0]
+        assert headers['header1'] == 'value1'
+        assert headers['Content-Type'] == 'application/json'
+
+    def test_error_status_with_error_data(self, stub_server):
+        stub_server.responses.append((500, {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}}))
+        query = create_query(stub_server.url)
+        query.send()
+
+        with pytest.raises(HypernovaQueryError) as exc_info:
+            query.json()
+
+        assert exc_info.value.error_data == ErrorData('SadError', 'so sad', [])
+
+    def test_error_status_without_json(self, stub_server):
+        stub_server.responses.append((502, b'<h1>502 Bad Gateway</h1>'))
+        query = create_query(stub_server.url)
+        query.send()
+
+        with pytest.raises(HypernovaQueryError) as exc_info:
+            query.json()
+
+        assert exc_info.value.error_data == ErrorData(message='<h1>502 Bad Gateway</h1>')
+        assert exc_info.value.status_code == 502
+
+    def test_connection_error(self):
+        query = create_query('http://127.0.0.1:1/batch')
+        query.send()
+
+        with pytest.raises(HypernovaQueryError):
+            query.json()
+
+    def test_read_timeout(self, slow_stub_server):
+        query = create_query(slow_stub_server.url, timeout=(1, 0.05))
+        query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            query.json()
+
+    def test_deadline(self, slow_stub_server):
+        query = create_query(slow_stub_server.url)
+        query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError) as exc_info:
+            query.json(timeout=0.05)
+
+        assert str(exc_info.value) == 'Hypernova batch deadline exceeded'
+        assert query.response.future.cancelled()
+
+    def test_deadline_exceeded_before_waiting(self, slow_stub_server):
+        query = create_query(slow_stub_server.url)
+        query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            query.json(timeout=0)
+
+        assert query.response.future.cancelled()
+
+    def test_response_received_before_deadline(self, stub_server):
+        query = create_query(stub_server.url)
+        query.send()
+        query.response.future.result(1)
+
+        assert query.json(timeout=0)['error'] is None
+
+
+class TestAsyncBatchRequest:
+
+    def test_submit_sends_job_groups_concurrently(self, stub_server):
+        batch_request = create_batch_request(stub_server.url, max_batch_size=1)
+        tokens = [batch_request.render(f'Component{i}.js', {'i': i}) for i in range(3)]
+
+        response = batch_request.submit()
+
+        assert len(stub_server.requests) == 3
+        assert response == {
+            token.identifier: JobResult(
+                error=None,
+                html=f'<div>Component{i}.js</div>',
+                job=Job(name=f'Component{i}.js', data={'i': i}, context={}),
+            )
+            for i, token in enumerate(tokens)
+        }
+
+    def test_submit_async(self, stub_server):
+        batch_request = create_batch_request(stub_server.url, max_batch_size=1)
+        tokens = [batch_request.render(f'Component{i}.js', {'i': i}) for i in range(2)]
+
+        response = asyncio.run(batch_request.submit_async())
+
+        assert {identifier: result.html for identifier, result in response.items()} == {
+            tokens[0].identifier: '<div>Component0.js</div>',
+            tokens[1].identifier: '<div>Component1.js</div>',
+        }
+
+    @pytest.mark.parametrize('transport', ['requests', 'fido'])
+    def test_submit_async_with_responses_received_when_waited_on(self, stub_server, transport):
+        batch_request = create_batch_request(stub_server.url, max_batch_size=1, transport=transport)
+        tokens = [batch_request.render(f'Component{i}.js', {'i': i}) for i in range(2)]
+
+        response = asyncio.run(batch_request.submit_async())
+
+        assert {identifier: result.html for identifier, result in response.items()} == {
+            tokens[0].identifier: '<div>Component0.js</div>',
+            tokens[1].identifier: '<div>Component1.js</div>',
+        }
+
+    def test_submit_async_to_unix_socket(self):
+        # tmp_path can be longer than a Unix domain socket path is allowed to be
+        with tempfile.TemporaryDirectory() as directory:
+            with StubHypernovaServer(address=os.path.join(directory, 'hypernova.sock')) as unix_stub_server:
+                batch_request = create_batch_request(unix_stub_server.url)
+                token = batch_request.render('Component.js', {})
+
+                response = asyncio.run(batch_request.submit_async())
+
+        assert response[token.identifier].html == '<div>Component.js</div>'
+
+    @pytest.mark.parametrize('url,transport,expected', [
+        ('http://localhost:8888', None, asyncio_transport),
+        ('unix:///var/run/hypernova.sock', None, get_transport('unix')),
+        ('unix:///var/run/hypernova.sock', 'thread_pool', get_transport('thread_pool')),
+    ])
+    def test_choose_transport(self, url, transport, expected):
+        batch_request = create_batch_request(url, transport=transport)
+
+        assert batch_request.choose_transport(url, True) is expected
+
+    def test_submit_async_without_jobs(self, stub_server):
+        batch_request = create_batch_request(stub_server.url)
+
+        assert asyncio.run(batch_request.submit_async()) == {}
+        assert stub_server.requests == []
+
+    def test_submit_async_falls_back_after_deadline(self, slow_stub_server):
+        batch_request = create_batch_request(slow_stub_server.url, deadline=0.05)
+        token = batch_request.render('Component.js', {})
+
+        response = asyncio.run(batch_request.submit_async())
+
+        assert response[token.identifier].error.name == 'HypernovaQueryTimeoutError'
+
+    def test_submit_async_with_coalesced_jobs(self, slow_stub_server):
+        coalescer = RenderCoalescer()
+        batch_request = create_batch_request(slow_stub_server.url, coalescer=coalescer)
+        token = batch_request.render('Component.js', {})
+        batch_request.flush()
+        coalesced_batch_request = create_batch_request(slow_stub_server.url, coalescer=coalescer)
+        coalesced_token = coalesced_batch_request.render('Component.js', {})
+
+        response = asyncio.run(coalesced_batch_request.submit_async())
+
+        assert response[coalesced_token.identifier].html == '<div>Component.js</div>'
+        assert batch_request.submit()[token.identifier].html == '<div>Component.js</div>'
+        assert len(slow_stub_server.requests) == 1
+
+    def test_submit_async_waits_on_coalesced_jobs_without_blocking(self, slow_stub_server):
+        coalescer = RenderCoalescer()
+        batch_request = create_batch_request(slow_stub_server.url, coalescer=coalescer)
+        batch_request.render('Component.js', {})
+        batch_request.flush()
+        coalesced_batch_request = create_batch_request(slow_stub_server.url, coalescer=coalescer)
+        coalesced_token = coalesced_batch_request.render('Component.js', {})
+
+        response, ticks = submit_with_ticker(coalesced_batch_request)
+
+        assert response[coalesced_token.identifier].html == '<div>Component.js</div>'
+        assert ticks >= 10
+        batch_request.submit()
+
+    def test_submit_async_retries_without_blocking(self, stub_server):
+        stub_server.responses.append((503, b'Service Unavailable'))
+        retry_policy = RetryPolicy()
+        batch_request = create_batch_request(stub_server.url, retry_policy=retry_policy)
+        token = batch_request.render('Component.js', {})
+
+        with mock.patch('pyramid_hypernova.retries.random.uniform', return_value=0.2):
+            response, ticks = submit_with_ticker(batch_request)
+
+        assert response[token.identifier].html == '<div>Component.js</div>'
+        assert len(stub_server.requests) == 2
+        # the backoff didn't block the event loop
+        assert ticks >= 10
+        assert retry_policy.get_stats() == RetryStats(queries=1, retries=1, budget_exceeded=0)
+
+    def test_submit_async_stops_retrying_once(self, stub_server):
+        stub_server.responses.append((503, b'Service Unavailable'))
+        retry_policy = RetryPolicy(budget_burst=0)
+        batch_request = create_batch_request(stub_server.url, retry_policy=retry_policy)
+        token = batch_request.render('Component.js', {})
+
+        response = asyncio.run(batch_request.submit_async())
+
+        assert response[token.identifier].error.message == 'Service Unavailable'
+        assert len(stub_server.requests) == 1
+        # submit() doesn't ask the retry policy again
+        assert retry_policy.get_stats() == RetryStats(queries=1, retries=0, budget_exceeded=1)
+
+    def test_submit_async_hedges_slow_queries(self, slow_stub_server, stub_server):
+        hedger = create_hedger(0.05)
+        batch_request = create_batch_request([slow_stub_server.url, stub_server.url], hedger=hedger)
+        token = batch_request.render('Component.js', {})
+
+        response, ticks = submit_with_ticker(batch_request)
+
+        assert response[token.identifier].html == '<div>Component.js</div>'
+        assert hedger.get_stats() == HedgeStats(queries=1, hedges=1, wins=1)
+        # the hedge was sent long before the slow server responded
+        assert ticks < 30
+
+    def test_submit_async_does_not_hedge_past_deadline(self, slow_stub_server, stub_server):
+        hedger = create_hedger(0.1)
+        batch_request = create_batch_request([slow_stub_server.url, stub_server.url], hedger=hedger, deadline=0.05)
+        token = batch_request.render('Component.js', {})
+
+        response = asyncio.run(batch_request.submit_async())
+
+        assert response[token.identifier].error.name == 'HypernovaQueryTimeoutError'
+        assert hedger.get_stats() == HedgeStats(queries=1, hedges=0, wins=0)
+        assert stub_server.requests == []
+
+    def test_uses_shared_event_loop_thread(self, stub_server):
+        batch_request = create_batch_request(stub_server.url)
+        batch_request.render('Component.js', {})
+
+        with mock.patch.object(aio, 'event_loop_thread', wraps=aio.event_loop_thread) as spy_event_loop_thread:
+            batch_request.submit()
+
+        assert spy_event_loop_thread.run.call_count == 1
+
+
+class TestHttp2Transport:
+
+    def test_multiplexes_job_groups_over_one_connection(self, http2_stub_server):
+        transport = Http2Transport(prior_knowledge=True)
+        batch_request = create_batch_request(
+            http2_stub_server.url,
+            batch_request_class=BatchRequest,
+            max_batch_size=1,
+            transport=transport,
+        )
+        tokens = [batch_request.render(f'Component{i}.js', {'i': i}) for i in range(4)]
+
+        response = batch_request.submit()
+
+        assert {identifier: result.html for identifier, result in response.items()} == {
+            token.identifier: f'<div>Component{i}.js</div>'
+            for i, token in enumerate(tokens)
+        }
+        assert len(http2_stub_server.requests) == 4
+        assert len(http2_stub_server.connections) == 1
+
+    def test_reuses_connection_between_pages(self, http2_stub_server):
+        transport = Http2Transport(prior_knowledge=True)
+
+        for _ in range(2):
+            query = create_query(http2_stub_server.url, transport=transport)
+            query.send()
+            assert query.json(1)['error'] is None
+
+        assert len(http2_stub_server.requests) == 2
+        assert len(http2_stub_server.connections) == 1
+
+    def test_error_status(self, http2_stub_server):
+        http2_stub_server.responses.append((500, {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}}))
+        query = create_query(http2_stub_server.url, transport=Http2Transport(prior_knowledge=True))
+        query.send()
+
+        with pytest.raises(HypernovaQueryError) as exc_info:
+            query.json()
+
+        assert exc_info.value.error_data == ErrorData('SadError', 'so sad', [])
+
+    def test_falls_back_to_http1_without_prior_knowledge(self, stub_server):
+        query = create_query(stub_server.url, transport=Http2Transport())
+        query.send()
+
+        assert query.json(1)['error'] is None
+
+    def test_client_speaks_http2(self):
+        transport = Http2Transport()
+        loop_thread = transport.get_event_loop_thread()
+
+        assert loop_thread is not aio.event_loop_thread
+        assert (loop_thread.http1, loop_thread.http2) == (True, True)
+        assert Http2Transport(prior_knowledge=True).get_event_loop_thread().http1 is False
+
+    def test_registered(self):
+        assert isinstance(get_transport('http2'), Http2Transport)
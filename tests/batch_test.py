@@ -5,12 +5,30 @@ import pyramid.request
 import pytest
 
 from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.batch import CIRCUIT_OPEN_ERROR
 from pyramid_hypernova.batch import create_fallback_response
 from pyramid_hypernova.batch import create_job_groups
+from pyramid_hypernova.batch import DeduplicationStats
+from pyramid_hypernova.batch import split_job_group_url
+from pyramid_hypernova.cache import CacheStats
+from pyramid_hypernova.cache import RenderCache
+from pyramid_hypernova.circuit_breaker import CircuitBreaker
+from pyramid_hypernova.circuit_breaker import CLOSED
+from pyramid_hypernova.circuit_breaker import HALF_OPEN
+from pyramid_hypernova.circuit_breaker import OPEN
+from pyramid_hypernova.grouping import get_job_grouper
+from pyramid_hypernova.grouping import RenderTimeJobGrouper
+from pyramid_hypernova.hedging import Hedger
 from pyramid_hypernova.plugins import PluginController
 from pyramid_hypernova.rendering import render_blank_markup
 from pyramid_hypernova.request import ErrorData
 from pyramid_hypernova.request import HypernovaQueryError
+from pyramid_hypernova.request import HypernovaQueryTimeoutError
+from pyramid_hypernova.shedding import HIGH_PRIORITY
+from pyramid_hypernova.shedding import LoadShedder
+from pyramid_hypernova.shedding import LoadStats
+from pyramid_hypernova.shedding import LOW_PRIORITY
+from pyramid_hypernova.transports import get_transport
 from pyramid_hypernova.types import HypernovaError
 from pyramid_hypernova.types import Job
 from pyramid_hypernova.types import JobResult
@@ -99,6 +117,22 @@ def test_create_job_groups(max_batch_size, expected):
     assert sizes == expected
 
 
+@pytest.mark.parametrize('job_group_url,expected', [
+    ('http://hypernova-1/batch', ('http://hypernova-1/batch', None)),
+    (['http://hypernova-1/batch'], ('http://hypernova-1/batch', None)),
+    (
+        ('http://hypernova-1/batch', 'http://hypernova-2/batch'),
+        ('http://hypernova-1/batch', 'http://hypernova-2/batch'),
+    ),
+    (
+        ['http://hypernova-1/batch', 'http://hypernova-2/batch', 'http://hypernova-3/batch'],
+        ('http://hypernova-1/batch', 'http://hypernova-2/batch'),
+    ),
+])
+def test_split_job_group_url(job_group_url, expected):
+    assert split_job_group_url(job_group_url) == expected
+
+
 @pytest.fixture
 def spy_plugin_controller():
     plugin_controller = PluginController([])
@@ -196,7 +230,19 @@ class TestBatchRequest:
             batch_count = (jobs_count + (max_batch_size - 1)) // max_batch_size
             assert spy_get_job_group_url.call_count == batch_count
             assert mock_hypernova_query.call_count == batch_count
-            mock_hypernova_query.assert_called_with(mock.ANY, 'http://localhost:8888', mock.ANY, batch_count == 1, {})
+            mock_hypernova_query.assert_called_with(
+                mock.ANY,
+                'http://localhost:8888',
+                mock.ANY,
+                get_transport('requests' if batch_count == 1 else 'fido'),
+                {},
+                timeout=(None, None),
+                coalescer=None,
+                hedge_url=None,
+                hedger=None,
+                retry_policy=None,
+                encoded_payloads=mock.ANY,
+            )
 
         assert response == {
             token_1.identifier: JobResult(
@@ -263,7 +309,19 @@ class TestBatchRequest:
             max_batch_size = batch_request.max_batch_size
             batch_count = (jobs_count + (max_batch_size - 1)) // max_batch_size
             assert mock_hypernova_query.call_count == batch_count
-            mock_hypernova_query.assert_called_with(mock.ANY, mock.ANY, mock.ANY, batch_count == 1, {})
+            mock_hypernova_query.assert_called_with(
+                mock.ANY,
+                mock.ANY,
+                mock.ANY,
+                get_transport('requests' if batch_count == 1 else 'fido'),
+                {},
+                timeout=(None, None),
+                coalescer=None,
+                hedge_url=None,
+                hedger=None,
+                retry_policy=None,
+                encoded_payloads=mock.ANY,
+            )
 
         assert response == {
             token_1.identifier: JobResult(
@@ -312,7 +370,19 @@ class TestBatchRequest:
             max_batch_size = batch_request.max_batch_size
             batch_count = (jobs_count + (max_batch_size - 1)) // max_batch_size
             assert mock_hypernova_query.call_count == batch_count
-            mock_hypernova_query.assert_called_with(mock.ANY, mock.ANY, mock.ANY, batch_count == 1, {})
+            mock_hypernova_query.assert_called_with(
+                mock.ANY,
+                mock.ANY,
+                mock.ANY,
+                get_transport('requests' if batch_count == 1 else 'fido'),
+                {},
+                timeout=(None, None),
+                coalescer=None,
+                hedge_url=None,
+                hedger=None,
+                retry_policy=None,
+                encoded_payloads=mock.ANY,
+            )
 
         assert response == {
             token.identifier: JobResult(
@@ -351,7 +421,19 @@ class TestBatchRequest:
             max_batch_size = batch_request.max_batch_size
             batch_count = (jobs_count + (max_batch_size - 1)) // max_batch_size
             assert mock_hypernova_query.call_count == batch_count
-            mock_hypernova_query.assert_called_with(mock.ANY, mock.ANY, mock.ANY, batch_count == 1, {})
+            mock_hypernova_query.assert_called_with(
+                mock.ANY,
+                mock.ANY,
+                mock.ANY,
+                get_transport('requests' if batch_count == 1 else 'fido'),
+                {},
+                timeout=(None, None),
+                coalescer=None,
+                hedge_url=None,
+                hedger=None,
+                retry_policy=None,
+                encoded_payloads=mock.ANY,
+            )
 
         assert response == {
             token.identifier: JobResult(
@@ -390,7 +472,19 @@ class TestBatchRequest:
             max_batch_size = batch_request.max_batch_size
             batch_count = (jobs_count + (max_batch_size - 1)) // max_batch_size
             assert mock_hypernova_query.call_count == batch_count
-            mock_hypernova_query.assert_called_with(mock.ANY, mock.ANY, mock.ANY, batch_count == 1, {})
+            mock_hypernova_query.assert_called_with(
+                mock.ANY,
+                mock.ANY,
+                mock.ANY,
+                get_transport('requests' if batch_count == 1 else 'fido'),
+                {},
+                timeout=(None, None),
+                coalescer=None,
+                hedge_url=None,
+                hedger=None,
+                retry_policy=None,
+                encoded_payloads=mock.ANY,
+            )
 
         assert response == {
             token.identifier: JobResult(
@@ -429,7 +523,19 @@ class TestBatchRequest:
             max_batch_size = batch_request.max_batch_size
             batch_count = (jobs_count + (max_batch_size - 1)) // max_batch_size
             assert mock_hypernova_query.call_count == batch_count
-            mock_hypernova_query.assert_called_with(mock.ANY, mock.ANY, mock.ANY, batch_count == 1, {})
+            mock_hypernova_query.assert_called_with(
+                mock.ANY,
+                mock.ANY,
+                mock.ANY,
+                get_transport('requests' if batch_count == 1 else 'fido'),
+                {},
+                timeout=(None, None),
+                coalescer=None,
+                hedge_url=None,
+                hedger=None,
+                retry_policy=None,
+                encoded_payloads=mock.ANY,
+            )
 
         assert response == {
             token.identifier: JobResult(
@@ -443,6 +549,1035 @@ class TestBatchRequest:
             ),
         }
 
+    def test_submit_memoizes_results(self, test_data, batch_request, mock_hypernova_query):
+        data = test_data[0]
+        token = batch_request.render('MyComponent.js', data[0])
+
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {
+                token.identifier: {'error': None, 'html': '<div>wow such SSR</div>'},
+            },
+        }
+        first_response = batch_request.submit()
+        second_response = batch_request.submit()
+
+        assert mock_hypernova_query.call_count == 1
+        assert second_response == first_response
+        assert second_response is not batch_request.results
+
+    def test_submit_only_sends_new_jobs(self, spy_plugin_controller, test_data, batch_request, mock_hypernova_query):
+        data = test_data[0]
+        token_1 = batch_request.render('MyComponent1.js', data[0])
+
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {
+                token_1.identifier: {'error': None, 'html': '<div>component 1</div>'},
+            },
+        }
+        batch_request.submit()
+
+        token_2 = batch_request.render('MyComponent2.js', data[1])
+        job_2 = Job(name='MyComponent2.js', data=data[1], context={})
+        mock_hypernova_query.reset_mock()
+        spy_plugin_controller.reset_mock()
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {
+                token_2.identifier: {'error': None, 'html': '<div>component 2</div>'},
+            },
+        }
+        response = batch_request.submit()
+
+        mock_hypernova_query.assert_called_once_with(
+            {token_2.identifier: job_2},
+            mock.ANY,
+            mock.ANY,
+            get_transport('requests'),
+            {},
+            timeout=(None, None),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+        spy_plugin_controller.will_send_request.assert_called_once_with(
+            {token_2.identifier: job_2},
+            batch_request.pyramid_request,
+        )
+        spy_plugin_controller.after_response.assert_called_once_with(
+            {token_2.identifier: JobResult(error=None, html='<div>component 2</div>', job=job_2)},
+            batch_request.pyramid_request,
+        )
+        assert response == {
+            token_1.identifier: JobResult(
+                error=None,
+                html='<div>component 1</div>',
+                job=Job(name='MyComponent1.js', data=data[0], context={}),
+            ),
+            token_2.identifier: JobResult(error=None, html='<div>component 2</div>', job=job_2),
+        }
+
+    def test_flush_sends_jobs_without_waiting(
+        self,
+        spy_plugin_controller,
+        test_data,
+        batch_request,
+        mock_hypernova_query,
+    ):
+        data = test_data[0]
+        token = batch_request.render('MyComponent.js', data[0])
+        job = Job(name='MyComponent.js', data=data[0], context={})
+
+        batch_request.flush()
+
+        mock_hypernova_query.assert_called_once_with(
+            {token.identifier: job},
+            mock.ANY,
+            mock.ANY,
+            get_transport('fido'),
+            {},
+            timeout=(None, None),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+        mock_hypernova_query.return_value.send.assert_called_once_with()
+        assert not mock_hypernova_query.return_value.json.called
+        assert not spy_plugin_controller.after_response.called
+
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {
+                token.identifier: {'error': None, 'html': '<div>wow such SSR</div>'},
+            },
+        }
+        response = batch_request.submit()
+
+        assert mock_hypernova_query.call_count == 1
+        assert response == {
+            token.identifier: JobResult(error=None, html='<div>wow such SSR</div>', job=job),
+        }
+
+    def test_flush_without_new_jobs_does_nothing(self, spy_plugin_controller, batch_request, mock_hypernova_query):
+        batch_request.flush()
+
+        assert not spy_plugin_controller.prepare_request.called
+        assert not mock_hypernova_query.called
+
+    def test_submit_after_flush_falls_back_when_request_cancelled(
+        self,
+        spy_plugin_controller,
+        test_data,
+        batch_request,
+        mock_hypernova_query,
+    ):
+        data = test_data[0]
+        token = batch_request.render('MyComponent.js', data[0])
+        job = Job(name='MyComponent.js', data=data[0], context={})
+        spy_plugin_controller.should_send_request.return_value = False
+
+        batch_request.flush()
+        response = batch_request.submit()
+
+        assert not mock_hypernova_query.called
+        spy_plugin_controller.prepare_request.assert_called_once_with({token.identifier: job}, mock.ANY)
+        assert response == {
+            token.identifier: JobResult(
+                error=None,
+                html=render_blank_markup(token.identifier, job, False, batch_request.json_encoder),
+                job=job,
+            ),
+        }
+
+    def test_send_on_render(self, spy_get_job_group_url, spy_plugin_controller, mock_hypernova_query):
+        batch_request = BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            send_on_render=True,
+        )
+
+        token = batch_request.render('MyComponent.js', {'title': 'sup'})
+
+        mock_hypernova_query.assert_called_once_with(
+            {token.identifier: Job(name='MyComponent.js', data={'title': 'sup'}, context={})},
+            'http://localhost:8888',
+            mock.ANY,
+            get_transport('fido'),
+            {},
+            timeout=(None, None),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+        mock_hypernova_query.return_value.send.assert_called_once_with()
+
+    def test_passes_transport_to_queries(self, spy_get_job_group_url, spy_plugin_controller, mock_hypernova_query):
+        transport = mock.Mock()
+        batch_request = BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            transport=transport,
+        )
+        batch_request.render('MyComponent.js', {})
+
+        batch_request.submit()
+
+        mock_hypernova_query.assert_called_once_with(
+            mock.ANY,
+            mock.ANY,
+            mock.ANY,
+            transport,
+            {},
+            timeout=(None, None),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+
+    def test_passes_registered_transport_to_queries(
+        self,
+        spy_get_job_group_url,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        batch_request = BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            max_batch_size=1,
+            transport='thread_pool',
+        )
+        batch_request.render('MyComponent1.js', {})
+        batch_request.render('MyComponent2.js', {})
+
+        batch_request.submit()
+
+        assert batch_request.transport is get_transport('thread_pool')
+        mock_hypernova_query.assert_called_with(
+            mock.ANY,
+            mock.ANY,
+            mock.ANY,
+            get_transport('thread_pool'),
+            {},
+            timeout=(None, None),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+
+    @pytest.mark.parametrize('url,concurrent,transport_name', [
+        ('http://localhost:8888', False, 'requests'),
+        ('http://localhost:8888', True, 'fido'),
+        ('unix:///var/run/hypernova.sock', False, 'unix'),
+        ('unix:///var/run/hypernova.sock', True, 'unix'),
+    ])
+    def test_choose_default_transport(self, batch_request, url, concurrent, transport_name):
+        assert batch_request.choose_transport(url, concurrent) is get_transport(transport_name)
+
+    def test_choose_configured_transport(self, spy_get_job_group_url, spy_plugin_controller):
+        batch_request = BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            transport='thread_pool',
+        )
+
+        assert batch_request.choose_transport('unix:///var/run/hypernova.sock', False) is get_transport('thread_pool')
+
+
+class TestBatchRequestDeadline:
+
+    @pytest.fixture
+    def mock_monotonic(self):
+        with mock.patch('pyramid_hypernova.batch.time.monotonic', return_value=100) as mock_monotonic:
+            yield mock_monotonic
+
+    @pytest.fixture
+    def batch_request(self, spy_get_job_group_url, spy_plugin_controller):
+        return BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            max_batch_size=1,
+            connect_timeout=0.1,
+            read_timeout=2,
+            deadline=1.5,
+        )
+
+    def test_passes_timeouts_to_queries(self, batch_request, mock_hypernova_query, mock_monotonic):
+        batch_request.render('MyComponent.js', {})
+
+        batch_request.submit()
+
+        mock_hypernova_query.assert_called_once_with(
+            mock.ANY,
+            mock.ANY,
+            mock.ANY,
+            get_transport('requests'),
+            {},
+            timeout=(0.1, 2),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+
+    def test_waits_for_remaining_time(self, batch_request, mock_hypernova_query, mock_monotonic):
+        batch_request.render('MyComponent1.js', {})
+        batch_request.render('MyComponent2.js', {})
+
+        def json(timeout):
+            mock_monotonic.return_value += 1
+            return {'error': None, 'results': {}}
+
+        batch_request.flush()
+        mock_monotonic.return_value = 100.5
+        mock_hypernova_query.return_value.json.side_effect = json
+        batch_request.submit()
+
+        assert mock_hypernova_query.return_value.json.call_args_list == [
+            mock.call(timeout=1),
+            mock.call(timeout=0),
+        ]
+
+    def test_no_deadline(self, spy_get_job_group_url, spy_plugin_controller, mock_hypernova_query):
+        batch_request = BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+        )
+        batch_request.render('MyComponent.js', {})
+
+        batch_request.submit()
+
+        mock_hypernova_query.return_value.json.assert_called_once_with(timeout=None)
+
+    def test_falls_back_on_timeout(self, spy_plugin_controller, batch_request, mock_hypernova_query, mock_monotonic):
+        token = batch_request.render('MyComponent.js', {})
+        job = Job(name='MyComponent.js', data={}, context={})
+        mock_hypernova_query.return_value.json.side_effect = HypernovaQueryTimeoutError('too slow')
+
+        response = batch_request.submit()
+
+        error = HypernovaError(name='HypernovaQueryTimeoutError', message='too slow', stack=mock.ANY)
+        spy_plugin_controller.on_error.assert_called_once_with(error, {token.identifier: job}, mock.ANY)
+        assert response == {
+            token.identifier: JobResult(
+                error=error,
+                html=render_blank_markup(token.identifier, job, True, batch_request.json_encoder),
+                job=job,
+            ),
+        }
+
+
+class TestBatchRequestRenderCache:
+
+    @pytest.fixture
+    def render_cache(self):
+        return RenderCache(components={'Header.js'})
+
+    @pytest.fixture
+    def create_batch_request(self, spy_get_job_group_url, spy_plugin_controller, render_cache):
+        def create_batch_request():
+            return BatchRequest(
+                get_job_group_url=spy_get_job_group_url,
+                plugin_controller=spy_plugin_controller,
+                pyramid_request=pyramid.request.Request.blank('/'),
+                render_cache=render_cache,
+            )
+        return create_batch_request
+
+    def render_header(self, mock_hypernova_query, batch_request, result=None):
+        token = batch_request.render('Header.js', {'title': 'sup'})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {
+                token.identifier: result or {'error': None, 'html': f'<div data-hypernova-id="{token.identifier}"/>'},
+            },
+        }
+        return token, batch_request.submit()
+
+    def test_cache_hit_is_not_sent(
+        self,
+        create_batch_request,
+        render_cache,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        self.render_header(mock_hypernova_query, create_batch_request())
+        mock_hypernova_query.reset_mock()
+        spy_plugin_controller.reset_mock()
+
+        batch_request = create_batch_request()
+        token = batch_request.render('Header.js', {'title': 'sup'})
+        response = batch_request.submit()
+
+        assert not mock_hypernova_query.called
+        assert not spy_plugin_controller.should_send_request.called
+        assert response == {
+            token.identifier: JobResult(
+                error=None,
+                html=f'<div data-hypernova-id="{token.identifier}"/>',
+                job=Job(name='Header.js', data={'title': 'sup'}, context={}),
+            ),
+        }
+        spy_plugin_controller.after_response.assert_called_once_with(response, mock.ANY)
+        assert render_cache.get_stats() == CacheStats(hits=1, misses=1)
+        assert batch_request.submit() == response
+
+    def test_cache_miss_is_sent_with_other_jobs(self, create_batch_request, mock_hypernova_query):
+        self.render_header(mock_hypernova_query, create_batch_request())
+        mock_hypernova_query.reset_mock()
+        mock_hypernova_query.return_value.json.return_value = {'error': None, 'results': {}}
+
+        batch_request = create_batch_request()
+        batch_request.render('Header.js', {'title': 'sup'})
+        token = batch_request.render('Header.js', {'title': 'yo'})
+        profile_token = batch_request.render('Profile.js', {})
+        batch_request.submit()
+
+        mock_hypernova_query.assert_called_once_with(
+            {
+                token.identifier: Job(name='Header.js', data={'title': 'yo'}, context={}),
+                profile_token.identifier: Job(name='Profile.js', data={}, context={}),
+            },
+            mock.ANY,
+            mock.ANY,
+            mock.ANY,
+            {},
+            timeout=(None, None),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+
+    @pytest.mark.parametrize('result', [
+        {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}, 'html': '<div/>'},
+        {'error': None, 'html': None},
+    ])
+    def test_failed_renders_are_not_cached(self, create_batch_request, render_cache, mock_hypernova_query, result):
+        self.render_header(mock_hypernova_query, create_batch_request(), result)
+
+        self.render_header(mock_hypernova_query, create_batch_request())
+
+        assert mock_hypernova_query.call_count == 2
+        assert render_cache.get_stats() == CacheStats(hits=0, misses=2)
+
+    def test_fallback_renders_are_not_cached(self, create_batch_request, render_cache, mock_hypernova_query):
+        mock_hypernova_query.return_value.json.side_effect = HypernovaQueryError('oh no')
+        batch_request = create_batch_request()
+        batch_request.render('Header.js', {'title': 'sup'})
+        batch_request.submit()
+
+        assert not render_cache.backend.entries
+
+
+class TestBatchRequestStaleIfError:
+
+    @pytest.fixture
+    def render_cache(self):
+        # HTML goes stale as soon as it's cached
+        render_cache = RenderCache(components={'Header.js'}, ttl=0, stale_ttl=3600)
+        with mock.patch.object(render_cache, 'revalidate'):
+            yield render_cache
+
+    @pytest.fixture
+    def create_batch_request(self, spy_get_job_group_url, spy_plugin_controller, render_cache, mock_hypernova_query):
+        def create_batch_request():
+            return BatchRequest(
+                get_job_group_url=spy_get_job_group_url,
+                plugin_controller=spy_plugin_controller,
+                pyramid_request=pyramid.request.Request.blank('/'),
+                render_cache=render_cache,
+            )
+
+        batch_request = create_batch_request()
+        token = batch_request.render('Header.js', {'title': 'sup'})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {token.identifier: {'error': None, 'html': f'<div data-hypernova-id="{token.identifier}"/>'}},
+        }
+        batch_request.submit()
+        mock_hypernova_query.reset_mock()
+        spy_plugin_controller.reset_mock()
+        return create_batch_request
+
+    def test_serves_stale_html_on_query_error(
+        self,
+        create_batch_request,
+        render_cache,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        mock_hypernova_query.return_value.json.side_effect = HypernovaQueryTimeoutError('too slow')
+        batch_request = create_batch_request()
+        token = batch_request.render('Header.js', {'title': 'sup'})
+
+        response = batch_request.submit()
+
+        job = Job(name='Header.js', data={'title': 'sup'}, context={})
+        stale_error = HypernovaError(
+            name='HypernovaStaleRenderError',
+            message='Served stale HTML after HypernovaQueryTimeoutError: too slow',
+            stack=mock.ANY,
+        )
+        assert mock_hypernova_query.called
+        assert response == {
+            token.identifier: JobResult(
+                error=stale_error,
+                html=f'<div data-hypernova-id="{token.identifier}"/>',
+                job=job,
+            ),
+        }
+        spy_plugin_controller.on_error.assert_called_once_with(stale_error, {token.identifier: job}, mock.ANY)
+        render_cache.revalidate.assert_called_once_with(
+            {token.identifier: job},
+            {token.identifier: mock.ANY},
+            batch_request.send_revalidation_query,
+            batch_request.record_query_result,
+        )
+        assert render_cache.get_stats() == CacheStats(hits=0, misses=2, stale_hits=1)
+
+    def test_falls_back_for_jobs_without_stale_html(
+        self,
+        create_batch_request,
+        render_cache,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        error = {'name': 'SadError', 'message': 'so sad', 'stack': []}
+        mock_hypernova_query.return_value.json.return_value = {'error': error, 'results': {}}
+        batch_request = create_batch_request()
+        header_token = batch_request.render('Header.js', {'title': 'sup'})
+        profile_token = batch_request.render('Profile.js', {})
+
+        response = batch_request.submit()
+
+        profile_job = Job(name='Profile.js', data={}, context={})
+        assert response[header_token.identifier].error.name == 'HypernovaStaleRenderError'
+        assert response[header_token.identifier].html == f'<div data-hypernova-id="{header_token.identifier}"/>'
+        assert response[profile_token.identifier] == JobResult(
+            error=HypernovaError(**error),
+            html=render_blank_markup(profile_token.identifier, profile_job, True, batch_request.json_encoder),
+            job=profile_job,
+        )
+        assert spy_plugin_controller.on_error.call_args_list == [
+            mock.call(response[header_token.identifier].error, mock.ANY, mock.ANY),
+            mock.call(HypernovaError(**error), {profile_token.identifier: profile_job}, mock.ANY),
+        ]
+
+    def test_send_revalidation_query(self, create_batch_request, mock_hypernova_query):
+        batch_request = create_batch_request()
+        job_group = {'id-1': Job(name='Header.js', data={'title': 'sup'}, context={})}
+
+        query = batch_request.send_revalidation_query(job_group)
+
+        assert query is mock_hypernova_query.return_value
+        mock_hypernova_query.assert_called_once_with(
+            job_group,
+            'http://localhost:8888',
+            mock.ANY,
+            get_transport('fido'),
+            {},
+            timeout=(None, None),
+            coalescer=None,
+            hedge_url=None,
+            hedger=None,
+            retry_policy=None,
+            encoded_payloads=mock.ANY,
+        )
+        query.send.assert_called_once_with()
+
+
+class TestBatchRequestJobGrouper:
+
+    def test_groups_jobs_with_job_grouper(self, spy_get_job_group_url, spy_plugin_controller, mock_hypernova_query):
+        job_grouper = mock.Mock(wraps=RenderTimeJobGrouper())
+        batch_request = BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            max_batch_size=2,
+            max_batch_bytes=1000,
+            job_grouper=job_grouper,
+        )
+        token = batch_request.render('Grid.js', {})
+        button_token = batch_request.render('Button.js', {})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {
+                token.identifier: {'error': None, 'html': '<div/>', 'duration': 50},
+                button_token.identifier: {'error': None, 'html': '<button/>'},
+            },
+        }
+
+        batch_request.submit()
+
+        job_grouper.group_jobs.assert_called_once_with(
+            {
+                token.identifier: Job(name='Grid.js', data={}, context={}),
+                button_token.identifier: Job(name='Button.js', data={}, context={}),
+            },
+            2,
+            1000,
+            batch_request.json_encoder,
+        )
+        job_grouper.record_render_time.assert_called_once_with('Grid.js', 50)
+
+    def test_job_grouper_by_name(self, spy_get_job_group_url, spy_plugin_controller):
+        batch_request = BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            job_grouper='render_time',
+        )
+
+        assert batch_request.job_grouper is get_job_grouper('render_time')
+
+
+class TestBatchRequestDeduplication:
+
+    @pytest.fixture
+    def batch_request(self, spy_get_job_group_url, spy_plugin_controller):
+        return BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+        )
+
+    def test_identical_jobs_are_sent_once(self, batch_request, spy_plugin_controller, mock_hypernova_query):
+        tokens = [batch_request.render('ReviewStars.js', {'rating': 4}) for __ in range(3)]
+        other_token = batch_request.render('ReviewStars.js', {'rating': 5})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {
+                tokens[0].identifier: {
+                    'error': None,
+                    'html': f'<div data-hypernova-id="{tokens[0].identifier}">4</div>',
+                    'duration': 2.5,
+                },
+                other_token.identifier: {'error': None, 'html': '<div>5</div>'},
+            },
+        }
+
+        response = batch_request.submit()
+
+        job = Job(name='ReviewStars.js', data={'rating': 4}, context={})
+        other_job = Job(name='ReviewStars.js', data={'rating': 5}, context={})
+        assert mock_hypernova_query.call_args[0][0] == {tokens[0].identifier: job, other_token.identifier: other_job}
+        spy_plugin_controller.will_send_request.assert_called_once_with(
+            {tokens[0].identifier: job, other_token.identifier: other_job},
+            mock.ANY,
+        )
+        assert response == {
+            **{
+                token.identifier: JobResult(
+                    error=None,
+                    html=f'<div data-hypernova-id="{token.identifier}">4</div>',
+                    job=job,
+                )
+                for token in tokens
+            },
+            other_token.identifier: JobResult(error=None, html='<div>5</div>', job=other_job),
+        }
+        duplicate_bytes = len(f'{{"{tokens[1].identifier}": {{"name": "ReviewStars.js", "data": {{"rating": 4}}, '
+                              '"context": {}}}'.encode('utf-8'))
+        assert batch_request.get_deduplication_stats() == DeduplicationStats(
+            jobs=2,
+            bytes=2 * duplicate_bytes,
+            render_ms=5,
+        )
+
+    def test_props_with_keys_that_cant_be_sorted(self, batch_request, mock_hypernova_query):
+        token = batch_request.render('Grid.js', {1: 'x', 'b': 2})
+        duplicate_token = batch_request.render('Grid.js', {1: 'x', 'b': 2})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {token.identifier: {'error': None, 'html': f'<div data-hypernova-id="{token.identifier}"/>'}},
+        }
+
+        response = batch_request.submit()
+
+        assert mock_hypernova_query.call_args[0][0] == {token.identifier: Job('Grid.js', {1: 'x', 'b': 2}, {})}
+        encoded_payloads = mock_hypernova_query.call_args[1]['encoded_payloads']
+        assert encoded_payloads[token.identifier].payload == (
+            '{"name": "Grid.js", "data": {"1": "x", "b": 2}, "context": {}}'
+        )
+        assert response[duplicate_token.identifier].html == f'<div data-hypernova-id="{duplicate_token.identifier}"/>'
+
+    def test_jobs_identical_to_submitted_jobs_are_not_sent(self, batch_request, mock_hypernova_query):
+        token = batch_request.render('ReviewStars.js', {'rating': 4})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {token.identifier: {'error': None, 'html': f'<div data-hypernova-id="{token.identifier}"/>'}},
+        }
+        batch_request.submit()
+        mock_hypernova_query.reset_mock()
+
+        duplicate_token = batch_request.render('ReviewStars.js', {'rating': 4})
+        response = batch_request.submit()
+
+        assert not mock_hypernova_query.called
+        assert response[duplicate_token.identifier].html == f'<div data-hypernova-id="{duplicate_token.identifier}"/>'
+        assert batch_request.get_deduplication_stats().render_ms == 0
+
+    def test_errors_are_fanned_out(self, batch_request, spy_plugin_controller, mock_hypernova_query):
+        mock_hypernova_query.return_value.json.side_effect = HypernovaQueryError('so sad')
+        token = batch_request.render('ReviewStars.js', {'rating': 4})
+        duplicate_token = batch_request.render('ReviewStars.js', {'rating': 4})
+
+        response = batch_request.submit()
+
+        job = Job(name='ReviewStars.js', data={'rating': 4}, context={})
+        assert response[duplicate_token.identifier] == JobResult(
+            error=response[token.identifier].error,
+            html=render_blank_markup(duplicate_token.identifier, job, True, batch_request.json_encoder),
+            job=job,
+        )
+        spy_plugin_controller.on_error.assert_called_once_with(mock.ANY, {token.identifier: job}, mock.ANY)
+
+    def test_fallbacks_are_fanned_out(self, batch_request, spy_plugin_controller, mock_hypernova_query):
+        spy_plugin_controller.should_send_request.return_value = False
+        token = batch_request.render('ReviewStars.js', {'rating': 4})
+        duplicate_token = batch_request.render('ReviewStars.js', {'rating': 4})
+
+        response = batch_request.submit()
+
+        job = Job(name='ReviewStars.js', data={'rating': 4}, context={})
+        assert not mock_hypernova_query.called
+        assert response == create_fallback_response(
+            {token.identifier: job, duplicate_token.identifier: job},
+            False,
+            batch_request.json_encoder,
+        )
+
+
+class TestBatchRequestCircuitBreaker:
+
+    @pytest.fixture
+    def circuit_breaker(self):
+        return CircuitBreaker(minimum_queries=2, open_timeout=30)
+
+    @pytest.fixture
+    def create_batch_request(
+        self,
+        spy_get_job_group_url,
+        spy_plugin_controller,
+        circuit_breaker,
+        mock_hypernova_query,
+    ):
+        mock_hypernova_query.return_value.url = 'http://localhost:8888'
+        mock_hypernova_query.return_value.network_time = 0.01
+
+        def create_batch_request(render_cache=None):
+            return BatchRequest(
+                get_job_group_url=spy_get_job_group_url,
+                plugin_controller=spy_plugin_controller,
+                pyramid_request=pyramid.request.Request.blank('/'),
+                render_cache=render_cache,
+                circuit_breaker=circuit_breaker,
+            )
+        return create_batch_request
+
+    def fail_queries(self, create_batch_request, mock_hypernova_query, count):
+        mock_hypernova_query.return_value.json.side_effect = HypernovaQueryError('oh no')
+        for __ in range(count):
+            batch_request = create_batch_request()
+            batch_request.render('MyComponent.js', {})
+            batch_request.submit()
+        mock_hypernova_query.reset_mock()
+        mock_hypernova_query.return_value.json.side_effect = None
+
+    def test_opens_on_failed_queries(
+        self,
+        create_batch_request,
+        circuit_breaker,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        self.fail_queries(create_batch_request, mock_hypernova_query, 1)
+        assert circuit_breaker.get_state() == CLOSED
+
+        self.fail_queries(create_batch_request, mock_hypernova_query, 1)
+
+        assert circuit_breaker.get_state() == OPEN
+        spy_plugin_controller.on_circuit_state_change.assert_called_once_with(
+            'http://localhost:8888',
+            CLOSED,
+            OPEN,
+            mock.ANY,
+        )
+
+    def test_opens_on_job_group_errors(self, create_batch_request, circuit_breaker, mock_hypernova_query):
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': {'name': 'SadError', 'message': 'so sad', 'stack': []},
+            'results': {},
+        }
+        for __ in range(2):
+            batch_request = create_batch_request()
+            batch_request.render('MyComponent.js', {})
+            batch_request.submit()
+
+        assert circuit_breaker.get_state() == OPEN
+
+    def test_does_not_query_while_open(
+        self,
+        create_batch_request,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        self.fail_queries(create_batch_request, mock_hypernova_query, 2)
+        spy_plugin_controller.reset_mock()
+
+        batch_request = create_batch_request()
+        token = batch_request.render('MyComponent.js', {})
+        response = batch_request.submit()
+
+        job = Job(name='MyComponent.js', data={}, context={})
+        assert not mock_hypernova_query.called
+        assert response == {
+            token.identifier: JobResult(
+                error=CIRCUIT_OPEN_ERROR,
+                html=render_blank_markup(token.identifier, job, True, batch_request.json_encoder),
+                job=job,
+            ),
+        }
+        spy_plugin_controller.on_error.assert_called_once_with(CIRCUIT_OPEN_ERROR, {token.identifier: job}, mock.ANY)
+        assert not spy_plugin_controller.on_metrics.called
+
+    def test_probe_closes_the_circuit(
+        self,
+        create_batch_request,
+        circuit_breaker,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        with mock.patch('pyramid_hypernova.circuit_breaker.time.monotonic', return_value=100) as mock_monotonic:
+            self.fail_queries(create_batch_request, mock_hypernova_query, 2)
+            spy_plugin_controller.reset_mock()
+            mock_monotonic.return_value = 130
+
+            batch_request = create_batch_request()
+            token = batch_request.render('MyComponent.js', {})
+            mock_hypernova_query.return_value.json.return_value = {
+                'error': None,
+                'results': {token.identifier: {'error': None, 'html': '<div/>'}},
+            }
+            response = batch_request.submit()
+
+        assert response[token.identifier].html == '<div/>'
+        assert circuit_breaker.get_state() == CLOSED
+        assert spy_plugin_controller.on_circuit_state_change.call_args_list == [
+            mock.call('http://localhost:8888', OPEN, HALF_OPEN, batch_request.pyramid_request),
+            mock.call('http://localhost:8888', HALF_OPEN, CLOSED, batch_request.pyramid_request),
+        ]
+
+    def test_serves_stale_html_without_revalidating(self, create_batch_request, mock_hypernova_query):
+        render_cache = RenderCache(components={'Header.js'}, ttl=0, stale_ttl=3600)
+        batch_request = create_batch_request(render_cache)
+        token = batch_request.render('Header.js', {'title': 'sup'})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {token.identifier: {'error': None, 'html': f'<div data-hypernova-id="{token.identifier}"/>'}},
+        }
+        batch_request.submit()
+        self.fail_queries(create_batch_request, mock_hypernova_query, 2)
+
+        batch_request = create_batch_request(render_cache)
+        token = batch_request.render('Header.js', {'title': 'sup'})
+        with mock.patch.object(render_cache, 'revalidate') as mock_revalidate:
+            response = batch_request.submit()
+
+        assert not mock_hypernova_query.called
+        assert response[token.identifier].html == f'<div data-hypernova-id="{token.identifier}"/>'
+        assert response[token.identifier].error.message == (
+            'Served stale HTML after HypernovaCircuitOpenError: '
+            'Not querying Hypernova while its circuit breaker is open'
+        )
+        assert not mock_revalidate.called
+
+    def test_revalidation_queries_wait_for_the_circuit_to_close(self, create_batch_request, mock_hypernova_query):
+        job_group = {'id-1': Job(name='Header.js', data={'title': 'sup'}, context={})}
+        self.fail_queries(create_batch_request, mock_hypernova_query, 2)
+
+        assert create_batch_request().send_revalidation_query(job_group) is None
+        assert not mock_hypernova_query.called
+
+    def test_records_revalidation_queries(self, create_batch_request, circuit_breaker, mock_hypernova_query):
+        render_cache = RenderCache(components={'Header.js'}, ttl=0, stale_ttl=3600)
+        batch_request = create_batch_request(render_cache)
+        token = batch_request.render('Header.js', {'title': 'sup'})
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': None,
+            'results': {token.identifier: {'error': None, 'html': f'<div data-hypernova-id="{token.identifier}"/>'}},
+        }
+        batch_request.submit()
+
+        # the stale HTML is served, and its revalidation fails too
+        mock_hypernova_query.return_value.json.side_effect = HypernovaQueryError('oh no')
+        batch_request = create_batch_request(render_cache)
+        batch_request.render('Header.js', {'title': 'sup'})
+        with mock.patch.object(circuit_breaker, 'record_result') as mock_record_result:
+            batch_request.submit()
+            render_cache.get_executor().submit(lambda: None).result()
+
+        assert mock_record_result.call_count == 2
+        mock_record_result.assert_has_calls([
+            mock.call('http://localhost:8888', True, 0.01, batch_request.on_circuit_state_change),
+            mock.call('http://localhost:8888', True, 0.01, None),
+        ], any_order=True)
+
+    def test_unsent_queries_are_not_recorded(self, create_batch_request, circuit_breaker, mock_hypernova_query):
+        mock_hypernova_query.return_value.was_sent.return_value = False
+        mock_hypernova_query.return_value.json.return_value = {
+            'error': {'name': 'SadError', 'message': 'so sad', 'stack': []},
+            'results': {},
+        }
+        for __ in range(2):
+            batch_request = create_batch_request()
+            batch_request.render('MyComponent.js', {})
+            batch_request.submit()
+
+        assert circuit_breaker.get_state() == CLOSED
+
+
+class TestBatchRequestLoadShedding:
+
+    @pytest.fixture
+    def load_shedder(self):
+        return LoadShedder(target_latency=0.2)
+
+    @pytest.fixture
+    def batch_request(self, spy_get_job_group_url, spy_plugin_controller, load_shedder, mock_hypernova_query):
+        mock_hypernova_query.return_value.network_time = 0.3
+        mock_hypernova_query.return_value.json.return_value = {'error': None, 'results': {}}
+        return BatchRequest(
+            get_job_group_url=spy_get_job_group_url,
+            plugin_controller=spy_plugin_controller,
+            pyramid_request=pyramid.request.Request.blank('/'),
+            load_shedder=load_shedder,
+        )
+
+    def test_sends_every_job_without_pressure(self, batch_request, mock_hypernova_query):
+        token = batch_request.render('Footer.js', {}, priority=LOW_PRIORITY)
+
+        batch_request.submit()
+
+        assert list(mock_hypernova_query.call_args[0][0]) == [token.identifier]
+
+    def test_sheds_low_priority_jobs_under_pressure(
+        self,
+        batch_request,
+        load_shedder,
+        spy_plugin_controller,
+        mock_hypernova_query,
+    ):
+        load_shedder.finish_query(load_shedder.start_query(), 0.3)
+        header_token = batch_request.render('Header.js', {}, priority=HIGH_PRIORITY)
+        body_token = batch_request.render('Body.js', {})
+        footer_token = batch_request.render('Footer.js', {}, priority=LOW_PRIORITY)
+
+        response = batch_request.submit()
+
+        footer_job = Job(name='Footer.js', data={}, context={})
+        assert list(mock_hypernova_query.call_args[0][0]) == [header_token.identifier, body_token.identifier]
+        assert response[footer_token.identifier] == JobResult(
+            error=None,
+            html=render_blank_markup(footer_token.identifier, footer_job, False, batch_request.json_encoder),
+            job=footer_job,
+        )
+        assert not spy_plugin_controller.on_error.called
+        assert load_shedder.get_stats().shed == 1
+
+    def test_sheds_every_job(self, batch_request, load_shedder, spy_plugin_controller, mock_hypernova_query):
+        load_shedder.finish_query(load_shedder.start_query(), 1)
+        token = batch_request.render('Body.js', {})
+
+        response = batch_request.submit()
+
+        assert not mock_hypernova_query.called
+        assert not spy_plugin_controller.will_send_request.called
+        assert response[token.identifier].error is None
+
+    def test_duplicates_raise_the_priority_of_the_job_sent(self, batch_request, load_shedder, mock_hypernova_query):
+        load_shedder.finish_query(load_shedder.start_query(), 0.3)
+        low_token = batch_request.render('ReviewStars.js', {'rating': 4}, priority=LOW_PRIORITY)
+        batch_request.render('ReviewStars.js', {'rating': 4}, priority=HIGH_PRIORITY)
+
+        batch_request.submit()
+
+        assert list(mock_hypernova_query.call_args[0][0]) == [low_token.identifier]
+
+    def test_records_query_latency(self, batch_request, load_shedder, mock_hypernova_query):
+        batch_request.render('Body.js', {})
+
+        batch_request.flush()
+        assert load_shedder.get_stats() == LoadStats(latency=None, in_flight=1, shed=0)
+
+        batch_request.submit()
+        assert load_shedder.get_stats() == LoadStats(latency=0.3, in_flight=0, shed=0)
+
+    def test_coalesced_queries_are_not_recorded(self, batch_request, load_shedder, mock_hypernova_query):
+        mock_hypernova_query.return_value.response = None
+        batch_request.render('Body.js', {})
+
+        batch_request.submit()
+
+        assert load_shedder.get_stats() == LoadStats(latency=None, in_flight=0, shed=0)
+
+    def test_unsent_queries_are_not_recorded(self, batch_request, load_shedder, mock_hypernova_query):
+        mock_hypernova_query.return_value.was_sent.return_value = False
+        batch_request.render('Body.js', {})
+        batch_request.flush()
+        assert load_shedder.get_stats() == LoadStats(latency=None, in_flight=1, shed=0)
+
+        batch_request.submit()
+
+        assert load_shedder.get_stats() == LoadStats(latency=None, in_flight=0, shed=0)
+
+
+def test_hedges_queries_to_the_second_url(spy_plugin_controller, mock_hypernova_query):
+    hedger = Hedger()
+    batch_request = BatchRequest(
+        get_job_group_url=lambda job_group, pyramid_request: ['http://hypernova-1/batch', 'http://hypernova-2/batch'],
+        plugin_controller=spy_plugin_controller,
+        pyramid_request=pyramid.request.Request.blank('/'),
+        hedger=hedger,
+    )
+    batch_request.render('MyComponent.js', {})
+
+    batch_request.submit()
+
+    mock_hypernova_query.assert_called_once_with(
+        mock.ANY,
+        'http://hypernova-1/batch',
+        mock.ANY,
+        get_transport('requests'),
+        {},
+        timeout=(None, None),
+        coalescer=None,
+        hedge_url='http://hypernova-2/batch',
+        hedger=hedger,
+        retry_policy=None,
+        encoded_payloads=mock.ANY,
+    )
+
 
 class TestBatchRequestLifecycleMethods:
     """Test that BatchRequest calls plugin lifecycle methods at the
@@ -0,0 +1,444 @@
+import json
+import socket
+import time
+import zlib
+from json import JSONEncoder
+from unittest import mock
+
+import pytest
+
+from pyramid_hypernova.cache import CachedRender
+from pyramid_hypernova.cache import CacheError
+from pyramid_hypernova.cache import CacheStats
+from pyramid_hypernova.cache import get_job_key
+from pyramid_hypernova.cache import LRUCacheBackend
+from pyramid_hypernova.cache import MemcachedCacheBackend
+from pyramid_hypernova.cache import MemcachedConnection
+from pyramid_hypernova.cache import RenderCache
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.types import Job
+from pyramid_hypernova.types import JobResult
+from testing.json_encoder import ComplexJSONEncoder
+from testing.memcached_server import StubMemcachedServer
+
+HEADER_JOB = Job('Header.js', {'title': 'sup', 'links': ['home', 'about']}, {'locale': 'en_US'})
+
+
+@pytest.fixture
+def mock_monotonic():
+    with mock.patch('pyramid_hypernova.cache.time.monotonic', return_value=100) as mock_monotonic:
+        yield mock_monotonic
+
+
+@pytest.fixture
+def mock_time():
+    with mock.patch('pyramid_hypernova.cache.time.time', return_value=1000) as mock_time:
+        yield mock_time
+
+
+@pytest.fixture
+def memcached_server():
+    with StubMemcachedServer() as memcached_server:
+        yield memcached_server
+
+
+@pytest.fixture
+def unused_address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+class TestGetJobKey:
+
+    def test_same_job_same_key(self):
+        job = Job('Header.js', {'links': ['home', 'about'], 'title': 'sup'}, {'locale': 'en_US'})
+
+        assert get_job_key(job, JSONEncoder()) == get_job_key(HEADER_JOB, JSONEncoder())
+
+    @pytest.mark.parametrize('job', [
+        HEADER_JOB._replace(name='Footer.js'),
+        HEADER_JOB._replace(data={'title': 'sup'}),
+        HEADER_JOB._replace(context={'locale': 'fr_FR'}),
+    ])
+    def test_different_job_different_key(self, job):
+        assert get_job_key(job, JSONEncoder()) != get_job_key(HEADER_JOB, JSONEncoder())
+
+    def test_uses_json_encoder(self):
+        job = Job('Chart.js', {'point': 1 + 2j}, {})
+
+        expected_key = get_job_key(job._replace(data={'point': [1.0, 2.0]}), JSONEncoder())
+        assert get_job_key(job, ComplexJSONEncoder()) == expected_key
+
+        with pytest.raises(TypeError):
+            get_job_key(job, JSONEncoder())
+
+    def test_keys_that_cant_be_sorted(self):
+        job = Job('Grid.js', {1: 'x', 'b': 2}, {})
+
+        assert get_job_key(job, JSONEncoder()) == get_job_key(job._replace(data={1: 'x', 'b': 2}), JSONEncoder())
+        assert get_job_key(job, JSONEncoder()) != get_job_key(job._replace(data={1: 'y', 'b': 2}), JSONEncoder())
+
+
+class TestLRUCacheBackend:
+
+    def test_get_many(self):
+        backend = LRUCacheBackend()
+        backend.set_many({'a': 1, 'b': 2}, ttl=60)
+
+        assert backend.get_many(['a', 'c']) == {'a': 1}
+
+    def test_expires_entries(self, mock_monotonic):
+        backend = LRUCacheBackend()
+        backend.set_many({'a': 1}, ttl=60)
+
+        mock_monotonic.return_value = 160
+
+        assert backend.get_many(['a']) == {}
+        assert 'a' not in backend.entries
+
+    def test_evicts_least_recently_used(self):
+        backend = LRUCacheBackend(max_size=2)
+        backend.set_many({'a': 1, 'b': 2}, ttl=60)
+        backend.get_many(['a'])
+
+        backend.set_many({'c': 3}, ttl=60)
+
+        assert backend.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+
+
+class TestRenderCache:
+
+    def test_should_cache_component_names(self):
+        render_cache = RenderCache(components={'Header.js'})
+
+        assert render_cache.should_cache(HEADER_JOB)
+        assert not render_cache.should_cache(HEADER_JOB._replace(name='Profile.js'))
+
+    def test_should_cache_callable(self):
+        render_cache = RenderCache(components=lambda job: not job.data.get('user'))
+
+        assert render_cache.should_cache(HEADER_JOB)
+        assert not render_cache.should_cache(HEADER_JOB._replace(data={'user': 'darwin'}))
+
+    def test_get_keys_of_cacheable_jobs(self):
+        render_cache = RenderCache(components={'Header.js'})
+        jobs = {'id-1': HEADER_JOB, 'id-2': HEADER_JOB._replace(name='Profile.js')}
+
+        assert render_cache.get_keys(jobs, JSONEncoder()) == {'id-1': get_job_key(HEADER_JOB, JSONEncoder())}
+
+    def test_cached_results_are_rendered_for_their_identifier(self):
+        render_cache = RenderCache(components={'Header.js'})
+        render_cache.set_results(
+            {'id-1': JobResult(error=None, html='<div data-hypernova-id="id-1">sup</div>', job=HEADER_JOB)},
+            {'id-1': 'key'},
+        )
+
+        results = render_cache.get_results({'id-2': HEADER_JOB, 'id-3': HEADER_JOB}, {'id-2': 'key', 'id-3': 'key'})
+
+        assert results == {
+            'id-2': JobResult(error=None, html='<div data-hypernova-id="id-2">sup</div>', job=HEADER_JOB),
+            'id-3': JobResult(error=None, html='<div data-hypernova-id="id-3">sup</div>', job=HEADER_JOB),
+        }
+
+    def test_set_results_skips_jobs_without_keys(self, mock_time):
+        backend = mock.Mock()
+        render_cache = RenderCache(components={'Header.js'}, ttl=30, backend=backend)
+
+        render_cache.set_results(
+            {
+                'id-1': JobResult(error=None, html='<div>sup</div>', job=HEADER_JOB),
+                'id-2': JobResult(error=None, html='<div>me</div>', job=HEADER_JOB._replace(name='Profile.js')),
+            },
+            {'id-1': 'key'},
+        )
+        render_cache.set_results({'id-2': JobResult(error=None, html='<div>me</div>', job=None)}, {'id-1': 'key'})
+
+        backend.set_many.assert_called_once_with({'key': CachedRender('id-1', '<div>sup</div>', 1030)}, 30)
+
+    def test_get_results_without_keys(self):
+        backend = mock.Mock()
+        render_cache = RenderCache(components={'Header.js'}, backend=backend)
+
+        assert render_cache.get_results({'id-1': HEADER_JOB}, {}) == {}
+        assert not backend.get_many.called
+
+    def test_get_stats(self):
+        render_cache = RenderCache(components={'Header.js'})
+        render_cache.set_results({'id-1': JobResult(error=None, html='<div>sup</div>', job=HEADER_JOB)}, {'id-1': 'a'})
+
+        render_cache.get_results({'id-2': HEADER_JOB, 'id-3': HEADER_JOB}, {'id-2': 'a', 'id-3': 'b'})
+        render_cache.get_results({'id-4': HEADER_JOB}, {'id-4': 'a'})
+
+        assert render_cache.get_stats() == CacheStats(hits=2, misses=1)
+
+    def test_backend_errors_are_misses(self):
+        backend = mock.Mock()
+        backend.get_many.side_effect = CacheError('oh no')
+        backend.set_many.side_effect = CacheError('oh no')
+        render_cache = RenderCache(components={'Header.js'}, backend=backend)
+
+        assert render_cache.get_results({'id-1': HEADER_JOB}, {'id-1': 'a'}) == {}
+        render_cache.set_results({'id-1': JobResult(error=None, html='<div>sup</div>', job=HEADER_JOB)}, {'id-1': 'a'})
+
+        assert render_cache.get_stats() == CacheStats(hits=0, misses=1, errors=2)
+
+    def test_shared_through_memcached(self, memcached_server):
+        render_cache = RenderCache(components={'Header.js'}, backend=MemcachedCacheBackend(memcached_server.address))
+        other_render_cache = RenderCache(
+            components={'Header.js'},
+            backend=MemcachedCacheBackend(memcached_server.address),
+        )
+        render_cache.set_results(
+            {'id-1': JobResult(error=None, html='<div data-hypernova-id="id-1">sup</div>', job=HEADER_JOB)},
+            {'id-1': 'key'},
+        )
+        memcached_server.wait_for_entries(1)
+
+        results = other_render_cache.get_results({'id-2': HEADER_JOB}, {'id-2': 'key'})
+
+        assert results == {
+            'id-2': JobResult(error=None, html='<div data-hypernova-id="id-2">sup</div>', job=HEADER_JOB),
+        }
+
+
+class TestRenderCacheStaleIfError:
+
+    @pytest.fixture
+    def render_cache(self, mock_time):
+        render_cache = RenderCache(components={'Header.js'}, ttl=60, stale_ttl=3600)
+        render_cache.set_results(
+            {'id-1': JobResult(error=None, html='<div data-hypernova-id="id-1">sup</div>', job=HEADER_JOB)},
+            {'id-1': 'key'},
+        )
+        return render_cache
+
+    def wait_for_revalidations(self, render_cache):
+        # revalidations run one after the other on the cache's single thread
+        render_cache.get_executor().submit(lambda: None).result()
+
+    def test_keeps_html_past_its_ttl(self, render_cache):
+        expires_at, __ = render_cache.backend.entries['key']
+
+        assert expires_at == pytest.approx(time.monotonic() + 3660, abs=1)
+
+    def test_stale_html_is_a_miss(self, render_cache, mock_time):
+        mock_time.return_value += 61
+
+        assert render_cache.get_results({'id-2': HEADER_JOB}, {'id-2': 'key'}) == {}
+        assert render_cache.get_stats() == CacheStats(hits=0, misses=1)
+
+    def test_get_stale_results(self, render_cache, mock_time):
+        mock_time.return_value += 61
+        jobs = {'id-2': HEADER_JOB, 'id-3': HEADER_JOB}
+
+        results = render_cache.get_stale_results(jobs, {'id-2': 'key', 'id-3': 'b'})
+
+        assert results == {
+            'id-2': JobResult(error=None, html='<div data-hypernova-id="id-2">sup</div>', job=HEADER_JOB),
+        }
+        assert render_cache.get_stats() == CacheStats(hits=0, misses=0, stale_hits=1)
+
+    def test_get_stale_results_without_stale_ttl(self):
+        render_cache = RenderCache(components={'Header.js'})
+        render_cache.set_results({'id-1': JobResult(error=None, html='<div>sup</div>', job=HEADER_JOB)}, {'id-1': 'a'})
+
+        assert render_cache.get_stale_results({'id-2': HEADER_JOB}, {'id-2': 'a'}) == {}
+
+    def test_revalidate(self, render_cache, mock_time):
+        query = mock.Mock()
+        query.json.return_value = {
+            'error': None,
+            'results': {'id-2': {'error': None, 'html': '<div data-hypernova-id="id-2">yo</div>'}},
+        }
+        send_query = mock.Mock(return_value=query)
+
+        render_cache.revalidate({'id-2': HEADER_JOB}, {'id-2': 'key'}, send_query)
+        self.wait_for_revalidations(render_cache)
+
+        send_query.assert_called_once_with({'id-2': HEADER_JOB})
+        query.json.assert_called_once_with(timeout=render_cache.revalidate_timeout)
+        assert render_cache.get_results({'id-3': HEADER_JOB}, {'id-3': 'key'})['id-3'].html == (
+            '<div data-hypernova-id="id-3">yo</div>'
+        )
+        assert render_cache.revalidating_keys == set()
+
+    @pytest.mark.parametrize('json', [
+        mock.Mock(side_effect=HypernovaQueryError('oh no')),
+        mock.Mock(return_value={'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}, 'results': {}}),
+        mock.Mock(return_value={
+            'error': None,
+            'results': {'id-2': {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}, 'html': None}},
+        }),
+    ])
+    def test_failed_revalidation_keeps_stale_html(self, render_cache, json):
+        render_cache.revalidate({'id-2': HEADER_JOB}, {'id-2': 'key'}, mock.Mock(return_value=mock.Mock(json=json)))
+        self.wait_for_revalidations(render_cache)
+
+        assert render_cache.get_results({'id-3': HEADER_JOB}, {'id-3': 'key'})['id-3'].html == (
+            '<div data-hypernova-id="id-3">sup</div>'
+        )
+        assert render_cache.revalidating_keys == set()
+
+    def test_revalidates_key_once_at_a_time(self, render_cache):
+        query = mock.Mock()
+        query.json.side_effect = lambda timeout: render_cache.revalidate(
+            {'id-3': HEADER_JOB},
+            {'id-3': 'key'},
+            send_query,
+        ) or {'error': None, 'results': {}}
+        send_query = mock.Mock(return_value=query)
+
+        render_cache.revalidate({'id-2': HEADER_JOB}, {'id-2': 'key'}, send_query)
+        self.wait_for_revalidations(render_cache)
+
+        assert send_query.call_count == 1
+
+    def test_revalidates_key_once_per_interval(self, render_cache):
+        send_query = mock.Mock(return_value=mock.Mock(**{'json.return_value': {'error': None, 'results': {}}}))
+
+        with mock.patch('pyramid_hypernova.cache.time.monotonic', return_value=100):
+            render_cache.revalidate({'id-2': HEADER_JOB}, {'id-2': 'key'}, send_query)
+            self.wait_for_revalidations(render_cache)
+        with mock.patch('pyramid_hypernova.cache.time.monotonic', return_value=104):
+            render_cache.revalidate({'id-3': HEADER_JOB}, {'id-3': 'key'}, send_query)
+        assert send_query.call_count == 1
+
+        with mock.patch('pyramid_hypernova.cache.time.monotonic', return_value=105):
+            render_cache.revalidate({'id-4': HEADER_JOB}, {'id-4': 'key'}, send_query)
+            self.wait_for_revalidations(render_cache)
+        assert send_query.call_count == 2
+        assert render_cache.revalidated_at == {'key': 105}
+
+    def test_revalidation_not_sent(self, render_cache):
+        send_query = mock.Mock(return_value=None)
+
+        render_cache.revalidate({'id-2': HEADER_JOB}, {'id-2': 'key'}, send_query)
+
+        send_query.assert_called_once_with({'id-2': HEADER_JOB})
+        assert render_cache.revalidating_keys == set()
+
+    @pytest.mark.parametrize('json,failed', [
+        (mock.Mock(return_value={'error': None, 'results': {}}), False),
+        (mock.Mock(side_effect=HypernovaQueryError('oh no')), True),
+        (
+            mock.Mock(return_value={'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}, 'results': {}}),
+            True,
+        ),
+    ])
+    def test_records_revalidation_result(self, render_cache, json, failed):
+        query = mock.Mock(json=json)
+        record_result = mock.Mock()
+
+        render_cache.revalidate({'id-2': HEADER_JOB}, {'id-2': 'key'}, mock.Mock(return_value=query), record_result)
+        self.wait_for_revalidations(render_cache)
+
+        record_result.assert_called_once_with(query, failed)
+
+    def test_creates_executor_once_per_process(self, render_cache):
+        executor = render_cache.get_executor()
+
+        assert render_cache.get_executor() is executor
+        with mock.patch('pyramid_hypernova.process.os.getpid', return_value=-1):
+            assert render_cache.get_executor() is not executor
+
+
+class TestMemcachedCacheBackend:
+
+    def test_get_many_in_one_round_trip(self, memcached_server):
+        backend = MemcachedCacheBackend(memcached_server.address)
+        backend.set_many(
+            {'a': CachedRender('id-1', '<div>a</div>', 1000.5), 'b': CachedRender('id-2', '<div>b</div>')},
+            ttl=60,
+        )
+
+        values = backend.get_many(['a', 'b', 'c'])
+
+        assert values == {'a': CachedRender('id-1', '<div>a</div>', 1000.5), 'b': CachedRender('id-2', '<div>b</div>')}
+        assert memcached_server.commands == ['set', 'set', 'get']
+
+    def test_get_many_without_keys(self, memcached_server):
+        backend = MemcachedCacheBackend(memcached_server.address)
+
+        assert backend.get_many([]) == {}
+        assert memcached_server.commands == []
+
+    def test_stores_compressed_values(self, memcached_server):
+        backend = MemcachedCacheBackend(memcached_server.address, key_prefix='ssr:')
+
+        with mock.patch('testing.memcached_server.time.time', return_value=1000):
+            backend.set_many({'a': CachedRender('id-1', '<div>a</div>')}, ttl=0.5)
+            memcached_server.wait_for_entries(1)
+
+        expires_at, flags, data = memcached_server.entries[b'ssr:a']
+        assert expires_at == 1001
+        assert flags == MemcachedCacheBackend.FLAG_COMPRESSED
+        assert json.loads(zlib.decompress(data)) == ['id-1', '<div>a</div>', None]
+
+    def test_reads_uncompressed_values(self, memcached_server):
+        memcached_server.entries[b'hypernova:a'] = (time.time() + 60, 0, b'["id-1", "<div>a</div>"]')
+        backend = MemcachedCacheBackend(memcached_server.address)
+
+        assert backend.get_many(['a']) == {'a': CachedRender('id-1', '<div>a</div>')}
+
+    def test_reuses_connections(self, memcached_server):
+        backend = MemcachedCacheBackend(memcached_server.address)
+
+        with mock.patch('pyramid_hypernova.cache.MemcachedConnection', wraps=MemcachedConnection) as spy_connection:
+            for _ in range(3):
+                backend.get_many(['a'])
+
+        assert spy_connection.call_count == 1
+
+    def test_does_not_reuse_connections_after_fork(self, memcached_server):
+        backend = MemcachedCacheBackend(memcached_server.address)
+        backend.get_many(['a'])
+
+        with mock.patch('pyramid_hypernova.cache.MemcachedConnection', wraps=MemcachedConnection) as spy_connection:
+            with mock.patch('pyramid_hypernova.process.os.getpid', return_value=-1):
+                backend.get_many(['a'])
+
+        assert spy_connection.call_count == 1
+
+    def test_closes_connections_over_pool_size(self):
+        backend = MemcachedCacheBackend(('127.0.0.1', 11211), pool_size=1)
+        connections = [mock.Mock(), mock.Mock()]
+
+        for connection in connections:
+            backend.release_connection(connection)
+
+        assert backend.idle_connections.get() == connections[:1]
+        connections[1].close.assert_called_once_with()
+
+    def test_connection_error(self, unused_address):
+        backend = MemcachedCacheBackend(unused_address)
+
+        with pytest.raises(CacheError):
+            backend.get_many(['a'])
+
+    def test_corrupt_value(self, memcached_server):
+        memcached_server.entries[b'hypernova:a'] = (time.time() + 60, 1, b'not zlib')
+        backend = MemcachedCacheBackend(memcached_server.address)
+
+        with pytest.raises(CacheError):
+            backend.get_many(['a'])
+
+        assert backend.idle_connections.get() == []
+
+    @pytest.mark.parametrize('lines,data', [
+        ([b'SERVER_ERROR out of memory\r\n'], b''),
+        ([b'VALUE hypernova:a 0 100\r\n'], b'["id-1", "<div>a</div>"]'),
+    ])
+    def test_unexpected_response(self, lines, data):
+        backend = MemcachedCacheBackend(('127.0.0.1', 11211))
+        connection = mock.Mock()
+        connection.file.readline.side_effect = lines
+        connection.file.read.return_value = data
+
+        with mock.patch.object(backend, 'get_connection', return_value=connection):
+            with pytest.raises(CacheError):
+                backend.get_many(['a'])
+
+        connection.close.assert_called_once_with()
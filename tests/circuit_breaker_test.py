@@ -0,0 +1,193 @@
+from collections import deque
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.circuit_breaker import CircuitBreaker
+from pyramid_hypernova.circuit_breaker import CLOSED
+from pyramid_hypernova.circuit_breaker import HALF_OPEN
+from pyramid_hypernova.circuit_breaker import OPEN
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.shedding import LoadShedder
+from pyramid_hypernova.shedding import LoadStats
+from testing.hypernova_server import StubHypernovaServer
+
+URL = 'http://localhost:8888'
+
+
+@pytest.fixture
+def mock_monotonic():
+    with mock.patch('pyramid_hypernova.circuit_breaker.time.monotonic', return_value=100) as mock_monotonic:
+        yield mock_monotonic
+
+
+@pytest.fixture
+def on_state_change():
+    return mock.Mock()
+
+
+def record_results(circuit_breaker, url, outcomes, duration=0.01, on_state_change=None):
+    for failed in outcomes:
+        circuit_breaker.record_result(url, failed, duration, on_state_change)
+
+
+def open_circuit(circuit_breaker, url=URL):
+    record_results(circuit_breaker, url, [True] * circuit_breaker.minimum_queries)
+    assert circuit_breaker.get_state(url) == OPEN
+
+
+class TestCircuitBreaker:
+
+    def test_closed_allows_requests(self, on_state_change):
+        circuit_breaker = CircuitBreaker()
+
+        assert circuit_breaker.get_state(URL) == CLOSED
+        assert circuit_breaker.allow_request(URL, on_state_change)
+        assert not on_state_change.called
+
+    def test_opens_at_error_rate(self, mock_monotonic, on_state_change):
+        circuit_breaker = CircuitBreaker(error_rate_threshold=0.5, window_size=4, minimum_queries=4)
+
+        record_results(circuit_breaker, URL, [True, False, False], on_state_change=on_state_change)
+        assert circuit_breaker.get_state(URL) == CLOSED
+
+        record_results(circuit_breaker, URL, [True], on_state_change=on_state_change)
+        assert circuit_breaker.get_state(URL) == OPEN
+        on_state_change.assert_called_once_with(URL, CLOSED, OPEN)
+        assert not circuit_breaker.allow_request(URL, on_state_change)
+
+    def test_only_counts_the_latest_queries(self):
+        circuit_breaker = CircuitBreaker(error_rate_threshold=0.5, window_size=4, minimum_queries=4)
+
+        record_results(circuit_breaker, URL, [True, False, False, False, False, True])
+
+        assert circuit_breaker.get_state(URL) == CLOSED
+
+    def test_waits_for_minimum_queries(self):
+        circuit_breaker = CircuitBreaker(minimum_queries=3)
+
+        record_results(circuit_breaker, URL, [True, True])
+        assert circuit_breaker.get_state(URL) == CLOSED
+
+        record_results(circuit_breaker, URL, [True])
+        assert circuit_breaker.get_state(URL) == OPEN
+
+    @pytest.mark.parametrize('slow_query_time,duration,expected_state', [
+        (None, 10, CLOSED),
+        (1, 0.5, CLOSED),
+        (1, 1, OPEN),
+    ])
+    def test_opens_at_slow_rate(self, slow_query_time, duration, expected_state):
+        circuit_breaker = CircuitBreaker(slow_query_time=slow_query_time, slow_rate_threshold=1, minimum_queries=2)
+
+        record_results(circuit_breaker, URL, [False, False], duration=duration)
+
+        assert circuit_breaker.get_state(URL) == expected_state
+
+    def test_sends_probe_after_open_timeout(self, mock_monotonic, on_state_change):
+        circuit_breaker = CircuitBreaker(open_timeout=30)
+        open_circuit(circuit_breaker)
+
+        mock_monotonic.return_value = 129
+        assert not circuit_breaker.allow_request(URL, on_state_change)
+
+        mock_monotonic.return_value = 130
+        assert circuit_breaker.allow_request(URL, on_state_change)
+        on_state_change.assert_called_once_with(URL, OPEN, HALF_OPEN)
+        assert circuit_breaker.get_state(URL) == HALF_OPEN
+
+        # a single probe is in flight at a time
+        assert not circuit_breaker.allow_request(URL, on_state_change)
+
+    def test_sends_probe_again_if_it_is_not_waited_on(self, mock_monotonic):
+        circuit_breaker = CircuitBreaker(open_timeout=30)
+        open_circuit(circuit_breaker)
+        mock_monotonic.return_value = 130
+        assert circuit_breaker.allow_request(URL)
+
+        mock_monotonic.return_value = 160
+        assert circuit_breaker.allow_request(URL)
+        assert circuit_breaker.get_state(URL) == HALF_OPEN
+
+    def test_successful_probe_closes_the_circuit(self, mock_monotonic, on_state_change):
+        circuit_breaker = CircuitBreaker(open_timeout=30)
+        open_circuit(circuit_breaker)
+        mock_monotonic.return_value = 130
+        circuit_breaker.allow_request(URL)
+
+        circuit_breaker.record_result(URL, False, 0.01, on_state_change)
+
+        on_state_change.assert_called_once_with(URL, HALF_OPEN, CLOSED)
+        assert circuit_breaker.allow_request(URL)
+        # the failures before the circuit opened are forgotten
+        record_results(circuit_breaker, URL, [True])
+        assert circuit_breaker.get_state(URL) == CLOSED
+
+    @pytest.mark.parametrize('failed,duration', [(True, 0.01), (False, 5)])
+    def test_failed_probe_opens_the_circuit_again(self, mock_monotonic, on_state_change, failed, duration):
+        circuit_breaker = CircuitBreaker(slow_query_time=1, open_timeout=30)
+        open_circuit(circuit_breaker)
+        mock_monotonic.return_value = 130
+        circuit_breaker.allow_request(URL)
+
+        circuit_breaker.record_result(URL, failed, duration, on_state_change)
+
+        on_state_change.assert_called_once_with(URL, HALF_OPEN, OPEN)
+        mock_monotonic.return_value = 159
+        assert not circuit_breaker.allow_request(URL)
+        mock_monotonic.return_value = 160
+        assert circuit_breaker.allow_request(URL)
+
+    def test_ignores_queries_sent_before_opening(self, on_state_change):
+        circuit_breaker = CircuitBreaker()
+        open_circuit(circuit_breaker)
+
+        circuit_breaker.record_result(URL, False, 0.01, on_state_change)
+
+        assert circuit_breaker.get_state(URL) == OPEN
+        assert not on_state_change.called
+
+    def test_shares_circuit_between_urls(self):
+        circuit_breaker = CircuitBreaker()
+
+        open_circuit(circuit_breaker, 'http://hypernova-1')
+
+        assert not circuit_breaker.allow_request('http://hypernova-2')
+
+    def test_per_url(self):
+        circuit_breaker = CircuitBreaker(per_url=True)
+
+        open_circuit(circuit_breaker, 'http://hypernova-1')
+
+        assert not circuit_breaker.allow_request('http://hypernova-1')
+        assert circuit_breaker.allow_request('http://hypernova-2')
+        assert circuit_breaker.get_state('http://hypernova-2') == CLOSED
+
+
+def test_ignores_queries_not_sent_before_the_deadline():
+    circuit_breaker = CircuitBreaker(minimum_queries=2)
+    load_shedder = LoadShedder()
+
+    with StubHypernovaServer(delay=0.3) as stub_server:
+        batch_request = BatchRequest(
+            get_job_group_url=lambda job_group, pyramid_request: stub_server.url,
+            plugin_controller=PluginController([]),
+            pyramid_request=pyramid.request.Request.blank('/'),
+            max_batch_size=1,
+            deadline=0.2,
+            transport='requests',
+            circuit_breaker=circuit_breaker,
+            load_shedder=load_shedder,
+        )
+        for i in range(4):
+            batch_request.render(f'Component{i}.js', {})
+        response = batch_request.submit()
+
+    # requests' queries are sent one after the other, once they're waited on
+    assert len(stub_server.requests) == 1
+    assert all(result.error.name == 'HypernovaQueryTimeoutError' for result in response.values())
+    assert circuit_breaker.get_state() == CLOSED
+    assert circuit_breaker.circuits[None].outcomes == deque([(True, False)])
+    assert load_shedder.get_stats() == LoadStats(latency=pytest.approx(0.2, abs=0.1), in_flight=0, shed=0)
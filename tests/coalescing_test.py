@@ -0,0 +1,365 @@
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from json import JSONEncoder
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.coalescing import CoalescerStats
+from pyramid_hypernova.coalescing import create_error_result
+from pyramid_hypernova.coalescing import InFlightRender
+from pyramid_hypernova.coalescing import RenderCoalescer
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.request import HypernovaQuery
+from pyramid_hypernova.transports import ErrorData
+from pyramid_hypernova.transports import FutureResponse
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError
+from pyramid_hypernova.transports import RequestsTransport
+from pyramid_hypernova.transports import ThreadPoolTransport
+from pyramid_hypernova.types import Job
+from testing.hypernova_server import StubHypernovaServer
+
+HEADER_JOB = Job('Header.js', {'title': 'sup'}, {})
+FOOTER_JOB = Job('Footer.js', {}, {})
+
+
+@pytest.fixture
+def mock_monotonic():
+    with mock.patch('pyramid_hypernova.coalescing.time.monotonic', return_value=100) as mock_monotonic:
+        yield mock_monotonic
+
+
+@pytest.fixture
+def mock_transport():
+    mock_transport = mock.Mock()
+    mock_transport.send.return_value.result.return_value = {
+        'error': None,
+        'results': {'id-1': {'error': None, 'html': '<div data-hypernova-id="id-1">sup</div>'}},
+    }
+    return mock_transport
+
+
+def create_query(job_group, transport, coalescer, timeout=None):
+    return HypernovaQuery(job_group, 'http://localhost:8888', JSONEncoder(), transport, {}, timeout, coalescer)
+
+
+@pytest.mark.parametrize('error,expected_result', [
+    (
+        HypernovaQueryError('so sad'),
+        {'error': {'name': 'HypernovaQueryError', 'message': 'so sad', 'stack': []}, 'html': None},
+    ),
+    (
+        HypernovaQueryError('so sad', ErrorData('SadError', 'very sad', ['line 1'])),
+        {'error': {'name': 'SadError', 'message': 'very sad', 'stack': ['line 1']}, 'html': None},
+    ),
+])
+def test_create_error_result(error, expected_result):
+    assert create_error_result(error) == expected_result
+
+
+class TestInFlightRender:
+
+    def test_wait_rewrites_identifier(self, mock_monotonic):
+        in_flight_render = InFlightRender('key', 'id-1', expires_at=110)
+        in_flight_render.finish({'error': None, 'html': '<div data-hypernova-id="id-1">sup</div>'})
+
+        assert in_flight_render.wait('id-2') == {'error': None, 'html': '<div data-hypernova-id="id-2">sup</div>'}
+
+    def test_wait_for_error(self, mock_monotonic):
+        in_flight_render = InFlightRender('key', 'id-1', expires_at=110)
+        result = {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}, 'html': None}
+        in_flight_render.finish(result)
+
+        assert in_flight_render.wait('id-2') is result
+
+    def test_first_result_wins(self):
+        in_flight_render = InFlightRender('key', 'id-1', expires_at=110)
+        in_flight_render.finish({'error': None, 'html': '<div/>'})
+        in_flight_render.finish({'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}, 'html': None})
+
+        assert in_flight_render.future.result() == {'error': None, 'html': '<div/>'}
+
+    @pytest.mark.parametrize('timeout,expected_wait', [(None, 10), (1, 1), (-1, 0)])
+    def test_wait_times_out(self, mock_monotonic, timeout, expected_wait):
+        in_flight_render = InFlightRender('key', 'id-1', expires_at=110)
+
+        with mock.patch.object(
+            in_flight_render.future,
+            'result',
+            side_effect=FutureTimeoutError(),
+        ) as mock_result:
+            result = in_flight_render.wait('id-2', timeout)
+
+        mock_result.assert_called_once_with(expected_wait)
+        assert result['html'] is None
+        assert result['error']['name'] == 'HypernovaQueryTimeoutError'
+
+
+class TestRenderCoalescer:
+
+    def test_start_joins_in_flight_renders(self, mock_monotonic):
+        coalescer = RenderCoalescer()
+
+        started, joined = coalescer.start({'id-1': 'header', 'id-2': 'footer'})
+        assert joined == {}
+        assert started['id-1'].identifier == 'id-1'
+        assert started['id-1'].expires_at == 110
+
+        second_started, second_joined = coalescer.start({'id-3': 'header', 'id-4': 'profile'})
+        assert list(second_started) == ['id-4']
+        assert second_joined == {'id-3': started['id-1']}
+        assert coalescer.get_stats() == CoalescerStats(sent=3, coalesced=1)
+
+    def test_start_without_sharing(self, mock_monotonic):
+        coalescer = RenderCoalescer()
+        started, __ = coalescer.start({'id-1': 'header'})
+
+        second_started, second_joined = coalescer.start({'id-2': 'header', 'id-3': 'footer'}, share=False)
+
+        assert second_joined == {'id-2': started['id-1']}
+        assert list(second_started) == ['id-3']
+        assert coalescer.in_flight == {'header': started['id-1']}
+
+    def test_start_sends_expired_renders_again(self, mock_monotonic):
+        coalescer = RenderCoalescer(max_wait=1)
+        started, __ = coalescer.start({'id-1': 'header'})
+
+        mock_monotonic.return_value = 101
+        second_started, second_joined = coalescer.start({'id-2': 'header'})
+
+        assert list(second_started) == ['id-2']
+        assert second_joined == {}
+        assert coalescer.in_flight == {'header': second_started['id-2']}
+
+    def test_start_forgets_renders_after_fork(self):
+        coalescer = RenderCoalescer()
+        coalescer.start({'id-1': 'header'})
+
+        with mock.patch('pyramid_hypernova.coalescing.os.getpid', return_value=-1):
+            started, joined = coalescer.start({'id-2': 'header'})
+
+        assert list(started) == ['id-2']
+        assert joined == {}
+
+    def test_finish_hands_results_over(self):
+        coalescer = RenderCoalescer()
+        started, __ = coalescer.start({'id-1': 'header', 'id-2': 'footer'})
+
+        coalescer.finish(started, {'error': None, 'results': {'id-1': {'error': None, 'html': '<div>sup</div>'}}})
+
+        assert coalescer.in_flight == {}
+        assert started['id-1'].future.result() == {'error': None, 'html': '<div>sup</div>'}
+        assert started['id-2'].future.result()['error']['message'] == 'Hypernova did not return a result for the job'
+
+    def test_finish_hands_response_error_over(self):
+        coalescer = RenderCoalescer()
+        started, __ = coalescer.start({'id-1': 'header'})
+        error = {'name': 'SadError', 'message': 'so sad', 'stack': []}
+
+        coalescer.finish(started, {'error': error, 'results': {}})
+
+        assert started['id-1'].future.result() == {'error': error, 'html': None}
+
+    def test_finish_hands_query_error_over(self):
+        coalescer = RenderCoalescer()
+        started, __ = coalescer.start({'id-1': 'header'})
+
+        coalescer.finish(started, error=HypernovaQueryTimeoutError('too slow'))
+
+        assert started['id-1'].future.result() == {
+            'error': {'name': 'HypernovaQueryTimeoutError', 'message': 'too slow', 'stack': []},
+            'html': None,
+        }
+
+    def test_finish_keeps_newer_renders(self, mock_monotonic):
+        coalescer = RenderCoalescer(max_wait=1)
+        started, __ = coalescer.start({'id-1': 'header'})
+        mock_monotonic.return_value = 101
+        second_started, __ = coalescer.start({'id-2': 'header'})
+
+        coalescer.finish(started, {'error': None, 'results': {'id-1': {'error': None, 'html': '<div/>'}}})
+
+        assert coalescer.in_flight == {'header': second_started['id-2']}
+
+
+class TestCoalescedQuery:
+
+    def test_identical_jobs_are_sent_once(self, mock_transport):
+        coalescer = RenderCoalescer()
+        query = create_query({'id-1': HEADER_JOB}, mock_transport, coalescer)
+        coalesced_query = create_query({'id-2': HEADER_JOB}, mock_transport, coalescer)
+
+        query.send()
+        coalesced_query.send()
+
+        assert mock_transport.send.call_count == 1
+        assert coalesced_query.response is None
+        assert query.json() == {
+            'error': None,
+            'results': {'id-1': {'error': None, 'html': '<div data-hypernova-id="id-1">sup</div>'}},
+        }
+        assert coalesced_query.json() == {
+            'error': None,
+            'results': {'id-2': {'error': None, 'html': '<div data-hypernova-id="id-2">sup</div>'}},
+        }
+
+    def test_deferred_renders_are_not_joined(self, mock_transport):
+        coalescer = RenderCoalescer()
+        query = create_query({'id-1': HEADER_JOB}, RequestsTransport(), coalescer)
+        coalesced_query = create_query({'id-2': HEADER_JOB}, mock_transport, coalescer)
+
+        query.send()
+        coalesced_query.send()
+
+        # the first query is only sent once it's waited on
+        assert list(query.started_renders) == ['id-1']
+        assert list(coalesced_query.started_renders) == ['id-2']
+        assert coalesced_query.joined_renders == {}
+
+    def test_deferred_renders_join_sent_renders(self, mock_transport):
+        coalescer = RenderCoalescer()
+        query = create_query({'id-1': HEADER_JOB}, mock_transport, coalescer)
+        coalesced_query = create_query({'id-2': HEADER_JOB}, RequestsTransport(), coalescer)
+
+        query.send()
+        coalesced_query.send()
+
+        assert coalesced_query.response is None
+        assert coalesced_query.joined_renders == {'id-2': query.started_renders['id-1']}
+
+    def test_only_new_jobs_are_sent(self, mock_transport):
+        coalescer = RenderCoalescer()
+        query = create_query({'id-1': HEADER_JOB}, mock_transport, coalescer)
+        query.send()
+        mock_transport.send.return_value.result.return_value = {
+            'error': None,
+            'results': {'id-3': {'error': None, 'html': '<footer/>'}},
+        }
+        coalesced_query = create_query({'id-2': HEADER_JOB, 'id-3': FOOTER_JOB}, mock_transport, coalescer)
+        coalesced_query.send()
+
+        assert mock_transport.send.call_args[0][1] == b'{"id-3": {"name": "Footer.js", "data": {}, "context": {}}}'
+        coalescer.finish(query.started_renders, {
+            'error': None,
+            'results': {'id-1': {'error': None, 'html': '<div data-hypernova-id="id-1">sup</div>'}},
+        })
+        assert coalesced_query.json() == {
+            'error': None,
+            'results': {
+                'id-2': {'error': None, 'html': '<div data-hypernova-id="id-2">sup</div>'},
+                'id-3': {'error': None, 'html': '<footer/>'},
+            },
+        }
+
+    def test_response_error_is_not_waited_on(self, mock_transport):
+        coalescer = RenderCoalescer()
+        create_query({'id-1': HEADER_JOB}, mock_transport, coalescer).send()
+        error = {'name': 'SadError', 'message': 'so sad', 'stack': []}
+        mock_transport.send.return_value.result.return_value = {'error': error, 'results': {}}
+        coalesced_query = create_query({'id-2': HEADER_JOB, 'id-3': FOOTER_JOB}, mock_transport, coalescer)
+        coalesced_query.send()
+
+        assert coalesced_query.json() == {'error': error, 'results': {}}
+        assert coalescer.in_flight.keys() == {coalesced_query.joined_renders['id-2'].key}
+
+    def test_query_error_is_handed_over(self, mock_transport):
+        coalescer = RenderCoalescer()
+        mock_transport.send.return_value.result.side_effect = HypernovaQueryTimeoutError('too slow')
+        query = create_query({'id-1': HEADER_JOB}, mock_transport, coalescer)
+        coalesced_query = create_query({'id-2': HEADER_JOB}, mock_transport, coalescer)
+        query.send()
+        coalesced_query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            query.json()
+
+        assert coalesced_query.json()['results']['id-2']['error']['name'] == 'HypernovaQueryTimeoutError'
+        assert coalescer.in_flight == {}
+
+    def test_response_is_handed_over_once_received(self):
+        coalescer = RenderCoalescer()
+        future = Future()
+        mock_transport = mock.Mock()
+        mock_transport.send.return_value = FutureResponse(future)
+        query = create_query({'id-1': HEADER_JOB}, mock_transport, coalescer)
+        coalesced_query = create_query({'id-2': HEADER_JOB}, mock_transport, coalescer)
+        query.send()
+        coalesced_query.send()
+
+        future.set_result({'error': None, 'results': {'id-1': {'error': None, 'html': '<div>sup</div>'}}})
+
+        # without waiting on the first query
+        assert coalesced_query.json(timeout=0)['results'] == {'id-2': {'error': None, 'html': '<div>sup</div>'}}
+        assert coalescer.in_flight == {}
+
+    def test_error_is_handed_over_once_received(self):
+        coalescer = RenderCoalescer()
+        future = Future()
+        mock_transport = mock.Mock()
+        mock_transport.send.return_value = FutureResponse(future)
+        query = create_query({'id-1': HEADER_JOB}, mock_transport, coalescer)
+        coalesced_query = create_query({'id-2': HEADER_JOB}, mock_transport, coalescer)
+        query.send()
+        coalesced_query.send()
+
+        future.set_exception(HypernovaQueryError('so sad'))
+
+        assert coalesced_query.json(timeout=0)['results']['id-2']['error']['message'] == 'so sad'
+        with pytest.raises(HypernovaQueryError):
+            query.json()
+
+    @pytest.mark.parametrize('timeout,read_timeout,expected_timeout', [
+        (None, None, None),
+        (5, None, 5),
+        (None, 2, 2),
+        (5, 2, 2),
+    ])
+    def test_joined_renders_are_waited_on_within_timeouts(
+        self,
+        mock_transport,
+        mock_monotonic,
+        timeout,
+        read_timeout,
+        expected_timeout,
+    ):
+        coalescer = RenderCoalescer()
+        create_query({'id-1': HEADER_JOB}, mock_transport, coalescer).send()
+        coalesced_query = create_query({'id-2': HEADER_JOB}, mock_transport, coalescer, timeout=(None, read_timeout))
+        coalesced_query.send()
+
+        with mock.patch.object(InFlightRender, 'wait') as mock_wait:
+            coalesced_query.json(timeout)
+
+        mock_wait.assert_called_once_with('id-2', expected_timeout)
+
+
+def test_concurrent_pages_share_renders():
+    coalescer = RenderCoalescer()
+    transport = ThreadPoolTransport()
+    responses = []
+
+    def render_page(url):
+        batch_request = BatchRequest(
+            get_job_group_url=lambda job_group, pyramid_request: url,
+            plugin_controller=PluginController([]),
+            pyramid_request=pyramid.request.Request.blank('/'),
+            transport=transport,
+            coalescer=coalescer,
+        )
+        token = batch_request.render('Header.js', {'title': 'sup'})
+        responses.append(batch_request.submit()[token.identifier].html)
+
+    with StubHypernovaServer(delay=0.2) as stub_server:
+        threads = [threading.Thread(target=render_page, args=(stub_server.url,)) for __ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(stub_server.requests) == 1
+    assert responses == ['<div>Header.js</div>'] * 5
+    assert coalescer.get_stats() == CoalescerStats(sent=1, coalesced=4)
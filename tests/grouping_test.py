@@ -0,0 +1,213 @@
+from json import JSONEncoder
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova import grouping
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.grouping import balance_job_groups
+from pyramid_hypernova.grouping import CountJobGrouper
+from pyramid_hypernova.grouping import get_job_grouper
+from pyramid_hypernova.grouping import get_job_sizes
+from pyramid_hypernova.grouping import has_room
+from pyramid_hypernova.grouping import JobGrouper
+from pyramid_hypernova.grouping import RenderTimeJobGrouper
+from pyramid_hypernova.grouping import SizeJobGrouper
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.types import Job
+from testing.hypernova_server import StubHypernovaServer
+
+
+def create_jobs(*names):
+    return {f'id-{i}': Job(name, {}, {}) for i, name in enumerate(names)}
+
+
+def get_identifiers(job_groups):
+    return [list(job_group) for job_group in job_groups]
+
+
+def test_get_job_sizes():
+    jobs = {'id-1': Job('Button.js', {'label': 'go'}, {})}
+
+    assert get_job_sizes(jobs, JSONEncoder()) == {
+        'id-1': len('{"id-1": {"name": "Button.js", "data": {"label": "go"}, "context": {}}}'),
+    }
+
+
+@pytest.mark.parametrize('job_group_size,job_group_bytes,job_size,max_batch_size,max_batch_bytes,expected', [
+    (0, 0, 500, 1, 100, True),
+    (1, 10, 10, None, None, True),
+    (1, 10, 10, 0, None, True),
+    (1, 10, 10, 1, None, False),
+    (1, 10, 10, 2, 20, True),
+    (1, 10, 11, 2, 20, False),
+])
+def test_has_room(job_group_size, job_group_bytes, job_size, max_batch_size, max_batch_bytes, expected):
+    assert has_room(job_group_size, job_group_bytes, job_size, max_batch_size, max_batch_bytes) is expected
+
+
+class TestBalanceJobGroups:
+
+    def test_balances_costs(self):
+        jobs = create_jobs('Grid.js', 'Grid.js', 'Grid.js', 'Button.js', 'Button.js', 'Button.js')
+        costs = {'id-0': 50, 'id-1': 50, 'id-2': 50, 'id-3': 1, 'id-4': 1, 'id-5': 1}
+
+        job_groups = balance_job_groups(jobs, costs, dict.fromkeys(jobs, 0), 2, None)
+
+        assert get_identifiers(job_groups) == [['id-0', 'id-3'], ['id-1', 'id-4'], ['id-2', 'id-5']]
+
+    def test_without_max_batch_size(self):
+        jobs = create_jobs('Grid.js', 'Button.js')
+
+        job_groups = balance_job_groups(jobs, {'id-0': 50, 'id-1': 1}, dict.fromkeys(jobs, 0), None, None)
+
+        assert job_groups == [jobs]
+
+    def test_max_batch_bytes(self):
+        jobs = create_jobs('Grid.js', 'Grid.js', 'Button.js', 'Button.js')
+        costs = {'id-0': 50, 'id-1': 40, 'id-2': 1, 'id-3': 1}
+        sizes = {'id-0': 90, 'id-1': 90, 'id-2': 20, 'id-3': 20}
+
+        job_groups = balance_job_groups(jobs, costs, sizes, None, 100)
+
+        # 220 bytes take at least 3 job groups, and the grids don't fit with each other
+        assert get_identifiers(job_groups) == [['id-0'], ['id-1'], ['id-2', 'id-3']]
+
+    def test_adds_job_groups_when_none_has_room(self):
+        jobs = create_jobs('Grid.js', 'Grid.js', 'Button.js')
+        costs = {'id-0': 50, 'id-1': 40, 'id-2': 1}
+        sizes = {'id-0': 60, 'id-1': 60, 'id-2': 60}
+
+        job_groups = balance_job_groups(jobs, costs, sizes, None, 100)
+
+        assert get_identifiers(job_groups) == [['id-0'], ['id-1'], ['id-2']]
+
+
+class TestJobGrouper:
+
+    def test_group_jobs_is_abstract(self):
+        with pytest.raises(NotImplementedError):
+            JobGrouper().group_jobs({}, None, None, JSONEncoder())
+
+    def test_record_render_time_does_nothing(self):
+        JobGrouper().record_render_time('Grid.js', 50)
+
+
+class TestCountJobGrouper:
+
+    def test_chunks_by_count(self):
+        jobs = create_jobs('Grid.js', 'Grid.js', 'Grid.js', 'Button.js')
+
+        job_groups = CountJobGrouper().group_jobs(jobs, 3, None, JSONEncoder())
+
+        assert get_identifiers(job_groups) == [['id-0', 'id-1', 'id-2'], ['id-3']]
+
+    @pytest.mark.parametrize('max_batch_size,expected', [
+        (None, [['id-0', 'id-1'], ['id-2', 'id-3'], ['id-4']]),
+        (1, [['id-0'], ['id-1'], ['id-2'], ['id-3'], ['id-4']]),
+    ])
+    def test_chunks_by_bytes(self, max_batch_size, expected):
+        jobs = create_jobs('A.js', 'B.js', 'C.js', 'D.js', 'E.js')
+        job_size = len('{"id-0": {"name": "A.js", "data": {}, "context": {}}}')
+
+        job_groups = CountJobGrouper().group_jobs(jobs, max_batch_size, 2 * job_size, JSONEncoder())
+
+        assert get_identifiers(job_groups) == expected
+
+
+class TestSizeJobGrouper:
+
+    def test_balances_sizes(self):
+        jobs = {
+            'grid-1': Job('Grid.js', {'items': list(range(100))}, {}),
+            'grid-2': Job('Grid.js', {'items': list(range(100))}, {}),
+            'button-1': Job('Button.js', {}, {}),
+            'button-2': Job('Button.js', {}, {}),
+        }
+
+        job_groups = SizeJobGrouper().group_jobs(jobs, 2, None, JSONEncoder())
+
+        assert get_identifiers(job_groups) == [['grid-1', 'button-1'], ['grid-2', 'button-2']]
+
+
+class TestRenderTimeJobGrouper:
+
+    def test_record_render_time(self):
+        job_grouper = RenderTimeJobGrouper(weight=0.5)
+
+        job_grouper.record_render_time('Grid.js', 50)
+        assert job_grouper.render_times == {'Grid.js': 50}
+
+        job_grouper.record_render_time('Grid.js', 30)
+        assert job_grouper.render_times == {'Grid.js': 40}
+
+    def test_unknown_components_take_the_average_time(self):
+        job_grouper = RenderTimeJobGrouper()
+        jobs = create_jobs('Grid.js', 'Button.js', 'Footer.js')
+        assert job_grouper.get_render_times(jobs) == {'id-0': 1, 'id-1': 1, 'id-2': 1}
+
+        job_grouper.record_render_time('Grid.js', 50)
+        job_grouper.record_render_time('Button.js', 2)
+
+        assert job_grouper.get_render_times(jobs) == {'id-0': 50, 'id-1': 2, 'id-2': 26}
+
+    @pytest.mark.parametrize('max_batch_bytes', [None, 1000])
+    def test_balances_render_times(self, max_batch_bytes):
+        job_grouper = RenderTimeJobGrouper()
+        job_grouper.record_render_time('Grid.js', 50)
+        job_grouper.record_render_time('Button.js', 1)
+        jobs = create_jobs('Grid.js', 'Grid.js', 'Button.js', 'Button.js')
+
+        job_groups = job_grouper.group_jobs(jobs, 2, max_batch_bytes, JSONEncoder())
+
+        assert get_identifiers(job_groups) == [['id-0', 'id-2'], ['id-1', 'id-3']]
+
+
+def test_learns_render_times_from_hypernova():
+    job_grouper = RenderTimeJobGrouper()
+
+    with StubHypernovaServer(render_times={'Grid.js': 0.02}) as stub_server:
+        batch_request = BatchRequest(
+            get_job_group_url=lambda job_group, pyramid_request: stub_server.url,
+            plugin_controller=PluginController([]),
+            pyramid_request=pyramid.request.Request.blank('/'),
+            job_grouper=job_grouper,
+        )
+        batch_request.render('Grid.js', {})
+        batch_request.render('Button.js', {})
+        batch_request.submit()
+
+    assert job_grouper.render_times == {'Grid.js': 20}
+
+
+class TestGetJobGrouper:
+
+    @pytest.fixture(autouse=True)
+    def job_groupers(self):
+        with mock.patch.object(grouping, '_job_groupers', {}):
+            yield
+
+    @pytest.mark.parametrize('name,job_grouper_class', [
+        ('count', CountJobGrouper),
+        ('size', SizeJobGrouper),
+        ('render_time', RenderTimeJobGrouper),
+    ])
+    def test_by_name(self, name, job_grouper_class):
+        job_grouper = get_job_grouper(name)
+
+        assert isinstance(job_grouper, job_grouper_class)
+        assert get_job_grouper(name) is job_grouper
+
+    def test_instance(self):
+        job_grouper = RenderTimeJobGrouper()
+
+        assert get_job_grouper(job_grouper) is job_grouper
+
+    def test_unknown_name(self):
+        with pytest.raises(ValueError) as exc_info:
+            get_job_grouper('cheapest')
+
+        assert str(exc_info.value) == (
+            "Unknown Hypernova job grouper 'cheapest', expected one of: count, render_time, size"
+        )
@@ -0,0 +1,226 @@
+import threading
+import time
+from concurrent.futures import Future
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.hedging import HedgedResponse
+from pyramid_hypernova.hedging import Hedger
+from pyramid_hypernova.hedging import HedgeStats
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.transports import DeferredResponse
+from pyramid_hypernova.transports import FutureResponse
+from pyramid_hypernova.transports import get_transport
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError
+from testing.hypernova_server import StubHypernovaServer
+
+RESPONSE_JSON = {'error': None, 'results': {}}
+HEDGE_RESPONSE_JSON = {'error': None, 'results': {'id-1': {'error': None, 'html': '<div/>'}}}
+
+
+def create_hedger(latency=0.01, **kwargs):
+    """A hedger that hedges after `latency` seconds, with budget to spare."""
+    hedger = Hedger(min_samples=1, max_hedge_rate=1, **kwargs)
+    hedger.record_latency(latency)
+    hedger.budget.tokens = hedger.hedge_burst
+    return hedger
+
+
+class TestHedger:
+
+    @pytest.mark.parametrize('percentile,expected', [(50, 0.06), (95, 0.1), (100, 0.1)])
+    def test_get_hedge_delay(self, percentile, expected):
+        hedger = Hedger(percentile=percentile, min_samples=10)
+        for latency in range(10, 0, -1):
+            hedger.record_latency(latency / 100)
+
+        assert hedger.get_hedge_delay() == expected
+
+    def test_no_hedge_delay_without_enough_latencies(self):
+        hedger = Hedger(min_samples=2)
+        hedger.record_latency(0.1)
+
+        assert hedger.get_hedge_delay() is None
+
+    def test_only_keeps_recent_latencies(self):
+        hedger = Hedger(percentile=100, window_size=2, min_samples=1)
+        for latency in (0.5, 0.1, 0.2):
+            hedger.record_latency(latency)
+
+        assert hedger.get_hedge_delay() == 0.2
+
+    def test_budget(self):
+        hedger = Hedger(max_hedge_rate=0.5, hedge_burst=2)
+        response = FutureResponse(Future())
+
+        hedger.hedge(response, mock.Mock())
+        assert not hedger.allow_hedge()
+
+        for __ in range(10):
+            hedger.hedge(response, mock.Mock())
+        assert hedger.allow_hedge()
+        assert hedger.allow_hedge()
+        assert not hedger.allow_hedge()
+        assert hedger.get_stats() == HedgeStats(queries=11, hedges=2, wins=0)
+
+    def test_responses_without_callbacks_are_not_hedged(self):
+        hedger = create_hedger()
+        response = mock.Mock(spec=DeferredResponse)
+
+        assert hedger.hedge(response, mock.Mock()) is response
+
+    def test_no_hedge_without_enough_latencies(self):
+        hedger = Hedger()
+        send_hedge = mock.Mock()
+        future = Future()
+        response = hedger.hedge(FutureResponse(future), send_hedge)
+
+        threading.Timer(0.05, lambda: future.set_result(RESPONSE_JSON)).start()
+
+        assert response.result() == RESPONSE_JSON
+        assert not send_hedge.called
+
+
+class TestHedgedResponse:
+
+    @pytest.fixture
+    def hedger(self):
+        return create_hedger()
+
+    @pytest.fixture
+    def primary(self):
+        return Future()
+
+    @pytest.fixture
+    def hedge(self):
+        return Future()
+
+    @pytest.fixture
+    def send_hedge(self, hedge):
+        return mock.Mock(return_value=FutureResponse(hedge))
+
+    def create_response(self, hedger, primary, send_hedge, delay=0.01):
+        return HedgedResponse(FutureResponse(primary), send_hedge, time.monotonic() + delay, hedger)
+
+    def test_fast_response_is_not_hedged(self, hedger, primary, send_hedge):
+        primary.set_result(RESPONSE_JSON)
+        response = self.create_response(hedger, primary, send_hedge)
+
+        assert response.result() == RESPONSE_JSON
+        assert not send_hedge.called
+        assert hedger.get_stats().hedges == 0
+
+    def test_hedge_wins(self, hedger, primary, hedge, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge)
+        send_hedge.side_effect = lambda: hedge.set_result(HEDGE_RESPONSE_JSON) or FutureResponse(hedge)
+
+        assert response.result() == HEDGE_RESPONSE_JSON
+        send_hedge.assert_called_once_with()
+        assert primary.cancelled()
+        assert hedger.get_stats() == HedgeStats(queries=0, hedges=1, wins=1)
+
+    def test_primary_wins_after_hedging(self, hedger, primary, hedge, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge)
+        send_hedge.side_effect = lambda: primary.set_result(RESPONSE_JSON) or FutureResponse(hedge)
+
+        assert response.result() == RESPONSE_JSON
+        assert hedge.cancelled()
+        assert hedger.get_stats() == HedgeStats(queries=0, hedges=1, wins=0)
+
+    def test_no_hedge_without_budget(self, hedger, primary, send_hedge):
+        hedger.budget.tokens = 0
+        response = self.create_response(hedger, primary, send_hedge)
+        threading.Timer(0.05, lambda: primary.set_result(RESPONSE_JSON)).start()
+
+        assert response.result() == RESPONSE_JSON
+        assert not send_hedge.called
+
+    def test_failed_query_is_not_hedged(self, hedger, primary, send_hedge):
+        primary.set_exception(HypernovaQueryError('oh no'))
+        response = self.create_response(hedger, primary, send_hedge)
+
+        with pytest.raises(HypernovaQueryError):
+            response.result()
+        assert not send_hedge.called
+
+    def test_waits_on_primary_when_hedge_fails(self, hedger, primary, hedge, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge)
+        hedge.set_exception(HypernovaQueryError('oh no'))
+        threading.Timer(0.05, lambda: primary.set_result(RESPONSE_JSON)).start()
+
+        assert response.result() == RESPONSE_JSON
+        send_hedge.assert_called_once_with()
+
+    def test_raises_last_error_when_both_fail(self, hedger, primary, hedge, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge)
+        hedge.set_exception(HypernovaQueryError('hedge failed'))
+        threading.Timer(0.05, lambda: primary.set_exception(HypernovaQueryError('primary failed'))).start()
+
+        with pytest.raises(HypernovaQueryError) as exc_info:
+            response.result()
+        assert str(exc_info.value) == 'primary failed'
+        send_hedge.assert_called_once_with()
+
+    def test_timeout(self, hedger, primary, hedge, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge)
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            response.result(timeout=0.05)
+        assert primary.cancelled()
+        assert hedge.cancelled()
+
+    def test_no_hedge_past_timeout(self, hedger, primary, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge, delay=1)
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            response.result(timeout=0.01)
+        assert not send_hedge.called
+
+    def test_add_done_callback(self, hedger, primary, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge)
+        results = []
+        # Waiting on the response from its callback doesn't deadlock
+        response.add_done_callback(lambda response: results.append(response.result()))
+
+        primary.set_result(RESPONSE_JSON)
+
+        assert results == [RESPONSE_JSON]
+
+    def test_callbacks_are_not_called_when_cancelled(self, hedger, primary, send_hedge):
+        response = self.create_response(hedger, primary, send_hedge)
+        callback = mock.Mock()
+        response.add_done_callback(callback)
+
+        response.cancel()
+        response.cancel()
+
+        assert not callback.called
+        assert primary.cancelled()
+
+
+def test_hedges_slow_upstream():
+    hedger = create_hedger(percentile=100)
+
+    with StubHypernovaServer(delay=1) as slow_stub_server, StubHypernovaServer() as stub_server:
+        batch_request = BatchRequest(
+            get_job_group_url=lambda job_group, pyramid_request: [slow_stub_server.url, stub_server.url],
+            plugin_controller=PluginController([]),
+            pyramid_request=pyramid.request.Request.blank('/'),
+            transport=get_transport('thread_pool'),
+            hedger=hedger,
+        )
+        token = batch_request.render('MyComponent.js', {})
+
+        started = time.perf_counter()
+        response = batch_request.submit()
+        elapsed = time.perf_counter() - started
+
+        assert response[token.identifier].error is None
+        assert response[token.identifier].html == '<div>MyComponent.js</div>'
+        assert elapsed < 0.5
+        assert len(slow_stub_server.requests) == len(stub_server.requests) == 1
+        assert hedger.get_stats() == HedgeStats(queries=1, hedges=1, wins=1)
@@ -0,0 +1,224 @@
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.coalescing import RenderCoalescer
+from pyramid_hypernova.metrics import Histogram
+from pyramid_hypernova.metrics import MetricsAggregator
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.types import ComponentMetrics
+from pyramid_hypernova.types import HypernovaError
+from pyramid_hypernova.types import JobGroupMetrics
+from testing.hypernova_server import StubHypernovaServer
+
+
+def create_metrics(error=None, render_time=0.02):
+    return JobGroupMetrics(
+        url='http://localhost:8888/batch',
+        encode_time=0.002,
+        network_time=0.05,
+        parse_time=0.001,
+        payload_bytes=2000,
+        html_bytes=50000,
+        error=error,
+        components={
+            'Grid.js': ComponentMetrics(
+                jobs=2,
+                encode_time=0.0015,
+                network_time=0.05,
+                parse_time=0.0008,
+                payload_bytes=1800,
+                html_bytes=49000,
+                render_time=render_time,
+            ),
+            'Button "big"': ComponentMetrics(
+                jobs=1,
+                encode_time=0.0005,
+                network_time=0.05,
+                parse_time=0.0002,
+                payload_bytes=200,
+                html_bytes=1000,
+                render_time=None,
+            ),
+        },
+    )
+
+
+class TestHistogram:
+
+    def test_observe(self):
+        histogram = Histogram([1, 5, 10])
+
+        for value in (0.5, 1, 3, 7, 20):
+            histogram.observe(value)
+
+        assert histogram.counts == [2, 1, 1]
+        assert histogram.count == 5
+        assert histogram.sum == 31.5
+        assert histogram.get_cumulative_counts() == [(1, 2), (5, 3), (10, 4)]
+
+
+class TestMetricsAggregator:
+
+    def test_on_metrics(self):
+        aggregator = MetricsAggregator()
+
+        aggregator.on_metrics(create_metrics(), mock.Mock())
+        aggregator.on_metrics(create_metrics(render_time=0.04), mock.Mock())
+
+        histograms = aggregator.get_histograms()
+        assert histograms[('network_seconds', None)].count == 2
+        assert histograms[('network_seconds', None)].sum == pytest.approx(0.1)
+        assert histograms[('html_bytes', 'Grid.js')].sum == 98000
+        assert histograms[('render_seconds', 'Grid.js')].sum == pytest.approx(0.06)
+        assert ('render_seconds', None) not in histograms
+        assert ('render_seconds', 'Button "big"') not in histograms
+        assert aggregator.error_count == 0
+
+    def test_counts_errors(self):
+        aggregator = MetricsAggregator()
+
+        aggregator.on_metrics(create_metrics(error=HypernovaError('SadError', 'so sad', [])), mock.Mock())
+
+        assert aggregator.error_count == 1
+
+    def test_get_histograms_returns_a_copy(self):
+        aggregator = MetricsAggregator()
+        aggregator.on_metrics(create_metrics(), mock.Mock())
+
+        histograms = aggregator.get_histograms()
+        aggregator.on_metrics(create_metrics(), mock.Mock())
+
+        assert histograms[('encode_seconds', None)].count == 1
+        assert histograms[('encode_seconds', None)].counts != aggregator.histograms[('encode_seconds', None)].counts
+
+    def test_render_prometheus(self):
+        aggregator = MetricsAggregator(time_buckets=(0.01, 0.1), size_buckets=(1000, 10000))
+        aggregator.on_metrics(create_metrics()._replace(retries=2), mock.Mock())
+
+        text = aggregator.render_prometheus()
+
+        assert text.startswith(
+            '# TYPE hypernova_job_group_errors_total counter\n'
+            'hypernova_job_group_errors_total 0\n'
+            '# TYPE hypernova_job_group_retries_total counter\n'
+            'hypernova_job_group_retries_total 2\n'
+            '# TYPE hypernova_job_group_encode_seconds histogram\n'
+            'hypernova_job_group_encode_seconds_bucket{le="0.01"} 1\n'
+            'hypernova_job_group_encode_seconds_bucket{le="0.1"} 1\n'
+            'hypernova_job_group_encode_seconds_bucket{le="+Inf"} 1\n'
+            'hypernova_job_group_encode_seconds_sum 0.002\n'
+            'hypernova_job_group_encode_seconds_count 1\n'
+        )
+        assert (
+            '# TYPE hypernova_component_html_bytes histogram\n'
+            'hypernova_component_html_bytes_bucket{component="Button \\"big\\"",le="1000"} 1\n'
+            'hypernova_component_html_bytes_bucket{component="Button \\"big\\"",le="10000"} 1\n'
+            'hypernova_component_html_bytes_bucket{component="Button \\"big\\"",le="+Inf"} 1\n'
+            'hypernova_component_html_bytes_sum{component="Button \\"big\\""} 1000\n'
+            'hypernova_component_html_bytes_count{component="Button \\"big\\""} 1\n'
+            'hypernova_component_html_bytes_bucket{component="Grid.js",le="1000"} 0\n'
+            'hypernova_component_html_bytes_bucket{component="Grid.js",le="10000"} 0\n'
+            'hypernova_component_html_bytes_bucket{component="Grid.js",le="+Inf"} 1\n'
+            'hypernova_component_html_bytes_sum{component="Grid.js"} 49000\n'
+            'hypernova_component_html_bytes_count{component="Grid.js"} 1\n'
+        ) in text
+        assert 'hypernova_job_group_render_seconds' not in text
+        assert 'hypernova_component_render_seconds_sum{component="Grid.js"} 0.02\n' in text
+
+    def test_render_prometheus_without_metrics(self):
+        assert MetricsAggregator().render_prometheus() == (
+            '# TYPE hypernova_job_group_errors_total counter\n'
+            'hypernova_job_group_errors_total 0\n'
+            '# TYPE hypernova_job_group_retries_total counter\n'
+            'hypernova_job_group_retries_total 0\n'
+        )
+
+
+class TestBatchRequestMetrics:
+
+    @pytest.fixture
+    def stub_server(self):
+        with StubHypernovaServer(render_times={'Grid.js': 0.01}) as stub_server:
+            yield stub_server
+
+    def create_batch_request(self, url, plugin, **kwargs):
+        return BatchRequest(
+            get_job_group_url=lambda job_group, pyramid_request: url,
+            plugin_controller=PluginController([plugin]),
+            pyramid_request=pyramid.request.Request.blank('/'),
+            **kwargs
+        )
+
+    def test_reports_job_group_metrics(self, stub_server):
+        plugin = mock.Mock(wraps=MetricsAggregator())
+        batch_request = self.create_batch_request(stub_server.url, plugin)
+        batch_request.render('Grid.js', {'items': [1, 2]})
+        batch_request.render('Grid.js', {'items': [3, 4]})
+        batch_request.render('Button.js', {})
+
+        batch_request.submit()
+
+        (metrics, pyramid_request), __ = plugin.on_metrics.call_args
+        assert pyramid_request is batch_request.pyramid_request
+        assert metrics.url == stub_server.url
+        assert metrics.error is None
+        assert metrics.payload_bytes == int(stub_server.requests[0][1]['Content-Length'])
+        assert metrics.html_bytes == len('<div>Grid.js</div>') * 2 + len('<div>Button.js</div>')
+        assert metrics.network_time >= 0.02
+        assert metrics.encode_time > 0
+        assert metrics.parse_time > 0
+        assert metrics.encode_time >= sum(component.encode_time for component in metrics.components.values())
+        assert batch_request.encode_time == metrics.encode_time
+        # the page also waits on reading and parsing the response
+        assert 0.02 <= metrics.network_time <= batch_request.wait_time
+
+        grid_metrics = metrics.components['Grid.js']
+        assert grid_metrics.jobs == 2
+        assert grid_metrics.network_time == metrics.network_time
+        assert grid_metrics.render_time == pytest.approx(0.02)
+        assert grid_metrics.html_bytes == len('<div>Grid.js</div>') * 2
+        assert grid_metrics.payload_bytes + metrics.components['Button.js'].payload_bytes == (
+            metrics.payload_bytes - len('{}') - 2 * len(', ')
+        )
+        assert metrics.components['Button.js'].render_time is None
+        assert plugin.get_histograms()[('render_seconds', 'Grid.js')].count == 1
+
+    def test_reports_failed_job_group_metrics(self, stub_server):
+        aggregator = MetricsAggregator()
+        plugin = mock.Mock(wraps=aggregator)
+        batch_request = self.create_batch_request(stub_server.url, plugin)
+        batch_request.render('Grid.js', {})
+        stub_server.responses.append((500, {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}}))
+
+        batch_request.submit()
+
+        (metrics, __), __ = plugin.on_metrics.call_args
+        assert metrics.error == HypernovaError('SadError', 'so sad', [])
+        assert metrics.html_bytes == 0
+        assert metrics.parse_time == 0
+        assert metrics.components['Grid.js'].html_bytes == 0
+        assert aggregator.error_count == 1
+
+    def test_coalesced_jobs_were_not_encoded(self, stub_server):
+        plugin = mock.Mock(wraps=MetricsAggregator())
+        coalescer = RenderCoalescer()
+        batch_request = self.create_batch_request(
+            stub_server.url,
+            plugin,
+            coalescer=coalescer,
+            transport='thread_pool',
+        )
+        batch_request.render('Grid.js', {})
+        batch_request.flush()
+        coalesced_batch_request = self.create_batch_request(stub_server.url, plugin, coalescer=coalescer)
+        coalesced_batch_request.render('Grid.js', {})
+
+        coalesced_batch_request.submit()
+
+        (metrics, __), __ = plugin.on_metrics.call_args
+        assert metrics.payload_bytes == len('{}')
+        assert metrics.components['Grid.js'].payload_bytes == 0
+        assert metrics.components['Grid.js'].html_bytes == len('<div>Grid.js</div>')
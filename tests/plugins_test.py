@@ -133,10 +133,46 @@ class TestPluginController:
         plugins[0].on_error.assert_called_once_with(err, jobs, pyramid_request)
         plugins[1].on_error.assert_called_once_with(err, jobs, pyramid_request)
 
+    def test_on_metrics(self, plugins, plugin_controller):
+        metrics = mock.Mock()
+        pyramid_request = mock.Mock()
+
+        plugin_controller.on_metrics(metrics, pyramid_request)
+        plugins[0].on_metrics.assert_called_once_with(metrics, pyramid_request)
+        plugins[1].on_metrics.assert_called_once_with(metrics, pyramid_request)
+
+    def test_on_metrics_skips_plugins_without_it(self):
+        plugin = mock.Mock(spec=['on_error'])
+
+        PluginController([plugin]).on_metrics(mock.Mock(), mock.Mock())
+
+    def test_on_circuit_state_change(self, plugins, plugin_controller):
+        pyramid_request = mock.Mock()
+
+        plugin_controller.on_circuit_state_change('http://localhost:8888', 'closed', 'open', pyramid_request)
+        for plugin in plugins:
+            plugin.on_circuit_state_change.assert_called_once_with(
+                'http://localhost:8888',
+                'closed',
+                'open',
+                pyramid_request,
+            )
+
+    def test_on_circuit_state_change_skips_plugins_without_it(self):
+        plugin = mock.Mock(spec=['on_error'])
+
+        PluginController([plugin]).on_circuit_state_change('http://localhost:8888', 'closed', 'open', mock.Mock())
+
 
 class TestBasePlugin:
     """Reducer functions on the BasePlugin should be identity functions."""
 
+    def test_on_metrics(self):
+        BasePlugin().on_metrics(mock.Mock(), mock.Mock())
+
+    def test_on_circuit_state_change(self):
+        BasePlugin().on_circuit_state_change('http://localhost:8888', 'closed', 'open', mock.Mock())
+
     def test_get_view_data(self):
         plugin = BasePlugin()
         data = mock.sentinel.data
@@ -0,0 +1,44 @@
+from unittest import mock
+
+from pyramid_hypernova.process import ProcessLocal
+from pyramid_hypernova.process import TokenBucket
+
+
+class TestProcessLocal:
+
+    def test_creates_value_once_per_process(self):
+        factory = mock.Mock(side_effect=[mock.sentinel.parent, mock.sentinel.child])
+        process_local = ProcessLocal(factory)
+
+        assert process_local.get() is mock.sentinel.parent
+        assert process_local.get() is mock.sentinel.parent
+        with mock.patch('pyramid_hypernova.process.os.getpid', return_value=-1):
+            assert process_local.get() is mock.sentinel.child
+            assert process_local.get() is mock.sentinel.child
+
+        assert factory.call_count == 2
+
+
+class TestTokenBucket:
+
+    def test_spend(self):
+        bucket = TokenBucket(ratio=0.5, burst=2, tokens=1)
+
+        assert bucket.spend()
+        assert not bucket.spend()
+
+        bucket.earn()
+        assert not bucket.spend()
+        bucket.earn()
+        assert bucket.spend()
+
+    def test_earns_up_to_burst(self):
+        bucket = TokenBucket(ratio=1, burst=2)
+
+        for __ in range(5):
+            bucket.earn()
+
+        assert bucket.tokens == 2
+        assert bucket.spend()
+        assert bucket.spend()
+        assert not bucket.spend()
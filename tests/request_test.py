@@ -1,17 +1,28 @@
+import time
+from concurrent.futures import Future
 from json import JSONEncoder
 from unittest import mock
 
 import pytest
+from crochet import TimeoutError as CrochetTimeoutError
+from fido.exceptions import HTTPTimeoutError
 from fido.exceptions import NetworkError
 from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectTimeout
 from requests.exceptions import HTTPError
 from requests.exceptions import JSONDecodeError
+from requests.exceptions import ReadTimeout
 
 from pyramid_hypernova.request import create_jobs_payload
+from pyramid_hypernova.request import encode_job_payload
 from pyramid_hypernova.request import ErrorData
 from pyramid_hypernova.request import format_response_error_data
 from pyramid_hypernova.request import HypernovaQuery
 from pyramid_hypernova.request import HypernovaQueryError
+from pyramid_hypernova.request import HypernovaQueryTimeoutError
+from pyramid_hypernova.transports import FidoTransport
+from pyramid_hypernova.transports import FutureResponse
+from pyramid_hypernova.transports import RequestsTransport
 from pyramid_hypernova.types import Job
 
 TEST_JOB_GROUP = {
@@ -22,21 +33,22 @@ TEST_JOB_GROUP = {
 
 @pytest.fixture
 def mock_fido_fetch():
-    with mock.patch('pyramid_hypernova.request.fido.fetch') as mock_fido_fetch:
+    with mock.patch('pyramid_hypernova.transports.fido.fetch') as mock_fido_fetch:
         yield mock_fido_fetch
 
 
 @pytest.fixture
 def mock_requests_post():
-    with mock.patch('pyramid_hypernova.request.requests.post') as mock_requests_post:
-        yield mock_requests_post
+    with mock.patch('pyramid_hypernova.transports.get_session') as mock_get_session:
+        yield mock_get_session.return_value.post
 
 
 @pytest.fixture
 def mock_requests_failed_post():
     # simulates when there's no healthy SSR host to send a request to
-    with mock.patch('pyramid_hypernova.request.requests.post', side_effect=ConnectionError()) as mock_requests_post:
-        yield mock_requests_post
+    with mock.patch('pyramid_hypernova.transports.get_session') as mock_get_session:
+        mock_get_session.return_value.post.side_effect = ConnectionError()
+        yield mock_get_session.return_value.post
 
 
 def test_create_jobs_payload():
@@ -75,10 +87,53 @@ def test_format_response_error_data(response_error_data, expected_result):
 
 class TestHypernovaQuery:
 
+    def test_encode_request_measures_each_job(self):
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {})
+
+        query.encode_request(TEST_JOB_GROUP)
+
+        assert query.job_bytes == JSONEncoder().encode(create_jobs_payload(TEST_JOB_GROUP)).encode('utf-8')
+        assert {identifier: encoded_job.payload_bytes for identifier, encoded_job in query.encoded_jobs.items()} == {
+            'yellow keycard': len(
+                '"yellow keycard": {"name": "open the exit door", "data": "behind the cacodemon", "context": {}}'
+            ),
+            'red skull key': len(
+                '"red skull key": {"name": "get the bfg9k", "data": "rocket jump from the platform", '
+                '"context": {"foo": "bar"}}'
+            ),
+        }
+
+    @pytest.mark.parametrize('synchronous,transport_class', [(True, RequestsTransport), (False, FidoTransport)])
+    def test_deprecated_synchronous_argument(self, synchronous, transport_class):
+        with pytest.warns(DeprecationWarning):
+            query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), synchronous, {})
+
+        assert isinstance(query.transport, transport_class)
+
+    def test_encode_request_reuses_encoded_payloads(self):
+        json_encoder = mock.Mock(wraps=JSONEncoder())
+        encoded_payload = encode_job_payload(TEST_JOB_GROUP['red skull key'], JSONEncoder())
+        query = HypernovaQuery(
+            TEST_JOB_GROUP,
+            'google.com',
+            json_encoder,
+            RequestsTransport(),
+            {},
+            encoded_payloads={'red skull key': encoded_payload._replace(encode_time=1)},
+        )
+
+        query.encode_request(TEST_JOB_GROUP)
+
+        assert query.job_bytes == JSONEncoder().encode(create_jobs_payload(TEST_JOB_GROUP)).encode('utf-8')
+        # the identifiers and the other job's payload
+        assert json_encoder.encode.call_count == 3
+        assert query.encoded_jobs['red skull key'].encode_time >= 1
+        assert query.encode_time >= 1
+
     def test_successful_send_synchronous(self, mock_fido_fetch, mock_requests_post):
         mock_requests_post.return_value.json.return_value = 'ayy lmao'
 
-        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), True, {'header1': 'value1'})
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {'header1': 'value1'})
         query.send()
 
         mock_fido_fetch.assert_not_called()
@@ -90,12 +145,13 @@ class TestHypernovaQuery:
             url='google.com',
             headers={'header1': 'value1', 'Content-Type': 'application/json'},
             data=mock.ANY,
+            timeout=(None, None),
         )
 
     def test_erroneous_send_synchronous(self, mock_fido_fetch, mock_requests_post):
         mock_requests_post.return_value.raise_for_status.side_effect = HTTPError('ayy lmao')
 
-        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), True, {})
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {})
         query.send()
 
         mock_fido_fetch.assert_not_called()
@@ -111,7 +167,7 @@ class TestHypernovaQuery:
         mock_resp.json.side_effect = JSONDecodeError('Expecting value', 'body', 0)
         mock_resp.text = 'Non-JSON Error Body'
 
-        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), True, {})
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {})
         query.send()
 
         mock_fido_fetch.assert_not_called()
@@ -124,6 +180,7 @@ class TestHypernovaQuery:
             url='google.com',
             headers={'Content-Type': 'application/json'},
             data=mock.ANY,
+            timeout=(None, None),
         )
         assert str(exc_info.value) == str(HypernovaQueryError(HTTPError('ayy lmao')))
         assert isinstance(exc_info.value.error_data, ErrorData)
@@ -133,7 +190,7 @@ class TestHypernovaQuery:
         mock_fido_fetch.return_value.wait.return_value.code = 200
         mock_fido_fetch.return_value.wait.return_value.json.return_value = 'ayy lmao'
 
-        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), False, {'header1': 'value1'})
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), FidoTransport(), {'header1': 'value1'})
         query.send()
 
         mock_fido_fetch.assert_called_once_with(
@@ -141,6 +198,8 @@ class TestHypernovaQuery:
             method='POST',
             headers={'header1': ['value1'], 'Content-Type': ['application/json']},
             body=mock.ANY,
+            timeout=None,
+            connect_timeout=None,
         )
         mock_requests_post.assert_not_called()
 
@@ -149,7 +208,7 @@ class TestHypernovaQuery:
     def test_erroneous_send_asynchronous(self, mock_fido_fetch, mock_requests_post):
         mock_fido_fetch.return_value.wait.side_effect = NetworkError('ayy lmao')
 
-        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), False, {})
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), FidoTransport(), {})
         query.send()
 
         mock_fido_fetch.assert_called_once()
@@ -164,7 +223,7 @@ class TestHypernovaQuery:
         mock_fido_fetch.return_value.wait.return_value.body = b'<h1>504 Bad Gateway</h1>'
         mock_fido_fetch.return_value.wait.return_value.json.side_effect = AssertionError()
 
-        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), False, {})
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), FidoTransport(), {})
         query.send()
 
         mock_fido_fetch.assert_called_once()
@@ -176,11 +235,146 @@ class TestHypernovaQuery:
             'Received response with status code 504 from Hypernova. Response body:\n'
             '<h1>504 Bad Gateway</h1>'
         )
+        assert exc_info.value.status_code == 504
 
     def test_does_not_throw_httperror_when_no_ssr_shard_available(self, mock_requests_failed_post):
         # WEBCORE-10219: throwing an error during query.send() returns an http error instead of a fallback response
         # instead, we should throw a HypernovaQueryError during query.json().
-        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), True, {})
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {})
         query.send()
         with pytest.raises(HypernovaQueryError):
             query.json()
+
+    def test_send_synchronous_with_timeouts(self, mock_requests_post):
+        mock_requests_post.return_value.json.return_value = 'ayy lmao'
+
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {}, timeout=(0.1, 2))
+        query.send()
+
+        assert query.json(timeout=1) == 'ayy lmao'
+        mock_requests_post.assert_called_once_with(
+            url='google.com',
+            headers={'Content-Type': 'application/json'},
+            data=mock.ANY,
+            timeout=(0.1, 1),
+        )
+
+    @pytest.mark.parametrize('error', [ReadTimeout('too slow'), ConnectTimeout('too slow')])
+    def test_timeout_send_synchronous(self, mock_requests_post, error):
+        mock_requests_post.side_effect = error
+
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {}, timeout=(0.1, 2))
+        query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError) as exc_info:
+            query.json()
+        assert str(exc_info.value) == 'too slow'
+
+    def test_send_asynchronous_with_timeouts(self, mock_fido_fetch):
+        mock_fido_fetch.return_value.wait.return_value.code = 200
+        mock_fido_fetch.return_value.wait.return_value.json.return_value = 'ayy lmao'
+
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), FidoTransport(), {}, timeout=(0.1, 2))
+        query.send()
+
+        mock_fido_fetch.assert_called_once_with(
+            url='google.com',
+            method='POST',
+            headers={'Content-Type': ['application/json']},
+            body=mock.ANY,
+            timeout=2,
+            connect_timeout=0.1,
+        )
+        assert query.json(timeout=1) == 'ayy lmao'
+        mock_fido_fetch.return_value.wait.assert_called_once_with(1)
+
+    @pytest.mark.parametrize('error', [CrochetTimeoutError(), HTTPTimeoutError('too slow')])
+    def test_timeout_send_asynchronous(self, mock_fido_fetch, error):
+        mock_fido_fetch.return_value.wait.side_effect = error
+
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), FidoTransport(), {})
+        query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            query.json(timeout=1)
+        mock_fido_fetch.return_value.cancel.assert_called_once_with()
+
+    def test_network_time_synchronous(self, mock_requests_post):
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {})
+        query.send()
+        # e.g. rendering the rest of the page
+        time.sleep(0.05)
+
+        query.json()
+
+        # the request is only sent once it's waited on
+        assert query.network_time < 0.05
+
+    def test_network_time_of_responses_received_in_the_background(self):
+        future = Future()
+        transport = mock.Mock()
+        transport.send.return_value = FutureResponse(future)
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), transport, {})
+        query.send()
+        future.set_result('ayy lmao')
+        # e.g. waiting on other job groups
+        time.sleep(0.05)
+
+        assert query.json() == 'ayy lmao'
+        assert query.network_time < 0.05
+
+    def test_network_time_ignores_responses_of_earlier_attempts(self):
+        transport = mock.Mock()
+        transport.send.side_effect = [FutureResponse(Future()), FutureResponse(Future())]
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), transport, {})
+        query.send()
+        earlier_response = query.response
+        query.send_request()
+
+        query.on_received(earlier_response)
+
+        assert query.received_at is None
+
+    def test_was_sent_synchronous(self, mock_requests_post):
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {})
+        assert not query.was_sent()
+        query.send()
+        assert not query.was_sent()
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            query.json(timeout=0)
+        assert not query.was_sent()
+
+        query.json()
+        assert query.was_sent()
+
+    def test_was_sent_in_the_background(self):
+        transport = mock.Mock()
+        transport.send.return_value = FutureResponse(Future())
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), transport, {})
+        assert not query.was_sent()
+
+        query.send()
+
+        assert query.was_sent()
+
+    def test_json_after_deadline_synchronous(self, mock_requests_post):
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), RequestsTransport(), {})
+        query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError) as exc_info:
+            query.json(timeout=-0.5)
+
+        assert str(exc_info.value) == 'Hypernova batch deadline exceeded'
+        mock_requests_post.assert_not_called()
+
+    def test_json_after_deadline_asynchronous(self, mock_fido_fetch):
+        mock_fido_fetch.return_value.wait.side_effect = CrochetTimeoutError()
+        query = HypernovaQuery(TEST_JOB_GROUP, 'google.com', JSONEncoder(), FidoTransport(), {})
+        query.send()
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            query.json(timeout=-0.5)
+
+        mock_fido_fetch.return_value.wait.assert_called_once_with(0)
+        mock_fido_fetch.return_value.cancel.assert_called_once_with()
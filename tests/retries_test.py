@@ -0,0 +1,222 @@
+import time
+from concurrent.futures import Future
+from json import JSONEncoder
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.coalescing import RenderCoalescer
+from pyramid_hypernova.plugins import BasePlugin
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.request import HypernovaQuery
+from pyramid_hypernova.retries import RetryPolicy
+from pyramid_hypernova.retries import RetryStats
+from pyramid_hypernova.transports import FutureResponse
+from pyramid_hypernova.transports import get_transport
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.transports import HypernovaQueryTimeoutError
+from pyramid_hypernova.types import Job
+from testing.hypernova_server import StubHypernovaServer
+
+HEADER_JOB = Job('Header.js', {'title': 'sup'}, {})
+RESPONSE_JSON = {'error': None, 'results': {'id-1': {'error': None, 'html': '<div>sup</div>'}}}
+
+
+@pytest.fixture
+def mock_sleep():
+    # Patching time.sleep itself would count other threads' sleeps too
+    with mock.patch('pyramid_hypernova.request.time', wraps=time) as mock_time:
+        mock_time.sleep = mock.Mock()
+        yield mock_time.sleep
+
+
+def create_transport(*outcomes):
+    """A transport whose responses, without callbacks, fail or succeed with
+    each outcome in turn.
+    """
+    transport = mock.Mock()
+    transport.send.side_effect = [mock.Mock(spec=['result', 'cancel'], **{'result.side_effect': [outcome]})
+                                  for outcome in outcomes]
+    return transport
+
+
+def create_query(transport, retry_policy, coalescer=None):
+    return HypernovaQuery(
+        {'id-1': HEADER_JOB},
+        'http://localhost:8888',
+        JSONEncoder(),
+        transport,
+        {},
+        coalescer=coalescer,
+        retry_policy=retry_policy,
+    )
+
+
+class TestRetryPolicy:
+
+    @pytest.mark.parametrize('error,expected', [
+        (HypernovaQueryError('connection refused'), True),
+        (HypernovaQueryError('bad gateway', status_code=502), True),
+        (HypernovaQueryError('unavailable', status_code=503), True),
+        (HypernovaQueryError('so sad', status_code=500), False),
+        (HypernovaQueryTimeoutError('too slow'), False),
+        (ValueError('not JSON'), False),
+    ])
+    def test_is_retryable(self, error, expected):
+        assert RetryPolicy().is_retryable(error) is expected
+
+    def test_is_retryable_with_status_codes(self):
+        retry_policy = RetryPolicy(status_codes=(500,))
+
+        assert retry_policy.is_retryable(HypernovaQueryError('so sad', status_code=500))
+        assert not retry_policy.is_retryable(HypernovaQueryError('unavailable', status_code=503))
+
+    @pytest.mark.parametrize('retry_count,expected_max', [(0, 0.01), (1, 0.02), (2, 0.04), (5, 0.1)])
+    def test_get_backoff(self, retry_count, expected_max):
+        retry_policy = RetryPolicy(backoff=0.01, max_backoff=0.1)
+
+        with mock.patch('pyramid_hypernova.retries.random.uniform', return_value=0.005) as mock_uniform:
+            assert retry_policy.get_backoff(retry_count) == 0.005
+
+        mock_uniform.assert_called_once_with(0, pytest.approx(expected_max))
+
+    def test_budget(self):
+        retry_policy = RetryPolicy(budget_ratio=0.5, budget_burst=2)
+
+        assert retry_policy.allow_retry()
+        assert retry_policy.allow_retry()
+        assert not retry_policy.allow_retry()
+
+        for __ in range(10):
+            retry_policy.record_query()
+        assert retry_policy.allow_retry()
+        assert retry_policy.allow_retry()
+        assert not retry_policy.allow_retry()
+        assert retry_policy.get_stats() == RetryStats(queries=10, retries=4, budget_exceeded=2)
+
+
+class TestRetriedQuery:
+
+    def test_retries_connection_error(self, mock_sleep):
+        transport = create_transport(HypernovaQueryError('connection refused'), RESPONSE_JSON)
+        retry_policy = RetryPolicy()
+        query = create_query(transport, retry_policy)
+        query.send()
+
+        assert query.json() == RESPONSE_JSON
+        assert transport.send.call_count == 2
+        assert query.retry_count == 1
+        assert mock_sleep.call_count == 1
+        assert retry_policy.get_stats() == RetryStats(queries=1, retries=1, budget_exceeded=0)
+
+    @pytest.mark.parametrize('error', [
+        HypernovaQueryTimeoutError('too slow'),
+        HypernovaQueryError('so sad', status_code=500),
+    ])
+    def test_does_not_retry_other_errors(self, mock_sleep, error):
+        transport = create_transport(error)
+        query = create_query(transport, RetryPolicy())
+        query.send()
+
+        with pytest.raises(HypernovaQueryError) as exc_info:
+            query.json()
+        assert exc_info.value is error
+        assert transport.send.call_count == 1
+        assert query.retry_count == 0
+
+    def test_does_not_retry_without_policy(self, mock_sleep):
+        transport = create_transport(HypernovaQueryError('connection refused'))
+        query = create_query(transport, None)
+        query.send()
+
+        with pytest.raises(HypernovaQueryError):
+            query.json()
+        assert transport.send.call_count == 1
+
+    def test_max_retries(self, mock_sleep):
+        transport = create_transport(*[HypernovaQueryError('unavailable', status_code=503)] * 3)
+        query = create_query(transport, RetryPolicy(max_retries=2))
+        query.send()
+
+        with pytest.raises(HypernovaQueryError):
+            query.json()
+        assert transport.send.call_count == 3
+        assert query.retry_count == 2
+
+    def test_does_not_retry_past_deadline(self, mock_sleep):
+        transport = create_transport(HypernovaQueryError('connection refused'))
+        query = create_query(transport, RetryPolicy(backoff=1, max_backoff=1))
+        query.send()
+
+        with mock.patch('pyramid_hypernova.retries.random.uniform', return_value=1):
+            with pytest.raises(HypernovaQueryError):
+                query.json(timeout=0.5)
+        assert transport.send.call_count == 1
+        mock_sleep.assert_not_called()
+
+    def test_retries_within_deadline(self, mock_sleep):
+        transport = create_transport(HypernovaQueryError('connection refused'), RESPONSE_JSON)
+        query = create_query(transport, RetryPolicy())
+        query.send()
+
+        first_response = query.response
+
+        assert query.json(timeout=5) == RESPONSE_JSON
+        first_response.result.assert_called_once_with(5)
+        (retry_timeout,), __ = query.response.result.call_args
+        assert 0 < retry_timeout < 5
+
+    def test_does_not_retry_without_budget(self, mock_sleep):
+        transport = create_transport(HypernovaQueryError('connection refused'))
+        retry_policy = RetryPolicy(budget_burst=0)
+        query = create_query(transport, retry_policy)
+        query.send()
+
+        with pytest.raises(HypernovaQueryError):
+            query.json()
+        assert transport.send.call_count == 1
+        assert retry_policy.get_stats() == RetryStats(queries=1, retries=0, budget_exceeded=1)
+
+    def test_coalesced_renders_wait_on_retry(self, mock_sleep):
+        coalescer = RenderCoalescer()
+        future = Future()
+        transport = mock.Mock()
+        transport.send.side_effect = [FutureResponse(future), mock.Mock(**{'result.return_value': RESPONSE_JSON})]
+        query = create_query(transport, RetryPolicy(), coalescer)
+        coalesced_query = create_query(transport, RetryPolicy(), coalescer)
+        query.send()
+        coalesced_query.send()
+
+        future.set_exception(HypernovaQueryError('connection refused'))
+
+        # the failed query is retried rather than handing its error over
+        assert coalescer.in_flight != {}
+        assert query.json() == RESPONSE_JSON
+        assert coalesced_query.json(timeout=0)['results'] == {'id-1': {'error': None, 'html': '<div>sup</div>'}}
+        assert coalescer.in_flight == {}
+
+
+def test_retries_unavailable_upstream():
+    plugin = mock.Mock(wraps=BasePlugin())
+    retry_policy = RetryPolicy()
+
+    with StubHypernovaServer() as stub_server:
+        stub_server.responses.append((503, b'Service Unavailable'))
+        batch_request = BatchRequest(
+            get_job_group_url=lambda job_group, pyramid_request: stub_server.url,
+            plugin_controller=PluginController([plugin]),
+            pyramid_request=pyramid.request.Request.blank('/'),
+            transport=get_transport('thread_pool'),
+            retry_policy=retry_policy,
+        )
+        token = batch_request.render('MyComponent.js', {})
+        response = batch_request.submit()
+
+    assert response[token.identifier].error is None
+    assert response[token.identifier].html == '<div>MyComponent.js</div>'
+    assert len(stub_server.requests) == 2
+    (metrics, __), __ = plugin.on_metrics.call_args
+    assert metrics.retries == 1
+    assert retry_policy.get_stats() == RetryStats(queries=1, retries=1, budget_exceeded=0)
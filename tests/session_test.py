@@ -0,0 +1,87 @@
+from unittest import mock
+
+import pytest
+
+from pyramid_hypernova import session
+from pyramid_hypernova.session import ConnectionStats
+from pyramid_hypernova.session import create_session
+from pyramid_hypernova.session import DEFAULT_POOL_SIZE
+from testing.hypernova_server import StubHypernovaServer
+
+
+@pytest.fixture
+def stub_server():
+    with StubHypernovaServer() as stub_server:
+        yield stub_server
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_session():
+    with mock.patch.object(session, '_session', None):
+        yield
+
+
+def test_create_session_configures_pool():
+    created_session = create_session(pool_size=3, max_retries=2)
+    adapter = created_session.get_adapter('http://')
+
+    assert adapter is created_session.get_adapter('https://')
+    assert adapter._pool_maxsize == 3
+    assert adapter.max_retries.total == 2
+    assert created_session.headers['Connection'] == 'keep-alive'
+
+
+def test_create_session_without_keep_alive():
+    created_session = create_session(keep_alive=False)
+
+    assert created_session.headers['Connection'] == 'close'
+
+
+def test_session_reuses_connections(stub_server):
+    created_session = create_session()
+
+    for _ in range(3):
+        response = created_session.post(stub_server.url, json={'a': {'name': 'A.js', 'data': {}, 'context': {}}})
+        assert response.json()['results']['a']['html'] == '<div>A.js</div>'
+
+    assert created_session.get_adapter('http://').get_stats() == ConnectionStats(requests=3, connections=1, reused=2)
+
+
+def test_session_does_not_reuse_connections_without_keep_alive(stub_server):
+    created_session = create_session(keep_alive=False)
+
+    for _ in range(2):
+        created_session.post(stub_server.url, json={})
+
+    assert created_session.get_adapter('http://').get_stats() == ConnectionStats(requests=2, connections=2, reused=0)
+
+
+def test_session_does_not_keep_cookies(stub_server):
+    created_session = create_session()
+    stub_server.headers['Set-Cookie'] = 'session=secret'
+
+    created_session.post(stub_server.url, json={})
+
+    assert len(created_session.cookies) == 0
+
+
+def test_get_session_creates_default_session_once():
+    shared_session = session.get_session()
+
+    assert session.get_session() is shared_session
+    assert shared_session.get_adapter('http://')._pool_maxsize == DEFAULT_POOL_SIZE
+
+
+def test_configure_session_replaces_shared_session():
+    default_session = session.get_session()
+
+    session.configure_session(pool_size=2)
+
+    assert session.get_session() is not default_session
+    assert session.get_session().get_adapter('http://')._pool_maxsize == 2
+
+
+def test_get_connection_stats(stub_server):
+    session.get_session().post(stub_server.url, json={})
+
+    assert session.get_connection_stats() == ConnectionStats(requests=1, connections=1, reused=0)
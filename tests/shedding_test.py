@@ -0,0 +1,113 @@
+from unittest import mock
+
+import pytest
+
+from pyramid_hypernova.shedding import HIGH_PRIORITY
+from pyramid_hypernova.shedding import LoadShedder
+from pyramid_hypernova.shedding import LoadStats
+from pyramid_hypernova.shedding import LOW_PRIORITY
+from pyramid_hypernova.shedding import NORMAL_PRIORITY
+from pyramid_hypernova.types import Job
+
+
+@pytest.fixture
+def mock_monotonic():
+    with mock.patch('pyramid_hypernova.shedding.time.monotonic', return_value=100) as mock_monotonic:
+        yield mock_monotonic
+
+
+def finish_queries(load_shedder, *latencies):
+    for latency in latencies:
+        load_shedder.finish_query(load_shedder.start_query(), latency)
+
+
+class TestLoadShedder:
+
+    def test_no_pressure_without_queries(self):
+        load_shedder = LoadShedder(max_in_flight=10)
+
+        assert load_shedder.get_pressure() == 0
+        assert load_shedder.get_min_priority() is None
+
+    def test_latency_pressure(self, mock_monotonic):
+        load_shedder = LoadShedder(target_latency=0.2, latency_weight=0.5)
+
+        finish_queries(load_shedder, 0.2)
+        assert load_shedder.get_pressure() == pytest.approx(1)
+
+        finish_queries(load_shedder, 0.6)
+        assert load_shedder.get_pressure() == pytest.approx(2)
+
+    def test_in_flight_pressure(self, mock_monotonic):
+        load_shedder = LoadShedder(max_in_flight=4)
+
+        tokens = [load_shedder.start_query() for __ in range(3)]
+        assert load_shedder.get_pressure() == 0.75
+
+        load_shedder.finish_query(tokens[0], 0.01)
+        assert load_shedder.get_pressure() == 0.5
+
+    def test_queries_not_waited_on_stop_counting(self, mock_monotonic):
+        load_shedder = LoadShedder(max_in_flight=1, stale_after=60)
+        load_shedder.start_query()
+        assert load_shedder.get_pressure() == 1
+
+        mock_monotonic.return_value = 160
+
+        assert load_shedder.get_pressure() == 0
+
+    def test_forgets_stale_latency(self, mock_monotonic):
+        load_shedder = LoadShedder(target_latency=0.2, stale_after=60)
+        finish_queries(load_shedder, 1)
+
+        mock_monotonic.return_value = 159
+        assert load_shedder.get_pressure() == 5
+
+        mock_monotonic.return_value = 160
+        assert load_shedder.get_pressure() == 0
+
+        finish_queries(load_shedder, 0.1)
+        assert load_shedder.get_pressure() == 0.5
+
+    @pytest.mark.parametrize('latency,expected', [
+        (0.1, None),
+        (0.2, NORMAL_PRIORITY),
+        (0.39, NORMAL_PRIORITY),
+        (0.4, HIGH_PRIORITY),
+    ])
+    def test_get_min_priority(self, mock_monotonic, latency, expected):
+        load_shedder = LoadShedder(target_latency=0.2, severe_pressure=2)
+        finish_queries(load_shedder, latency)
+
+        assert load_shedder.get_min_priority() == expected
+
+    @pytest.mark.parametrize('latency,expected_sent', [
+        (0.1, ['low', 'normal', 'default', 'high']),
+        (0.2, ['normal', 'default', 'high']),
+        (1, ['high']),
+    ])
+    def test_shed_jobs(self, mock_monotonic, latency, expected_sent):
+        load_shedder = LoadShedder(target_latency=0.2)
+        finish_queries(load_shedder, latency)
+        jobs = {identifier: Job('MyComponent.js', {}, {}) for identifier in ('low', 'normal', 'default', 'high')}
+        priorities = {'low': LOW_PRIORITY, 'normal': NORMAL_PRIORITY, 'high': HIGH_PRIORITY}
+
+        sent_jobs, shed_jobs = load_shedder.shed_jobs(jobs, priorities)
+
+        assert list(sent_jobs) == expected_sent
+        assert list(shed_jobs) == [identifier for identifier in jobs if identifier not in expected_sent]
+        assert load_shedder.get_stats().shed == len(shed_jobs)
+
+    def test_cancel_query(self, mock_monotonic):
+        load_shedder = LoadShedder(max_in_flight=1)
+
+        load_shedder.cancel_query(load_shedder.start_query())
+
+        assert load_shedder.get_stats() == LoadStats(latency=None, in_flight=0, shed=0)
+
+    def test_get_stats(self, mock_monotonic):
+        load_shedder = LoadShedder()
+        finish_queries(load_shedder, 0.1)
+        load_shedder.start_query()
+
+        assert load_shedder.get_stats() == LoadStats(latency=0.1, in_flight=1, shed=0)
@@ -1,7 +1,13 @@
 from unittest import mock
 
+import pytest
+
 from pyramid_hypernova.rendering import RenderToken
 from pyramid_hypernova.token_replacement import hypernova_token_replacement
+from pyramid_hypernova.token_replacement import MAX_RENDER_TOKEN_LENGTH
+from pyramid_hypernova.token_replacement import replace_render_tokens
+from pyramid_hypernova.token_replacement import replace_render_tokens_in_bytes
+from pyramid_hypernova.token_replacement import StreamingTokenReplacer
 from pyramid_hypernova.types import JobResult
 
 
@@ -45,3 +51,160 @@ def test_hypernova_token_replacement_no_content_written_to_body():
 
     assert mock_hypernova_batch.submit.called
     assert body['content'] == ''
+
+
+def test_hypernova_token_replacement_with_multiple_tokens():
+    tokens = [RenderToken(f'id-{i}') for i in range(3)]
+    content = '<main>{}<hr>{}<hr>{}</main>'.format(*tokens)
+
+    mock_hypernova_batch = mock.Mock()
+    mock_hypernova_batch.submit.return_value = {
+        token.identifier: JobResult(error=None, html=f'<div>{token.identifier}</div>', job=None)
+        for token in tokens
+    }
+
+    with hypernova_token_replacement(mock_hypernova_batch) as body:
+        body['content'] = content
+
+    assert body['content'] == '<main><div>id-0</div><hr><div>id-1</div><hr><div>id-2</div></main>'
+
+
+def test_replace_render_tokens_leaves_unknown_tokens():
+    known_token = RenderToken('known-id')
+    unknown_token = RenderToken('unknown-id')
+    content = f'{known_token}{unknown_token}{known_token}'
+
+    result = replace_render_tokens(content, {
+        'known-id': JobResult(error=None, html='<b>known</b>', job=None),
+    })
+
+    assert result == f'<b>known</b>{unknown_token}<b>known</b>'
+
+
+def test_replace_render_tokens_does_not_rescan_replaced_html():
+    token = RenderToken('outer-id')
+    nested_token = RenderToken('inner-id')
+
+    result = replace_render_tokens(str(token), {
+        'outer-id': JobResult(error=None, html=f'<div>{nested_token}</div>', job=None),
+        'inner-id': JobResult(error=None, html='<b>inner</b>', job=None),
+    })
+
+    assert result == f'<div>{nested_token}</div>'
+
+
+@pytest.mark.parametrize('stray', [
+    '<script>var s = "<!--hypernova-render-token-";</script>',
+    '<!--hypernova-render-token-' + 'x' * 200,
+])
+def test_replace_render_tokens_after_stray_prefix(stray):
+    token = RenderToken('my-unique-id')
+    job_results = {'my-unique-id': JobResult(error=None, html='<div>REACT!</div>', job=None)}
+
+    assert replace_render_tokens(f'{stray}{token}', job_results) == f'{stray}<div>REACT!</div>'
+    assert replace_render_tokens_in_bytes(f'{stray}{token}'.encode('utf-8'), job_results) == (
+        f'{stray}<div>REACT!</div>'.encode('utf-8')
+    )
+
+
+@pytest.mark.parametrize('content', [
+    '<div>no tokens here</div>',
+    '<div><!--hypernova-render-token-unterminated</div>',
+])
+def test_replace_render_tokens_returns_content_without_complete_tokens(content):
+    result = replace_render_tokens(content, {
+        'my-unique-id': JobResult(error=None, html='<div>REACT!</div>', job=None),
+    })
+
+    assert result is content
+
+
+def test_replace_render_tokens_in_bytes():
+    content = '<p>héllo</p>{}<p>wörld</p>{}'.format(
+        RenderToken('my-unique-id'),
+        RenderToken('unknown-id'),
+    ).encode('utf-8')
+
+    result = replace_render_tokens_in_bytes(content, {
+        'my-unique-id': JobResult(error=None, html='<div>RÉACT!</div>', job=None),
+    })
+
+    assert result == '<p>héllo</p><div>RÉACT!</div><p>wörld</p>{}'.format(
+        RenderToken('unknown-id'),
+    ).encode('utf-8')
+
+
+@pytest.mark.parametrize('job_results', [
+    {},
+    {'my-unique-id': JobResult(error=None, html='<div>REACT!</div>', job=None)},
+])
+def test_replace_render_tokens_in_bytes_returns_content_without_matching_tokens(job_results):
+    content = '<div>no tokens for {}</div>'.format(RenderToken('unknown-id')).encode('utf-8')
+
+    assert replace_render_tokens_in_bytes(content, job_results) is content
+
+
+class TestStreamingTokenReplacer:
+
+    @pytest.fixture
+    def job_results(self):
+        return {
+            'my-unique-id': JobResult(error=None, html='<div>RÉACT!</div>', job=None),
+        }
+
+    def replace_in_chunks(self, replacer, chunks):
+        output = [replacer.feed(chunk) for chunk in chunks]
+        output.append(replacer.flush())
+        return output
+
+    def test_replaces_token_split_at_every_position(self, job_results):
+        content = '<head></head>{}<footer/>'.format(RenderToken('my-unique-id')).encode('utf-8')
+
+        for split in range(len(content) + 1):
+            replacer = StreamingTokenReplacer(lambda: job_results)
+            output = self.replace_in_chunks(replacer, [content[:split], content[split:]])
+
+            assert b''.join(output) == '<head></head><div>RÉACT!</div><footer/>'.encode('utf-8')
+
+    def test_replaces_token_split_across_many_chunks(self, job_results):
+        content = str(RenderToken('my-unique-id')).encode('utf-8')
+        replacer = StreamingTokenReplacer(lambda: job_results)
+
+        output = self.replace_in_chunks(replacer, [content[i:i + 3] for i in range(0, len(content), 3)])
+
+        assert b''.join(output) == '<div>RÉACT!</div>'.encode('utf-8')
+
+    def test_emits_content_before_partial_token_right_away(self, job_results):
+        get_job_results = mock.Mock(return_value=job_results)
+        replacer = StreamingTokenReplacer(get_job_results)
+
+        assert replacer.feed(b'<head></head><!--hypernova-render') == b'<head></head>'
+        assert replacer.buffer == b'<!--hypernova-render'
+        assert not get_job_results.called
+
+        assert replacer.feed(b'-token-my-unique-id--><body>') == '<div>RÉACT!</div><body>'.encode('utf-8')
+        assert replacer.buffer == b''
+
+    def test_releases_partial_prefix_that_is_not_a_token(self, job_results):
+        replacer = StreamingTokenReplacer(lambda: job_results)
+
+        assert replacer.feed(b'<p>a</p><!--hyper') == b'<p>a</p>'
+        assert replacer.feed(b'text--><p>b</p>') == b'<!--hypertext--><p>b</p>'
+        assert replacer.flush() == b''
+
+    def test_buffer_is_bounded_by_token_length(self, job_results):
+        replacer = StreamingTokenReplacer(lambda: job_results)
+
+        assert replacer.feed(b'<p>a</p><!--hypernova-render-token-') == b'<p>a</p>'
+        output = [replacer.feed(b'x' * 10) for _ in range(MAX_RENDER_TOKEN_LENGTH)]
+
+        assert len(replacer.buffer) < MAX_RENDER_TOKEN_LENGTH
+        expected = b'<!--hypernova-render-token-' + b'x' * 10 * MAX_RENDER_TOKEN_LENGTH
+        assert b''.join(output) + replacer.flush() == expected
+
+    def test_flush_returns_incomplete_token(self, job_results):
+        replacer = StreamingTokenReplacer(lambda: job_results)
+
+        assert replacer.feed(b'<p>a</p><!--hypernova-render-token-my-') == b'<p>a</p>'
+        assert replacer.flush() == b'<!--hypernova-render-token-my-'
+        assert replacer.buffer == b''
@@ -0,0 +1,327 @@
+import http.client
+import os
+import socket
+import tempfile
+from concurrent.futures import Future
+from unittest import mock
+
+import pytest
+
+from pyramid_hypernova import transports
+from pyramid_hypernova.aio import asyncio_transport
+from pyramid_hypernova.request import HypernovaQueryError
+from pyramid_hypernova.request import HypernovaQueryTimeoutError
+from pyramid_hypernova.session import ConnectionStats
+from pyramid_hypernova.session import create_session
+from pyramid_hypernova.transports import BaseTransport
+from pyramid_hypernova.transports import FidoTransport
+from pyramid_hypernova.transports import FutureResponse
+from pyramid_hypernova.transports import get_transport
+from pyramid_hypernova.transports import min_timeout
+from pyramid_hypernova.transports import register_transport
+from pyramid_hypernova.transports import RequestsTransport
+from pyramid_hypernova.transports import ThreadPoolTransport
+from pyramid_hypernova.transports import UnixSocketTransport
+from testing.hypernova_server import StubHypernovaServer
+
+TEST_BODY = b'{"yellow keycard": {"name": "open the exit door", "data": {}, "context": {}}}'
+TEST_HEADERS = {'Content-Type': 'application/json'}
+
+
+@pytest.fixture
+def restore_registry():
+    with mock.patch.dict(transports._transport_factories), mock.patch.dict(transports._transports):
+        yield
+
+
+@pytest.fixture
+def stub_server():
+    with StubHypernovaServer() as stub_server:
+        yield stub_server
+
+
+@pytest.fixture
+def socket_path():
+    # tmp_path can be longer than a Unix domain socket path is allowed to be
+    with tempfile.TemporaryDirectory() as directory:
+        yield os.path.join(directory, 'hypernova.sock')
+
+
+@pytest.fixture
+def unix_stub_server(socket_path):
+    with StubHypernovaServer(address=socket_path) as stub_server:
+        yield stub_server
+
+
+@pytest.fixture
+def slow_stub_server():
+    with StubHypernovaServer(delay=0.5) as stub_server:
+        yield stub_server
+
+
+@pytest.mark.parametrize('timeouts,expected', [
+    ((None, None), None),
+    ((1, None), 1),
+    ((None, 2, 0.5), 0.5),
+])
+def test_min_timeout(timeouts, expected):
+    assert min_timeout(*timeouts) == expected
+
+
+class TestFutureResponse:
+
+    def test_result(self):
+        future = Future()
+        future.set_result({'error': None, 'results': {}})
+
+        assert FutureResponse(future).result(timeout=-1) == {'error': None, 'results': {}}
+
+    def test_result_raises_query_error(self):
+        future = Future()
+        future.set_exception(HypernovaQueryError('oh no'))
+
+        with pytest.raises(HypernovaQueryError):
+            FutureResponse(future).result()
+
+    def test_result_times_out(self):
+        future = Future()
+
+        with pytest.raises(HypernovaQueryTimeoutError) as exc_info:
+            FutureResponse(future).result(timeout=0.01)
+
+        assert str(exc_info.value) == 'Hypernova batch deadline exceeded'
+        assert future.cancelled()
+
+    def test_add_done_callback(self):
+        future = Future()
+        response = FutureResponse(future)
+        callback = mock.Mock()
+
+        response.add_done_callback(callback)
+        assert not callback.called
+
+        future.set_result({'error': None, 'results': {}})
+        callback.assert_called_once_with(response)
+
+    def test_add_done_callback_skips_cancelled_response(self):
+        response = FutureResponse(Future())
+        callback = mock.Mock()
+
+        response.add_done_callback(callback)
+        response.cancel()
+
+        assert not callback.called
+
+
+class TestThreadPoolTransport:
+
+    def test_send(self, stub_server):
+        transport = ThreadPoolTransport(max_workers=2)
+
+        responses = [transport.send(stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)) for _ in range(3)]
+
+        for response in responses:
+            assert response.result(1) == {
+                'error': None,
+                'results': {'yellow keycard': {'error': None, 'html': '<div>open the exit door</div>'}},
+            }
+        assert len(stub_server.requests) == 3
+
+    def test_send_with_session(self, stub_server):
+        session = create_session()
+        transport = ThreadPoolTransport(session=session)
+
+        transport.send(stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+        assert session.get_adapter('http://').get_stats().requests == 1
+
+    def test_send_error_status(self, stub_server):
+        stub_server.responses.append((500, {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}}))
+        transport = ThreadPoolTransport()
+
+        with pytest.raises(HypernovaQueryError) as exc_info:
+            transport.send(stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+        assert exc_info.value.error_data.name == 'SadError'
+        assert exc_info.value.status_code == 500
+
+    def test_send_read_timeout(self, slow_stub_server):
+        transport = ThreadPoolTransport()
+
+        with pytest.raises(HypernovaQueryTimeoutError):
+            transport.send(slow_stub_server.url, TEST_BODY, TEST_HEADERS, (1, 0.05)).result(1)
+
+    def test_creates_executor_once_per_process(self):
+        transport = ThreadPoolTransport()
+        executor = transport.get_executor()
+
+        assert transport.get_executor() is executor
+        with mock.patch('pyramid_hypernova.process.os.getpid', return_value=-1):
+            assert transport.get_executor() is not executor
+
+
+class TestUnixSocketTransport:
+
+    def test_send(self, unix_stub_server):
+        transport = UnixSocketTransport()
+
+        response = transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None))
+
+        assert response.result(1) == {
+            'error': None,
+            'results': {'yellow keycard': {'error': None, 'html': '<div>open the exit door</div>'}},
+        }
+        path, headers, jobs = unix_stub_server.requests[0]
+        assert path == '/batch'
+        assert headers['Content-Type'] == 'application/json'
+
+    def test_send_to_request_path(self, unix_stub_server):
+        transport = UnixSocketTransport(request_path='/render')
+
+        transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+        assert unix_stub_server.requests[0][0] == '/render'
+
+    def test_reuses_connections(self, unix_stub_server):
+        transport = UnixSocketTransport()
+
+        for _ in range(3):
+            transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+        assert transport.get_stats() == ConnectionStats(requests=3, connections=1, reused=2)
+
+    def test_does_not_reuse_closed_connections(self, unix_stub_server):
+        unix_stub_server.headers['Connection'] = 'close'
+        transport = UnixSocketTransport()
+
+        for _ in range(2):
+            transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+        assert transport.get_stats() == ConnectionStats(requests=2, connections=2, reused=0)
+
+    def test_reconnects_when_idle_connection_was_closed(self, unix_stub_server, socket_path):
+        transport = UnixSocketTransport()
+        transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+        transport.idle_connections.get()[socket_path][0].sock.shutdown(socket.SHUT_RDWR)
+
+        response = transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None))
+
+        assert response.result(1)['error'] is None
+        assert transport.get_stats() == ConnectionStats(requests=2, connections=2, reused=0)
+        assert len(unix_stub_server.requests) == 2
+
+    def test_does_not_reuse_connections_after_fork(self, unix_stub_server):
+        transport = UnixSocketTransport()
+        transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+        with mock.patch('pyramid_hypernova.process.os.getpid', return_value=-1):
+            transport.post(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None))
+
+        assert transport.get_stats() == ConnectionStats(requests=2, connections=2, reused=0)
+
+    def test_closes_connections_over_pool_size(self, socket_path):
+        transport = UnixSocketTransport(pool_size=1)
+        connections = [mock.Mock(), mock.Mock()]
+
+        for connection in connections:
+            transport.release_connection(socket_path, connection)
+
+        assert transport.idle_connections.get()[socket_path] == connections[:1]
+        assert not connections[0].close.called
+        connections[1].close.assert_called_once_with()
+
+    @pytest.mark.parametrize('response,error_data', [
+        (
+            {'error': {'name': 'SadError', 'message': 'so sad', 'stack': []}},
+            ('SadError', 'so sad', []),
+        ),
+        (b'Bad Gateway', (None, 'Bad Gateway', None)),
+        (b'', (None, 'SSRS did not return any content', None)),
+    ])
+    def test_send_error_status(self, unix_stub_server, response, error_data):
+        unix_stub_server.responses.append((502, response))
+        transport = UnixSocketTransport()
+
+        with pytest.raises(HypernovaQueryError) as exc_info:
+            transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+        assert str(exc_info.value) == 'Received response with status code 502 from Hypernova'
+        assert exc_info.value.error_data == error_data
+        assert exc_info.value.status_code == 502
+
+    def test_send_read_timeout(self, socket_path):
+        transport = UnixSocketTransport()
+
+        with StubHypernovaServer(delay=0.5, address=socket_path) as stub_server:
+            with pytest.raises(HypernovaQueryTimeoutError):
+                transport.send(stub_server.url, TEST_BODY, TEST_HEADERS, (None, 0.05)).result(1)
+
+    def test_send_without_server(self, socket_path):
+        transport = UnixSocketTransport()
+
+        with pytest.raises(HypernovaQueryError):
+            transport.send(f'unix://{socket_path}', TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+    def test_send_incomplete_response(self, unix_stub_server):
+        transport = UnixSocketTransport()
+
+        with mock.patch.object(transport, 'request', side_effect=http.client.IncompleteRead(b'')):
+            with pytest.raises(HypernovaQueryError):
+                transport.send(unix_stub_server.url, TEST_BODY, TEST_HEADERS, (None, None)).result(1)
+
+
+def test_base_transport_send():
+    with pytest.raises(NotImplementedError):
+        BaseTransport().send('http://localhost:8888', b'{}', {}, (None, None))
+
+
+@pytest.mark.parametrize('name,transport_class', [
+    ('requests', RequestsTransport),
+    ('fido', FidoTransport),
+    ('thread_pool', ThreadPoolTransport),
+    ('unix', UnixSocketTransport),
+])
+def test_get_transport_by_name(name, transport_class):
+    transport = get_transport(name)
+
+    assert isinstance(transport, transport_class)
+    assert get_transport(name) is transport
+
+
+def test_get_asyncio_transport_by_name():
+    assert get_transport('asyncio') is asyncio_transport
+
+
+def test_get_transport_returns_transports_as_is():
+    transport = mock.Mock()
+
+    assert get_transport(transport) is transport
+
+
+def test_get_transport_unknown_name():
+    with pytest.raises(ValueError) as exc_info:
+        get_transport('carrier pigeon')
+
+    assert str(exc_info.value) == (
+        "Unknown Hypernova transport 'carrier pigeon', "
+        'expected one of: asyncio, fido, http2, requests, thread_pool, unix'
+    )
+
+
+@pytest.mark.usefixtures('restore_registry')
+def test_register_transport():
+    factory = mock.Mock()
+    register_transport('carrier pigeon', factory)
+
+    assert get_transport('carrier pigeon') is factory.return_value
+    assert get_transport('carrier pigeon') is factory.return_value
+    factory.assert_called_once_with()
+
+
+@pytest.mark.usefixtures('restore_registry')
+def test_register_transport_replaces_transport():
+    default_transport = get_transport('requests')
+
+    register_transport('requests', mock.Mock)
+
+    assert get_transport('requests') is not default_transport
@@ -4,6 +4,7 @@ import pytest
 from pyramid.response import Response
 
 from pyramid_hypernova.rendering import RenderToken
+from pyramid_hypernova.tweens import format_server_timing
 from pyramid_hypernova.tweens import hypernova_tween_factory
 from pyramid_hypernova.types import JobResult
 
@@ -57,6 +58,37 @@ class TestTweens:
             display_error_stack=True
         )
 
+    def test_configure_hypernova_batch_passes_optional_settings(self):
+        self.mock_registry.settings['pyramid_hypernova.send_on_render'] = True
+        response = self.tween(self.mock_request)
+
+        # Access the response's body to ensure the batch request is made
+        response.body
+
+        self.mock_batch_request_factory.assert_called_once_with(
+            get_job_group_url=self.mock_get_job_group_url,
+            plugin_controller=mock.ANY,
+            json_encoder=self.mock_json_encoder,
+            pyramid_request=self.mock_request,
+            display_error_stack=False,
+            send_on_render=True,
+        )
+
+    def test_tween_factory_configures_shared_session(self):
+        self.mock_registry.settings['pyramid_hypernova.http_pool_size'] = 25
+        self.mock_registry.settings['pyramid_hypernova.http_keep_alive'] = False
+
+        with mock.patch('pyramid_hypernova.tweens.configure_session') as mock_configure_session:
+            hypernova_tween_factory(mock.Mock(), self.mock_registry)
+
+        mock_configure_session.assert_called_once_with(pool_size=25, keep_alive=False)
+
+    def test_tween_factory_keeps_default_session(self):
+        with mock.patch('pyramid_hypernova.tweens.configure_session') as mock_configure_session:
+            hypernova_tween_factory(mock.Mock(), self.mock_registry)
+
+        assert not mock_configure_session.called
+
     def test_tween_replaces_tokens_when_disable_hypernova_tween_not_set(self):
         del self.mock_request.disable_hypernova_tween
 
@@ -135,3 +167,164 @@ class TestTweens:
 
         assert not self.mock_batch_request_factory.return_value.submit.called
         assert response == mock_response
+
+    def test_tween_passes_through_chunks_without_tokens(self):
+        del self.mock_request.disable_hypernova_tween
+        chunks = ['<head>héad</head>'.encode(), str(self.token).encode('utf-8'), b'<footer/>']
+        mock_handler = mock.Mock()
+        mock_handler.return_value = Response(app_iter=chunks)
+        tween = hypernova_tween_factory(mock_handler, self.mock_registry)
+
+        response = tween(self.mock_request)
+        app_iter = iter(response.app_iter)
+
+        assert next(app_iter) is chunks[0]
+        assert not self.mock_batch_request_factory.return_value.submit.called
+        assert next(app_iter) == b'<div>REACT!</div>'
+        assert next(app_iter) is chunks[2]
+        assert self.mock_batch_request_factory.return_value.submit.call_count == 1
+
+    def test_tween_replaces_token_split_across_chunks(self):
+        del self.mock_request.disable_hypernova_tween
+        token = str(self.token).encode('utf-8')
+        mock_handler = mock.Mock()
+        mock_handler.return_value = Response(app_iter=[b'<head/>', token[:10], token[10:] + b'<footer/>'])
+        tween = hypernova_tween_factory(mock_handler, self.mock_registry)
+
+        response = tween(self.mock_request)
+
+        assert list(response.app_iter) == [b'<head/>', b'<div>REACT!</div><footer/>']
+
+    def test_tween_releases_held_back_content_when_disabled_mid_stream(self):
+        self.mock_request.disable_hypernova_tween = False
+        token = str(self.token).encode('utf-8')
+
+        def app_iter():
+            yield b'<head/>' + token[:10]
+            self.mock_request.disable_hypernova_tween = True
+            yield token[10:]
+
+        mock_handler = mock.Mock()
+        mock_handler.return_value = Response(app_iter=app_iter())
+        tween = hypernova_tween_factory(mock_handler, self.mock_registry)
+
+        response = tween(self.mock_request)
+
+        assert list(response.app_iter) == [b'<head/>', token]
+        assert not self.mock_batch_request_factory.return_value.submit.called
+
+    def test_tween_yields_incomplete_token_at_end_of_stream(self):
+        del self.mock_request.disable_hypernova_tween
+        mock_handler = mock.Mock()
+        mock_handler.return_value = Response(app_iter=[b'<p/><!--hypernova-render-token-my-'])
+        tween = hypernova_tween_factory(mock_handler, self.mock_registry)
+
+        response = tween(self.mock_request)
+
+        assert list(response.app_iter) == [b'<p/>', b'<!--hypernova-render-token-my-']
+
+    def test_tween_closes_original_app_iter(self):
+        del self.mock_request.disable_hypernova_tween
+        original_app_iter = mock.MagicMock()
+        original_app_iter.__iter__.return_value = iter([b'<p/>'])
+        mock_handler = mock.Mock()
+        mock_handler.return_value = Response(app_iter=original_app_iter)
+        tween = hypernova_tween_factory(mock_handler, self.mock_registry)
+
+        response = tween(self.mock_request)
+        app_iter = response.app_iter
+        assert list(app_iter) == [b'<p/>']
+        app_iter.close()
+
+        original_app_iter.close.assert_called_once_with()
+
+
+class TestTweenTimings:
+
+    @pytest.fixture(autouse=True)
+    def mock_setup(self):
+        self.token = RenderToken('my-unique-id')
+        # a fake clock, advanced by the view, its templates and submit
+        self.clock = [0]
+
+        self.mock_batch_request = mock.Mock(encode_time=0.25, wait_time=1.5)
+        self.mock_batch_request.submit.side_effect = lambda: self.advance_clock(2) or {
+            'my-unique-id': JobResult(error=None, html='<div>REACT!</div>', job=None),
+        }
+
+        self.mock_registry = mock.Mock()
+        self.mock_registry.settings = {
+            'pyramid_hypernova.get_job_group_url': mock.Mock(),
+            'pyramid_hypernova.batch_request_factory': mock.Mock(return_value=self.mock_batch_request),
+        }
+
+        self.mock_request = mock.Mock()
+        del self.mock_request.disable_hypernova_tween
+
+        with mock.patch('pyramid_hypernova.tweens.time.perf_counter', side_effect=lambda: self.clock[0]):
+            yield
+
+    def advance_clock(self, seconds):
+        self.clock[0] += seconds
+
+    def create_tween(self, app_iter):
+        def handler(request):
+            self.advance_clock(1)
+            return Response(app_iter=app_iter)
+
+        return hypernova_tween_factory(handler, self.mock_registry)
+
+    def streamed_template(self):
+        yield b'<head/>'
+        self.advance_clock(4)
+        yield str(self.token).encode('utf-8')
+
+    def test_records_timings(self):
+        tween = self.create_tween(self.streamed_template())
+
+        response = tween(self.mock_request)
+        assert self.mock_request.hypernova_timings == {'view': 1, 'submit': 0, 'encode': 0, 'wait': 0, 'replace': 0}
+
+        assert list(response.app_iter) == [b'<head/>', b'<div>REACT!</div>']
+        assert self.mock_request.hypernova_timings == {
+            'view': 5,
+            'submit': 2,
+            'encode': 0.25,
+            'wait': 1.5,
+            'replace': 0,
+        }
+        assert 'Server-Timing' not in response.headers
+
+    def test_server_timing_for_buffered_response(self):
+        self.mock_registry.settings['pyramid_hypernova.server_timing'] = True
+        tween = self.create_tween([b'<head/>', str(self.token).encode('utf-8')])
+
+        response = tween(self.mock_request)
+
+        assert response.headers['Server-Timing'] == (
+            'hypernova-view;dur=1000.0, hypernova-submit;dur=2000.0, hypernova-encode;dur=250.0, '
+            'hypernova-wait;dur=1500.0, hypernova-replace;dur=0.0'
+        )
+        assert response.body == b'<head/><div>REACT!</div>'
+
+    def test_server_timing_for_streamed_response(self):
+        self.mock_registry.settings['pyramid_hypernova.server_timing'] = True
+        tween = self.create_tween(self.streamed_template())
+
+        response = tween(self.mock_request)
+
+        assert response.headers['Server-Timing'] == (
+            'hypernova-view;dur=1000.0, hypernova-submit;dur=0.0, hypernova-encode;dur=250.0, '
+            'hypernova-wait;dur=1500.0, hypernova-replace;dur=0.0'
+        )
+        assert not self.mock_batch_request.submit.called
+        assert list(response.app_iter) == [b'<head/>', b'<div>REACT!</div>']
+
+
+def test_format_server_timing():
+    timings = {'view': 0.0123, 'submit': 0.05, 'encode': 0.001, 'wait': 0.04, 'replace': 0.0004}
+
+    assert format_server_timing(timings) == (
+        'hypernova-view;dur=12.3, hypernova-submit;dur=50.0, hypernova-encode;dur=1.0, '
+        'hypernova-wait;dur=40.0, hypernova-replace;dur=0.4'
+    )
@@ -0,0 +1,212 @@
+from unittest import mock
+
+import pyramid.request
+import pytest
+
+from pyramid_hypernova.batch import BatchRequest
+from pyramid_hypernova.plugins import PluginController
+from pyramid_hypernova.transports import get_transport
+from pyramid_hypernova.transports import HypernovaQueryError
+from pyramid_hypernova.upstreams import Upstream
+from pyramid_hypernova.upstreams import UpstreamPool
+from pyramid_hypernova.upstreams import UpstreamStats
+from testing.hypernova_server import StubHypernovaServer
+
+URLS = ['http://hypernova-1/batch', 'http://hypernova-2/batch', 'http://hypernova-3/batch']
+
+
+@pytest.fixture
+def mock_monotonic():
+    with mock.patch('pyramid_hypernova.upstreams.time.monotonic', return_value=100) as mock_monotonic:
+        yield mock_monotonic
+
+
+@pytest.fixture
+def mock_sample():
+    # picks the first two candidates, in order
+    with mock.patch('pyramid_hypernova.upstreams.random.sample', side_effect=lambda population, k: population[:k]):
+        yield
+
+
+class TestUpstream:
+
+    def test_unknown_latency_costs_nothing(self):
+        assert Upstream(URLS[0]).get_cost(100, 10) == 0
+
+    @pytest.mark.parametrize('now,error_rate,expected', [
+        (100, 0, 0.2),
+        (110, 0, 0.2 / 2.718281828459045),
+        (100, 0.5, 0.4),
+        (100, 1, 20),
+    ])
+    def test_get_cost(self, now, error_rate, expected):
+        upstream = Upstream(URLS[0])
+        upstream.latency = 0.2
+        upstream.updated_at = 100
+        upstream.error_rate = error_rate
+
+        assert upstream.get_cost(now, 10) == pytest.approx(expected)
+
+
+class TestUpstreamPool:
+
+    def test_needs_urls(self):
+        with pytest.raises(ValueError):
+            UpstreamPool([])
+
+    def test_single_url(self):
+        pool = UpstreamPool(URLS[:1])
+
+        assert pool({}, mock.Mock()) == URLS[:1]
+
+    def test_chooses_two_distinct_urls(self):
+        pool = UpstreamPool(URLS)
+
+        for __ in range(20):
+            urls = pool.choose_urls()
+            assert len(set(urls)) == 2
+            assert set(urls) <= set(URLS)
+
+    def test_prefers_the_faster_choice(self, mock_monotonic, mock_sample):
+        pool = UpstreamPool(URLS)
+        pool.record_result(URLS[0], False, 0.5)
+        pool.record_result(URLS[1], False, 0.1)
+
+        assert pool.choose_urls() == [URLS[1], URLS[0]]
+
+    def test_prefers_the_healthier_choice(self, mock_monotonic, mock_sample):
+        pool = UpstreamPool(URLS, weight=0.5)
+        pool.record_result(URLS[0], True, 0.1)
+        pool.record_result(URLS[1], False, 0.15)
+
+        assert pool.choose_urls() == [URLS[1], URLS[0]]
+
+    def test_record_result(self, mock_monotonic):
+        pool = UpstreamPool(URLS, weight=0.5)
+
+        pool.record_result(URLS[0], False, 0.2)
+        pool.record_result(URLS[0], True, 0.4)
+        pool.record_result('http://elsewhere/batch', True, 0.4)
+
+        assert pool.get_stats() == {
+            URLS[0]: UpstreamStats(latency=pytest.approx(0.3), error_rate=0.5, queries=2, ejected=False),
+            URLS[1]: UpstreamStats(latency=None, error_rate=0, queries=0, ejected=False),
+            URLS[2]: UpstreamStats(latency=None, error_rate=0, queries=0, ejected=False),
+        }
+
+    def test_ejects_failing_upstream(self, mock_monotonic, mock_sample):
+        pool = UpstreamPool(URLS, weight=0.5, min_queries=2, ejection_time=30)
+
+        pool.record_result(URLS[0], True, 0.1)
+        assert not pool.get_stats()[URLS[0]].ejected
+
+        pool.record_result(URLS[0], True, 0.1)
+        assert pool.get_stats()[URLS[0]] == UpstreamStats(latency=None, error_rate=0, queries=0, ejected=True)
+        assert pool.choose_urls() == [URLS[1], URLS[2]]
+
+        mock_monotonic.return_value = 130
+        assert not pool.get_stats()[URLS[0]].ejected
+        assert pool.choose_urls() == [URLS[0], URLS[1]]
+
+    def test_single_upstream_left(self, mock_monotonic):
+        pool = UpstreamPool(URLS[:2], min_queries=1, ejection_error_rate=0.1)
+
+        pool.record_result(URLS[0], True, 0.1)
+
+        assert pool.choose_urls() == [URLS[1]]
+
+    def test_uses_every_upstream_when_all_are_ejected(self, mock_monotonic, mock_sample):
+        pool = UpstreamPool(URLS[:2], min_queries=1, ejection_error_rate=0.1)
+
+        pool.record_result(URLS[0], True, 0.1)
+        pool.record_result(URLS[1], True, 0.1)
+
+        assert pool.choose_urls() == URLS[:2]
+
+
+class TestBatchRequestUpstreamPool:
+
+    def create_batch_request(self, pool):
+        return BatchRequest(
+            get_job_group_url=pool,
+            plugin_controller=PluginController([]),
+            pyramid_request=pyramid.request.Request.blank('/'),
+        )
+
+    def test_records_query_results(self, mock_monotonic):
+        pool = UpstreamPool(URLS[:1])
+        batch_request = self.create_batch_request(pool)
+        batch_request.render('MyComponent.js', {})
+
+        with mock.patch('pyramid_hypernova.batch.HypernovaQuery') as mock_hypernova_query:
+            mock_hypernova_query.return_value.url = URLS[0]
+            mock_hypernova_query.return_value.network_time = 0.25
+            mock_hypernova_query.return_value.json.side_effect = HypernovaQueryError('oh no')
+            batch_request.submit()
+
+        assert mock_hypernova_query.call_args[0][1] == URLS[0]
+        assert pool.get_stats()[URLS[0]] == UpstreamStats(latency=0.25, error_rate=0.2, queries=1, ejected=False)
+
+    def test_sends_job_groups_to_the_faster_upstream(self):
+        with StubHypernovaServer(delay=0.05) as slow_stub_server, StubHypernovaServer() as stub_server:
+            pool = UpstreamPool([slow_stub_server.url, stub_server.url])
+            for __ in range(10):
+                batch_request = self.create_batch_request(pool)
+                token = batch_request.render('MyComponent.js', {})
+                response = batch_request.submit()
+                assert response[token.identifier].html == '<div>MyComponent.js</div>'
+
+        # Once both latencies are known, every job group goes to the faster upstream
+        assert len(slow_stub_server.requests) <= 2
+        assert len(stub_server.requests) >= 8
+
+    def test_records_latency_of_each_job_group(self):
+        with StubHypernovaServer(delay=0.5) as slow_stub_server, StubHypernovaServer() as stub_server:
+            urls = {'Slow.js': slow_stub_server.url, 'Fast.js': stub_server.url}
+
+            def get_job_group_url(job_group, pyramid_request):
+                [job] = job_group.values()
+                return urls[job.name]
+
+            get_job_group_url.record_result = mock.Mock()
+            batch_request = BatchRequest(
+                get_job_group_url=get_job_group_url,
+                plugin_controller=PluginController([]),
+                pyramid_request=pyramid.request.Request.blank('/'),
+                transport=get_transport('thread_pool'),
+                max_batch_size=1,
+            )
+            batch_request.render('Slow.js', {})
+            batch_request.render('Fast.js', {})
+            batch_request.submit()
+
+        latencies = {url: latency for (url, __, latency), __ in get_job_group_url.record_result.call_args_list}
+        # The fast job group isn't charged for the time spent waiting on the slow one
+        assert latencies[slow_stub_server.url] >= 0.5
+        assert latencies[stub_server.url] < 0.25
+
+    def test_ignores_job_groups_not_sent_before_the_deadline(self):
+        with StubHypernovaServer(delay=0.3) as slow_stub_server, StubHypernovaServer() as stub_server:
+            urls = {'Slow.js': slow_stub_server.url, 'Fast.js': stub_server.url}
+
+            def get_job_group_url(job_group, pyramid_request):
+                [job] = job_group.values()
+                return urls[job.name]
+
+            get_job_group_url.record_result = mock.Mock()
+            batch_request = BatchRequest(
+                get_job_group_url=get_job_group_url,
+                plugin_controller=PluginController([]),
+                pyramid_request=pyramid.request.Request.blank('/'),
+                transport='requests',
+                max_batch_size=1,
+                deadline=0.2,
+            )
+            batch_request.render('Slow.js', {})
+            batch_request.render('Fast.js', {})
+            batch_request.submit()
+
+        # requests' queries are sent one after the other, once they're waited on
+        assert stub_server.requests == []
+        # The fast upstream isn't blamed for the slow one
+        get_job_group_url.record_result.assert_called_once_with(slow_stub_server.url, True, mock.ANY)